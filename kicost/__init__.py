@@ -8,6 +8,9 @@ from .version import __version__, __build__  # noqa: F401
 
 class DistData(object):
     '''@brief Data from a distributor related to a part.'''
+    # No `__dict__`, big projects have thousands of these
+    __slots__ = ('part_num', 'url', 'price_tiers', 'qty_avail', 'qty_increment', 'currency', 'moq')
+
     def __init__(self):
         self.part_num = None  # Distributor catalogue number.
         self.url = None  # Purchase distributor URL for the spefic part.
@@ -18,11 +21,30 @@ class DistData(object):
         self.currency = None  # Default currency.
         self.moq = None  # Minimum order quantity allowd by the distributor.
 
+    def update(self, dd):
+        '''@brief Adds the data from another DistData, the values from `dd` have priority.'''
+        self.price_tiers.update(dd.price_tiers)
+        for attr in ('part_num', 'url', 'qty_avail', 'qty_increment', 'currency', 'moq'):
+            val = getattr(dd, attr)
+            if val is not None:
+                setattr(self, attr, val)
+
 
 # Class for storing part group information.
 class PartGroup(object):
     '''@brief Class to group components.'''
+    # No `__dict__`, big projects have thousands of these
+    __slots__ = ('refs', 'fields', 'manfcat_codes', 'collapsed_refs', 'first_ref', 'datasheet', 'lifecycle', 'specs', 'min_price',
+                 'qty', 'qty_str', 'qty_total_spreadsheet', 'dd')
+
     def __init__(self):
+        # Filled by `group_parts()`
+        self.refs = None  # References of the components in the group
+        self.fields = None  # Fields shared by all the components
+        self.manfcat_codes = None  # Codes for each manf#/distributor# field
+        # Filled by the spreadsheet code
+        self.collapsed_refs = None
+        self.first_ref = None
         # None by default, here to avoid try/except in the code
         self.datasheet = None
         self.lifecycle = None
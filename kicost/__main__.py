@@ -30,9 +30,11 @@ import platform
 import time
 import tqdm
 import logging
+import threading
 import subprocess
 # Debug, language and default configurations.
 from .global_vars import wxPythonNotPresent, DEBUG_OBSESSIVE, DEF_MAX_COLUMN_W, set_logger, KiCostError
+from .cache import PersistentCache, DEFAULT_CACHE_TTL
 # Import log first to set the domain and assign it to the global logger
 from . import log
 log.set_domain('kicost')
@@ -40,7 +42,7 @@ logger = log.init()
 set_logger(logger)
 
 # KiCost definitions and modules/packages functions.
-from .kicost import kicost, output_filename, kicost_gui_notdependences  # kicost core functions. # noqa: E402
+from .kicost import kicost, output_filename, kicost_gui_notdependences, set_bom_cache  # kicost core functions. # noqa: E402
 try:
     from .kicost_gui import kicost_gui
     GUI_ENABLED = True
@@ -49,7 +51,8 @@ except wxPythonNotPresent:
     GUI_ENABLED = False
 from .edas import get_registered_eda_names, set_edas_logger  # noqa: E402
 from .distributors import (get_distributors_list, set_distributors_logger, set_distributors_progress, set_api_options, set_api_status,  # noqa: E402
-                           get_api_status)  # noqa: E402
+                           set_api_limits, get_api_status, set_distributors_cache, set_distributors_concurrency, set_distributors_retries,  # noqa: E402
+                           set_distributors_recorder, HttpRecorder)  # noqa: E402
 from .spreadsheet import Spreadsheet  # noqa: E402
 from . import __version__, __build__  # Version control by @xesscorp and collaborator.  # noqa: E402
 
@@ -107,14 +110,22 @@ class TqdmLoggingHandler(logging.Handler):
 
 
 class ProgressConsole(object):
+    # The APIs can run at the same time, the bars share the logging handler
+    lock = threading.Lock()
+    active = 0
+    logTqdmHandler = None
+
     def __init__(self, total, logger):
-        # Create a handler that emits using TQDM
-        self.logTqdmHandler = TqdmLoggingHandler(sys.stderr)
-        # Apply our custom formatter
-        self.logTqdmHandler.setFormatter(log.CustomFormatter(sys.stderr))
-        # Add as a handler and avoid propagating to the base class
-        logger.addHandler(self.logTqdmHandler)
-        logger.propagate = False
+        with ProgressConsole.lock:
+            if not ProgressConsole.active:
+                # Create a handler that emits using TQDM
+                ProgressConsole.logTqdmHandler = TqdmLoggingHandler(sys.stderr)
+                # Apply our custom formatter
+                ProgressConsole.logTqdmHandler.setFormatter(log.CustomFormatter(sys.stderr))
+                # Add as a handler and avoid propagating to the base class
+                logger.addHandler(ProgressConsole.logTqdmHandler)
+                logger.propagate = False
+            ProgressConsole.active += 1
         self.logger = logger
         # Create the progress object
         self.progress = tqdm.tqdm(desc='Progress', total=total, unit='part', miniters=1, file=sys.stderr)
@@ -124,8 +135,11 @@ class ProgressConsole(object):
 
     def close(self):
         self.progress.close()
-        self.logger.removeHandler(self.logTqdmHandler)
-        self.logger.propagate = True
+        with ProgressConsole.lock:
+            ProgressConsole.active -= 1
+            if not ProgressConsole.active:
+                self.logger.removeHandler(ProgressConsole.logTqdmHandler)
+                self.logger.propagate = True
 
 
 ###############################################################################
@@ -232,6 +246,33 @@ def main_real():
     parser.add_argument('--no_price',
                         action='store_true',
                         help='Create a spreadsheet without scraping part data from distributor websites.')
+    parser.add_argument('--cache_ttl',
+                        type=float,
+                        default=DEFAULT_CACHE_TTL,
+                        metavar='HOURS',
+                        help='Time to keep the distributors data in the cache and the --incremental file. Default: ' + str(DEFAULT_CACHE_TTL) + ' hours.')
+    parser.add_argument('--no_cache',
+                        action='store_true',
+                        help='Always ask the distributors and read the BoMs, don\'t use the cached data.')
+    parser.add_argument('--incremental',
+                        type=str, metavar='FILE',
+                        help='Keep the distributors data in FILE, the next run will only query the new or changed parts.')
+    parser.add_argument('--record',
+                        type=str, metavar='DIR',
+                        help='Store the responses from the distributors in DIR, to use them with --replay.')
+    parser.add_argument('--replay',
+                        type=str, metavar='DIR',
+                        help='Use the responses stored with --record in DIR, the distributors aren\'t contacted.')
+    parser.add_argument('--parallel_queries',
+                        type=int,
+                        default=4,
+                        metavar='NUM',
+                        help='Maximum number of distributor queries sent at the same time. Use 1 to send them, and run the APIs, one by one. Default: 4.')
+    parser.add_argument('--retries',
+                        type=int,
+                        default=4,
+                        metavar='NUM',
+                        help='How many times a query is retried when the server is busy or the connection fails. Default: 4.')
     parser.add_argument('--currency',
                         nargs='?',
                         type=str,
@@ -272,6 +313,12 @@ def main_real():
     parser.add_argument('--octopart_level',
                         nargs='?', type=str, metavar='APILEVEL', choices=['3', '3p', '4', '4p'],
                         help='Use Octopart API level. Can be 3 or 4 for basic API and 3p or 4p for PRO plans. Default: 4')
+    parser.add_argument('--octopart_rate',
+                        nargs='?', type=float, metavar='RATE',
+                        help='Maximum number of Octopart requests per second.')
+    parser.add_argument('--octopart_budget',
+                        nargs='+', type=int, metavar='NUM',
+                        help='Daily budget for the Octopart key: maximum number of requests and, optionally, of parts.')
 
     args = parser.parse_args()
 
@@ -312,8 +359,29 @@ def main_real():
         # Output file was given. Make sure it has spreadsheet extension.
         args.output = os.path.splitext(args.output)[0] + '.xlsx'
 
+    # Record or replay the distributors responses
+    if args.record and args.replay:
+        logger.error('Use --record or --replay, not both.')
+        sys.exit(2)
+    if args.record or args.replay:
+        set_distributors_recorder(HttpRecorder(args.record or args.replay, replay=bool(args.replay)))
+        # All the queries must be recorded/replayed
+        args.no_cache = True
+
+    # Persistent cache for the distributors data and the parsed BoMs
+    if not args.no_cache:
+        set_distributors_cache(PersistentCache('queries', ttl=args.cache_ttl))
+        # The BoMs are identified by their content, so they don't expire
+        set_bom_cache(PersistentCache('boms', ttl=0))
+
+    set_distributors_concurrency(max(args.parallel_queries, 1))
+    set_distributors_retries(max(args.retries, 0))
+
     # Configure the Octopart API
     set_api_options('Octopart', key=args.octopart_key, level=args.octopart_level)
+    if args.octopart_rate or args.octopart_budget:
+        budget = (args.octopart_budget or []) + [None, None]
+        set_api_limits('Octopart', rate=args.octopart_rate, requests=budget[0], parts=budget[1])
     if get_api_status('Octopart'):
         # Disable KitSpace if Octopart is enabled.
         # Mixing both could sound useful, but KitSpace uses Octopart, so any difference is most probably an error.
@@ -409,7 +477,8 @@ def main_real():
            user_fields=args.fields, ignore_fields=args.ignore_fields,
            group_fields=args.group_fields, translate_fields=args.translate_fields,
            variant=args.variant, dist_list=dist_list, currency=args.currency, max_column_width=args.max_column_width,
-           split_extra_fields=args.split_extra_fields, board_qty=args.board_qty)
+           split_extra_fields=args.split_extra_fields, board_qty=args.board_qty, incremental=args.incremental,
+           incremental_ttl=args.cache_ttl)
 
 
 def main():
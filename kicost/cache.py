@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# MIT license
+#
+# Copyright (c) 2021 KiCost authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Cache module
+
+Persistent on-disk storage used to avoid repeating expensive operations
+between runs (i.e. distributor queries).
+"""
+import os
+import sys
+import time
+import zlib
+import hashlib
+import sqlite3
+import threading
+from .global_vars import PLATFORM_MACOS_STARTS_WITH, PLATFORM_WINDOWS_STARTS_WITH, DEBUG_OVERVIEW, get_logger
+
+__all__ = ['get_cache_path', 'PersistentCache', 'DEFAULT_CACHE_TTL', 'DEFAULT_CACHE_SIZE']
+
+# Default time to live for the cached entries, in hours.
+DEFAULT_CACHE_TTL = 24
+# Default maximum size for the data stored in each cache, in MB.
+DEFAULT_CACHE_SIZE = 50
+
+
+def get_cache_path(appname='kicost'):
+    ''' Directory used to store the cache files.
+        Can be changed using the KICOST_CACHE_DIR environment variable. '''
+    if os.environ.get('KICOST_CACHE_DIR'):
+        return os.environ['KICOST_CACHE_DIR']
+    if sys.platform == PLATFORM_MACOS_STARTS_WITH:
+        cache = os.path.expanduser(os.path.join("~", "Library", "Caches", appname))
+    elif sys.platform == PLATFORM_WINDOWS_STARTS_WITH:
+        cache = os.path.join(os.environ.get('LOCALAPPDATA', os.environ.get('APPDATA', '')), appname, 'cache')
+    else:
+        # ~/.cache/kicost
+        cache = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join("~", ".cache"))), appname)
+    return cache
+
+
+def to_bytes(val):
+    return val.encode('utf-8')
+
+
+class PersistentCache(object):
+    '''@brief Key/value storage kept in an SQLite file.
+
+       The keys are hashed, so any string can be used. The values are strings, they are stored compressed.
+       Entries older than `ttl` hours are ignored and the oldest entries are discarded when the stored data
+       is bigger than `max_size` MB.
+       The object can be shared by more than one thread.
+    '''
+    def __init__(self, name, ttl=DEFAULT_CACHE_TTL, max_size=DEFAULT_CACHE_SIZE, path=None):
+        self.name = name
+        self.file_name = os.path.join(path or get_cache_path(), name + '.sqlite')
+        self.ttl = ttl*3600
+        self.max_size = max_size*1024*1024
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        self.failed = False
+        self.lock = threading.RLock()
+
+    def _connect(self):
+        if self.db is None and not self.failed:
+            try:
+                dir_name = os.path.dirname(self.file_name)
+                if not os.path.isdir(dir_name):
+                    os.makedirs(dir_name)
+                self.db = sqlite3.connect(self.file_name, check_same_thread=False)
+                self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, stamp REAL, data BLOB)')
+                self.db.execute('CREATE INDEX IF NOT EXISTS cache_stamp ON cache (stamp)')
+            except (OSError, sqlite3.Error) as e:
+                # Don't abort the run just because we can't use the cache
+                get_logger().warning('Disabling the `{}` cache, unable to use `{}` ({})'.format(self.name, self.file_name, e))
+                self.db = None
+                self.failed = True
+        return self.db
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha1(to_bytes(key)).hexdigest()
+
+    def get(self, key):
+        ''' Returns the value stored for `key` or `None` if not found or expired '''
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return None
+            try:
+                row = db.execute('SELECT stamp, data FROM cache WHERE key=?', (self.hash_key(key),)).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row is None or (self.ttl and time.time() - row[0] > self.ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+        return zlib.decompress(bytes(row[1])).decode('utf-8')
+
+    def set(self, key, value):
+        ''' Stores `value` (a string) using `key` '''
+        data = sqlite3.Binary(zlib.compress(to_bytes(value)))
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return
+            try:
+                db.execute('INSERT OR REPLACE INTO cache (key, stamp, data) VALUES (?, ?, ?)', (self.hash_key(key), time.time(), data))
+            except sqlite3.Error as e:
+                get_logger().debug('Failed to store `{}` cache entry ({})'.format(self.name, e))
+
+    def evict(self):
+        ''' Removes the expired entries and the oldest ones if we exceed the size limit '''
+        db = self.db
+        if self.ttl:
+            db.execute('DELETE FROM cache WHERE stamp<?', (time.time() - self.ttl,))
+        size = db.execute('SELECT SUM(LENGTH(data)) FROM cache').fetchone()[0] or 0
+        if size <= self.max_size:
+            return
+        # Discard the oldest entries
+        old_keys = []
+        for key, length in db.execute('SELECT key, LENGTH(data) FROM cache ORDER BY stamp').fetchall():
+            if size <= self.max_size:
+                break
+            old_keys.append((key,))
+            size -= length
+        db.executemany('DELETE FROM cache WHERE key=?', old_keys)
+
+    def flush(self):
+        ''' Commits the changes to disk and reports the cache usage '''
+        with self.lock:
+            get_logger().log(DEBUG_OVERVIEW, 'Cache `{}`: {} hits, {} misses'.format(self.name, self.hits, self.misses))
+            self.hits = self.misses = 0
+            if self.db is None:
+                return
+            try:
+                self.evict()
+                self.db.commit()
+            except sqlite3.Error as e:
+                get_logger().warning('Failed to update the `{}` cache ({})'.format(self.name, e))
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.db is not None:
+                self.db.close()
+                self.db = None
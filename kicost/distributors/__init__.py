@@ -33,6 +33,8 @@ from .distributors_info import ORDER_COL_USERFIELDS  # noqa: F401
 from .dist_local_template import dist_local_template  # noqa: F401
 from .api_octopart import api_octopart  # noqa: F401
 from .api_partinfo_kitspace import api_partinfo_kitspace  # noqa: F401
+# Used to record/replay the queries
+from .recorder import HttpRecorder  # noqa: F401
 
 
 #
@@ -42,8 +44,8 @@ def init_distributor_dict():
     distributor_class.init_dist_dict()
 
 
-def get_dist_parts_info(parts, dist_list, currency):
-    distributor_class.get_dist_parts_info(parts, dist_list, currency)
+def get_dist_parts_info(parts, dist_list, currency, to_query=None):
+    distributor_class.get_dist_parts_info(parts, dist_list, currency, to_query)
 
 
 def get_registered_apis():
@@ -81,11 +83,42 @@ def set_distributors_progress(cls):
     distributor_class.progress = cls
 
 
+def set_distributors_cache(cache):
+    ''' Configures the persistent cache used for the queries (`None` to disable it) '''
+    distributor_class.cache = cache
+
+
+def set_distributors_recorder(recorder):
+    ''' Configures the object used to record or replay the queries (`None` to disable it) '''
+    distributor_class.recorder = recorder
+
+
+def set_distributors_concurrency(workers, per_host=None):
+    ''' Configures how many queries can be sent at the same time, in total and to the same server '''
+    distributor_class.max_workers = workers
+    if per_host is not None:
+        distributor_class.max_host_connections = per_host
+    # The size of the connections pool depends on it
+    distributor_class.session = None
+
+
+def set_distributors_retries(retries, backoff=None):
+    ''' Configures how many times a failed query is retried and the initial wait time (in seconds) '''
+    distributor_class.retries = retries
+    if backoff is not None:
+        distributor_class.retry_backoff = backoff
+
+
 def set_api_options(api, **kwargs):
     ''' Configure an API (by name) '''
     distributor_class.set_api_options(api, **kwargs)
 
 
+def set_api_limits(api, rate=None, requests=None, parts=None):
+    ''' Limits the rate (requests per second) and daily budget of an API '''
+    distributor_class.set_api_limits(api, rate, requests, parts)
+
+
 def set_api_status(api, enabled):
     ''' Enable/Disable a particular API '''
     distributor_class.set_api_status(api, enabled)
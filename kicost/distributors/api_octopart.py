@@ -23,7 +23,6 @@
 
 # Libraries.
 import json
-import requests
 import re
 import os
 import sys
@@ -54,6 +53,7 @@ class api_octopart(distributor_class):
     type = 'api'
     enabled = False
     url = 'https://octopart.com/'  # Web site API information.
+    timeout = (10, 30)  # Connect and read timeouts for the queries (seconds)
     api_level = 4
     # Include specs and datasheets. Only in the Pro plan.
     extended = False
@@ -122,7 +122,7 @@ class api_octopart(distributor_class):
             data += '&include[]=specs'
             data += '&include[]=datasheets'
         distributor_class.log_request(url, data)
-        response = requests.get(url + '?' + data)
+        response = distributor_class.http_request('GET', url + '?' + data, timeout=api_octopart.timeout, api=api_octopart)
         distributor_class.log_response(response)
         if response.status_code == 200:  # Ok
             results = json.loads(response.text).get('results')
@@ -187,8 +187,28 @@ class api_octopart(distributor_class):
             part.fields['manf#'] = mpn_cnts.most_common(1)[0][0]
 
     @staticmethod
-    def get_part_info(query, parts, distributors, currency='USD'):
-        """Query Octopart for quantity/price info and place it into the parts list."""
+    def cache_key(query, distributors, currency):
+        # The API level and the extended information changes the results
+        return distributor_class.cache_key(api_octopart.name, query, distributors, currency, api_octopart.api_level, api_octopart.extended)
+
+    @staticmethod
+    def get_part_info(queries, distributors, currency):
+        """Query Octopart for quantity/price info of a batch of queries.
+           `queries` is a list of (index, query) tuples, the index is used as reference.
+           Returns a dict with the results, indexed by reference.
+           The results are also stored in the cache."""
+        results = api_octopart.query(['{"reference": "'+str(i)+'", '+part_query+'}' for i, part_query in queries])
+        queries = dict(queries)
+        res = {}
+        for result in results or []:
+            i = int(result['reference'])  # Get the index into the part dict.
+            res[i] = result
+            distributor_class.cache_put(api_octopart.cache_key(queries[i], distributors, currency), result)
+        return res
+
+    @staticmethod
+    def fill_part_info(part, result, distributors, currency='USD'):
+        """Place the quantity/price info of a query result into the part."""
         # Translate from Octopart distributor names to the names used internally by kicost.
         dist_xlate = api_octopart.DIST_TRANSLATION
         # List of desired distributors in native format
@@ -199,163 +219,155 @@ class api_octopart(distributor_class):
             currency_prio.append('USD')
         if currency != 'EUR':
             currency_prio.append('EUR')
-        results = api_octopart.query(query)
-        # Loop through the response to the query and enter info into the parts list.
-        for result in results:
-            i = int(result['reference'])  # Get the index into the part dict.
-            part = parts[i]
-            # Each result can match one or more components from different manufacturers
-            # Take only the items with useful offers
-            useful_items = []
-            for item in result['items']:
-                for offer in item['offers']:
-                    if offer['seller']['name'] in native_dists:
-                        useful_items.append(item)
-                        break
-            # distributor_class.logger.log(DEBUG_OBSESSIVE, str(result))
-            # distributor_class.logger.log(DEBUG_OBSESSIVE, str(useful_items))
-            # If more than one select the right one
-            if len(useful_items) > 1:
-                # List of possible manufacturers
-                # TODO: Can we get more than one hit for the same manf?
-                manufacturers = {it['manufacturer']['name'].lower(): it for it in useful_items}
-                # Is the manf included?
-                manf = part.fields.get('manf', 'none').lower()
-                item = manufacturers.get(manf)
-                if not item:
-                    if manf == 'none':
-                        item = useful_items[0]
-                    else:
-                        best_match = difflib.get_close_matches(manf, manufacturers.keys())[0]
-                        item = manufacturers[best_match]
-                    mpn = item['mpn']
-                    distributor_class.logger.warning(W_AMBIPN+'Using "{}" for manf#="{}"'.format(item['manufacturer']['name'], mpn))
-                    distributor_class.logger.warning(W_AMBIPN+'Ambiguous manf#="{}" please use manf to select the right one, choices: {}'.format(
-                                                      mpn, list(manufacturers.keys())))
-            else:
-                if len(useful_items):
+        # Each result can match one or more components from different manufacturers
+        # Take only the items with useful offers
+        useful_items = []
+        for item in result['items']:
+            for offer in item['offers']:
+                if offer['seller']['name'] in native_dists:
+                    useful_items.append(item)
+                    break
+        # distributor_class.logger.log(DEBUG_OBSESSIVE, str(result))
+        # distributor_class.logger.log(DEBUG_OBSESSIVE, str(useful_items))
+        # If more than one select the right one
+        if len(useful_items) > 1:
+            # List of possible manufacturers
+            # TODO: Can we get more than one hit for the same manf?
+            manufacturers = {it['manufacturer']['name'].lower(): it for it in useful_items}
+            # Is the manf included?
+            manf = part.fields.get('manf', 'none').lower()
+            item = manufacturers.get(manf)
+            if not item:
+                if manf == 'none':
                     item = useful_items[0]
                 else:
-                    # No hits, skip
-                    continue
-            if api_octopart.extended:
-                # Assign the lifecycle status 'obsolete' (others possible: 'active' and 'not recommended for new designs') but not used.
+                    best_match = difflib.get_close_matches(manf, manufacturers.keys())[0]
+                    item = manufacturers[best_match]
+                mpn = item['mpn']
+                distributor_class.logger.warning(W_AMBIPN+'Using "{}" for manf#="{}"'.format(item['manufacturer']['name'], mpn))
+                distributor_class.logger.warning(W_AMBIPN+'Ambiguous manf#="{}" please use manf to select the right one, choices: {}'.format(
+                                                  mpn, list(manufacturers.keys())))
+        else:
+            if len(useful_items):
+                item = useful_items[0]
+            else:
+                # No hits, skip
+                return
+        if api_octopart.extended:
+            # Assign the lifecycle status 'obsolete' (others possible: 'active' and 'not recommended for new designs') but not used.
+            try:
+                # API v4 (production, eol, nrnd, ...) we take the first word
+                part.lifecycle = item['specs']['lifecyclestatus']['value'][0].lower().split(' ')[0]
+            except KeyError:
                 try:
-                    # API v4 (production, eol, nrnd, ...) we take the first word
-                    part.lifecycle = item['specs']['lifecyclestatus']['value'][0].lower().split(' ')[0]
+                    # API v3
+                    part.lifecycle = item['specs']['lifecycle_status']['value'][0].lower()
                 except KeyError:
-                    try:
-                        # API v3
-                        part.lifecycle = item['specs']['lifecycle_status']['value'][0].lower()
-                    except KeyError:
-                        # No lifecyclestatus (current name) nor lifecycle_status (old name)
-                        pass
-                # Take the datasheet provided by the distributor. This will by used
-                # in the output spreadsheet if not provide any in the BOM/schematic.
-                # This will be signed in the file.
+                    # No lifecyclestatus (current name) nor lifecycle_status (old name)
+                    pass
+            # Take the datasheet provided by the distributor. This will by used
+            # in the output spreadsheet if not provide any in the BOM/schematic.
+            # This will be signed in the file.
+            try:
+                part.datasheet = item['datasheets'][0]['url']
+            except (KeyError, IndexError):
+                # No datasheet key (KeyError) or empty (IndexError)
+                pass
+            # Misc data collected, currently not used inside KiCost
+            part.update_specs({code: (info['metadata']['name'], ', '.join(info['value'])) for code, info in item['specs'].items()})
+        # Loop through the offers from various dists for this particular part.
+        for offer in item['offers']:
+            # Get the distributor who made the offer and add their
+            # price/qty info to the parts list if its one of the accepted distributors.
+            dist = dist_xlate.get(offer['seller']['name'], '')
+            if dist not in distributors:
+                # Unknown or excluded seller
+                continue
+            price_tiers = {}
+            part_qty_increment = float("inf")
+            # Get the DistData for this distributor
+            dd = part.dd.get(dist, DistData())
+            # Get pricing information from this distributor.
+            prices = offer['prices']
+            if prices:
+                for curr in currency_prio:
+                    if curr in prices:
+                        dd.currency = curr
+                        price_l = prices[curr]
+                        break
+                else:
+                    # Use the first entry
+                    dd.currency, price_l = next(iter(prices.items()))
+                price_tiers = {qty: float(price) for qty, price in price_l}
+                # Combine price lists for multiple offers from the same distributor
+                # to build a complete list of cut-tape and reeled components.
+                dd.price_tiers.update(price_tiers)
+                # Compute the quantity increment between the lowest two prices.
+                # This will be used to distinguish the cut-tape from the reeled components.
                 try:
-                    part.datasheet = item['datasheets'][0]['url']
-                except (KeyError, IndexError):
-                    # No datasheet key (KeyError) or empty (IndexError)
+                    part_break_qtys = sorted(price_tiers.keys())
+                    part_qty_increment = part_break_qtys[1] - part_break_qtys[0]
+                except IndexError:
+                    # This will happen if there are not enough entries in the price/qty list.
+                    # As a stop-gap measure, just assign infinity to the part increment.
+                    # A better alternative may be to examine the packaging field of the offer.
                     pass
-                # Misc data collected, currently not used inside KiCost
-                part.update_specs({code: (info['metadata']['name'], ', '.join(info['value'])) for code, info in item['specs'].items()})
-            # Loop through the offers from various dists for this particular part.
-            for offer in item['offers']:
-                # Get the distributor who made the offer and add their
-                # price/qty info to the parts list if its one of the accepted distributors.
-                dist = dist_xlate.get(offer['seller']['name'], '')
-                if dist not in distributors:
-                    # Unknown or excluded seller
-                    continue
-                price_tiers = {}
-                part_qty_increment = float("inf")
-                # Get the DistData for this distributor
-                dd = part.dd.get(dist, DistData())
-                # Get pricing information from this distributor.
-                prices = offer['prices']
-                if prices:
-                    for curr in currency_prio:
-                        if curr in prices:
-                            dd.currency = curr
-                            price_l = prices[curr]
-                            break
-                    else:
-                        # Use the first entry
-                        dd.currency, price_l = next(iter(prices.items()))
-                    price_tiers = {qty: float(price) for qty, price in price_l}
-                    # Combine price lists for multiple offers from the same distributor
-                    # to build a complete list of cut-tape and reeled components.
-                    dd.price_tiers.update(price_tiers)
-                    # Compute the quantity increment between the lowest two prices.
-                    # This will be used to distinguish the cut-tape from the reeled components.
-                    try:
-                        part_break_qtys = sorted(price_tiers.keys())
-                        part_qty_increment = part_break_qtys[1] - part_break_qtys[0]
-                    except IndexError:
-                        # This will happen if there are not enough entries in the price/qty list.
-                        # As a stop-gap measure, just assign infinity to the part increment.
-                        # A better alternative may be to examine the packaging field of the offer.
-                        pass
-                # Select the part SKU, web page, and available quantity.
-                # Each distributor can have different stock codes for the same part in different
-                # quantities / delivery package styles: cut-tape, reel, ...
-                # Therefore we select and overwrite a previous selection if one of the
-                # following conditions is met:
-                #   1. We don't have a selection for this part from this distributor yet.
-                #   2. The MOQ is smaller than for the current selection.
-                #   3. The part_qty_increment for this offer smaller than that of the existing selection.
-                #      (we prefer cut-tape style packaging over reels)
-                #   4. For DigiKey, we can't use part_qty_increment to distinguish between
-                #      reel and cut-tape, so we need to look at the actual DigiKey part number.
-                #      This procedure is made by the definition `distributors_info[dist]['ignore_cat#_re']`
-                #      at the distributor profile.
-                if not dd.part_num:
-                    qty_avail = dd.qty_avail
-                    in_stock_quantity = offer.get('in_stock_quantity')
-                    if not qty_avail or (in_stock_quantity and qty_avail < in_stock_quantity):
-                        # Keep the information with more availability.
-                        dd.qty_avail = in_stock_quantity
-                    moq = dd.moq
-                    moq_offer = offer.get('moq')
-                    if not moq or (moq_offer and moq > moq_offer):
-                        # Save the link, stock code, ... of the page for minimum purchase.
-                        dd.moq = moq_offer  # Minimum order qty.
-                        dd.part_num = offer.get('sku')
-                        dd.url = offer.get('product_url')
-                        dd.qty_increment = part_qty_increment
-                # Otherwise, check qty increment and see if its the smallest for this part & dist.
-                elif part_qty_increment < dd.qty_increment:
-                    # This part looks more like a cut-tape version, so
-                    # update the SKU, web page, and available quantity.
-                    qty_avail = dd.qty_avail
-                    in_stock_quantity = offer.get('in_stock_quantity')
-                    if not qty_avail or (in_stock_quantity and qty_avail < in_stock_quantity):
-                        # Keep the information with more availability.
-                        dd.qty_avail = in_stock_quantity
-                    # Check for a valid SKU
-                    dist_part_num = offer.get('sku', '')
-                    ign_stock_code = distributor_class.get_distributor_info(dist).ignore_cat
-                    valid_part = not (ign_stock_code and re.match(ign_stock_code, dist_part_num))
-                    moq_offer = offer.get('moq')
-                    if (valid_part and (not dd.part_num or (part_qty_increment < dd.qty_increment) or
-                                        (not dd.moq or (moq_offer and dd.moq > moq_offer)))):
-                        # Save the link, stock code, ... of the page for minimum purchase.
-                        dd.moq = moq_offer  # Minimum order qty.
-                        dd.part_num = dist_part_num
-                        dd.url = offer.get('product_url')
-                        dd.qty_increment = part_qty_increment
-                # Update the DistData for this distributor
-                part.dd[dist] = dd
+            # Select the part SKU, web page, and available quantity.
+            # Each distributor can have different stock codes for the same part in different
+            # quantities / delivery package styles: cut-tape, reel, ...
+            # Therefore we select and overwrite a previous selection if one of the
+            # following conditions is met:
+            #   1. We don't have a selection for this part from this distributor yet.
+            #   2. The MOQ is smaller than for the current selection.
+            #   3. The part_qty_increment for this offer smaller than that of the existing selection.
+            #      (we prefer cut-tape style packaging over reels)
+            #   4. For DigiKey, we can't use part_qty_increment to distinguish between
+            #      reel and cut-tape, so we need to look at the actual DigiKey part number.
+            #      This procedure is made by the definition `distributors_info[dist]['ignore_cat#_re']`
+            #      at the distributor profile.
+            if not dd.part_num:
+                qty_avail = dd.qty_avail
+                in_stock_quantity = offer.get('in_stock_quantity')
+                if not qty_avail or (in_stock_quantity and qty_avail < in_stock_quantity):
+                    # Keep the information with more availability.
+                    dd.qty_avail = in_stock_quantity
+                moq = dd.moq
+                moq_offer = offer.get('moq')
+                if not moq or (moq_offer and moq > moq_offer):
+                    # Save the link, stock code, ... of the page for minimum purchase.
+                    dd.moq = moq_offer  # Minimum order qty.
+                    dd.part_num = offer.get('sku')
+                    dd.url = offer.get('product_url')
+                    dd.qty_increment = part_qty_increment
+            # Otherwise, check qty increment and see if its the smallest for this part & dist.
+            elif part_qty_increment < dd.qty_increment:
+                # This part looks more like a cut-tape version, so
+                # update the SKU, web page, and available quantity.
+                qty_avail = dd.qty_avail
+                in_stock_quantity = offer.get('in_stock_quantity')
+                if not qty_avail or (in_stock_quantity and qty_avail < in_stock_quantity):
+                    # Keep the information with more availability.
+                    dd.qty_avail = in_stock_quantity
+                # Check for a valid SKU
+                dist_part_num = offer.get('sku', '')
+                ign_stock_code = distributor_class.get_distributor_info(dist).ignore_cat
+                valid_part = not (ign_stock_code and re.match(ign_stock_code, dist_part_num))
+                moq_offer = offer.get('moq')
+                if (valid_part and (not dd.part_num or (part_qty_increment < dd.qty_increment) or
+                                    (not dd.moq or (moq_offer and dd.moq > moq_offer)))):
+                    # Save the link, stock code, ... of the page for minimum purchase.
+                    dd.moq = moq_offer  # Minimum order qty.
+                    dd.part_num = dist_part_num
+                    dd.url = offer.get('product_url')
+                    dd.qty_increment = part_qty_increment
+            # Update the DistData for this distributor
+            part.dd[dist] = dd
 
     @staticmethod
     def query_part_info(parts, distributors, currency):
         """Fill-in the parts with price/qty/etc info from Octopart."""
         distributor_class.logger.log(DEBUG_OVERVIEW, '# Getting part data from Octopart...')
 
-        # Setup progress bar to track progress of Octopart queries.
-        progress = distributor_class.progress(len(parts), distributor_class.logger)
-
         # Get the valid distributors names used by them part catalog
         # that may be index by Octopart. This is used to remove the
         # local distributors and future not implemented in the Octopart
@@ -364,16 +376,15 @@ class api_octopart(distributor_class):
         distributors_octopart = [d for d in distributors if distributor_class.get_distributor_info(d).is_web()
                                  and d in api_octopart.API_DISTRIBUTORS]
 
-        # Break list of parts into smaller pieces and get price/quantities from Octopart.
-        octopart_query = []
-        prev_i = 0  # Used to record index where parts query occurs.
+        # Create the queries for the parts, a list of (part index, query)
+        queries = []
         for i, part in enumerate(parts):
 
             # Create an Octopart query using the manufacturer's part number or
             # distributor SKU.
             manf_code = part.fields.get('manf#')
             if manf_code:
-                part_query = '{"reference": "'+str(i)+'", "mpn": "'+quote_plus(manf_code)+'"}'
+                part_query = '"mpn": "'+quote_plus(manf_code)+'"'
             else:
                 # No MPN, so use the first distributor SKU that's found.
                 for octopart_dist_sku in distributors_octopart:
@@ -384,7 +395,7 @@ class api_octopart(distributor_class):
                     # No MPN or SKU, so skip this part.
                     continue
                 # Create the part query using SKU matching.
-                part_query = '{"reference": "'+str(i)+'", "sku": "'+quote_plus(sku)+'"}'
+                part_query = '"sku": "'+quote_plus(sku)+'"'
 
                 # Because was used the distributor (enrolled at Octopart list)
                 # despite the normal 'manf#' code, take the sub quantity as
@@ -398,23 +409,47 @@ class api_octopart(distributor_class):
                     pass
 
             # Add query for this part to the list of part queries.
-            octopart_query.append(part_query)
+            queries.append((i, part_query))
 
-            # Once there are enough (but not too many) part queries, make a query request to Octopart.
-            if len(octopart_query) == OCTOPART_MAX_PARTBYQUERY:
-                api_octopart.get_part_info(octopart_query, parts, distributors_octopart, currency)
-                progress.update(i - prev_i)  # Update progress bar.
-                prev_i = i
-                octopart_query = []  # Get ready for next batch.
-
-        # Query Octopart for the last batch of parts.
-        if octopart_query:
-            api_octopart.get_part_info(octopart_query, parts, distributors_octopart, currency)
-            progress.update(len(parts)-prev_i)  # This will indicate final progress of 100%.
+        if not queries:
+            return
+        # Ask only once for each query, the result is shared by all the parts using it.
+        unique, unique_index = distributor_class.unique_queries(queries, lambda q: q[1])
+        n_queries = len(unique)
+        # Setup progress bar to track progress of Octopart queries.
+        progress = distributor_class.progress(n_queries, distributor_class.logger)
+
+        # Use the results from the cache when available.
+        results = {}
+        pending = []  # Queries we must send to the server.
+        for i, part_query in unique:
+            found, result = distributor_class.cache_get(api_octopart.cache_key(part_query, distributors_octopart, currency))
+            if found:
+                results[i] = result
+            else:
+                pending.append((i, part_query))
+        progress.update(n_queries-len(pending))
+
+        # Break list of pending queries into smaller pieces and get price/quantities from Octopart.
+        batches = [pending[n:n+OCTOPART_MAX_PARTBYQUERY] for n in range(0, len(pending), OCTOPART_MAX_PARTBYQUERY)]
+        # Skip the batches that doesn't fit in the budget (when limited)
+        allowed = distributor_class.budget_batches(api_octopart, batches)
+        progress.update(sum(len(b) for b in batches[len(allowed):]))
+        for batch in allowed:
+            results.update(api_octopart.get_part_info(batch, distributors_octopart, currency))
+            progress.update(len(batch))
+
+        # Enter the info into the parts list, in the same order used to create the queries.
+        # The results are indexed using the part that originated the unique query.
+        for (i, _), n in zip(queries, unique_index):
+            result = results.get(unique[n][0])
+            if result:
+                api_octopart.fill_part_info(parts[i], result, distributors_octopart, currency)
 
         # Done with the scraping progress bar so delete it or else we get an
         # error when the program terminates.
         progress.close()
+        distributor_class.report_budget(api_octopart)
 
 
 # Configure the module from the environment
@@ -88,6 +88,7 @@ class api_partinfo_kitspace(distributor_class):
     type = 'api'
     enabled = True
     url = 'https://kitspace.org/'  # Web site API information.
+    timeout = (10, 90)  # Connect and read timeouts for the queries (seconds), big queries can be slow
 
     API_DISTRIBUTORS = ['digikey', 'farnell', 'mouser', 'newark', 'rs', 'arrow', 'tme', 'lcsc']
     DIST_TRANSLATION = {  # Distributor translation.
@@ -131,7 +132,7 @@ class api_partinfo_kitspace(distributor_class):
         data = OrderedDict()
         data["query"] = query_type
         data["variables"] = variables
-        response = requests.post(url, data)
+        response = distributor_class.http_request('POST', url, timeout=api_partinfo_kitspace.timeout, api=api_partinfo_kitspace, data=data)
         distributor_class.log_response(response)
         if response.status_code == requests.codes['ok']:  # 200
             results = json.loads(response.text)
@@ -159,105 +160,112 @@ class api_partinfo_kitspace(distributor_class):
         return default
 
     @staticmethod
-    def get_part_info(query, parts, distributors, currency, distributors_wanted):
-        '''Query PartInfo for quantity/price info and place it into the parts list.
-           `distributors_wanted` is the list of distributors we want for each query.
-           `distributors` is the list of all distributors we want, in general.
-           This difference is because some queries are for an specific distributor.
+    def cache_key(query, distributors, currency):
+        return distributor_class.cache_key(api_partinfo_kitspace.name, query, distributors, currency)
+
+    @staticmethod
+    def get_part_info(query, distributors):
+        '''Query PartInfo for quantity/price info of a batch of queries.
+           Returns the list of results, one for each query.
+           Can be called from a worker thread, so it must not modify the parts.
+        '''
+        return api_partinfo_kitspace.query(query, distributors)['data']['match']
+
+    @staticmethod
+    def fill_part_info(part_query, part, dist_want, result, currency):
+        '''Place the quantity/price info of a query result into the part.
+           `dist_want` is the list of distributors we want for this query.
+           This is because some queries are for an specific distributor.
         '''
         # Translate from PartInfo distributor names to the names used internally by kicost.
         dist_xlate = api_partinfo_kitspace.DIST_TRANSLATION
 
-        results = api_partinfo_kitspace.query(query, distributors)
-
-        # Loop through the response to the query and enter info into the parts list.
-        for part_query, part, dist_want, result in zip(query, parts, distributors_wanted, results['data']['match']):
-            if not result:
-                distributor_class.logger.warning(W_NOINFO+'No information found for parts \'{}\' query `{}`'.format(part.refs, str(part_query)))
+        if not result:
+            distributor_class.logger.warning(W_NOINFO+'No information found for parts \'{}\' query `{}`'.format(part.refs, str(part_query)))
+            return
+        # Get the information of the part.
+        part.datasheet = result.get('datasheet')
+        part.lifecycle = api_partinfo_kitspace.get_spec(result, 'lifecycle_status', 'active').lower()
+        # Misc data collected, currently not used inside KiCost
+        part.update_specs({sp['key']: (sp['key'], sp['value']) for sp in result['specs'] if sp['value']})
+        # Loop through the offers from various dists for this particular part.
+        for offer in result['offers']:
+            # Get the distributor who made the offer and add their
+            # price/qty info to the parts list if its one of the accepted distributors.
+            dist = dist_xlate.get(offer['sku']['vendor'], '')
+            if dist not in dist_want:
+                # Not interested in this distributor
                 continue
-            # Get the information of the part.
-            part.datasheet = result.get('datasheet')
-            part.lifecycle = api_partinfo_kitspace.get_spec(result, 'lifecycle_status', 'active').lower()
-            # Misc data collected, currently not used inside KiCost
-            part.update_specs({sp['key']: (sp['key'], sp['value']) for sp in result['specs'] if sp['value']})
-            # Loop through the offers from various dists for this particular part.
-            for offer in result['offers']:
-                # Get the distributor who made the offer and add their
-                # price/qty info to the parts list if its one of the accepted distributors.
-                dist = dist_xlate.get(offer['sku']['vendor'], '')
-                if dist not in dist_want:
-                    # Not interested in this distributor
-                    continue
-                # Get the DistData for this distributor
-                dd = part.dd.get(dist, DistData())
-                # This will happen if there are not enough entries in the price/qty list.
-                # As a stop-gap measure, just assign infinity to the part increment.
-                # A better alternative may be to examine the packaging field of the offer.
-                part_qty_increment = float("inf")
-                # Get pricing information from this distributor.
-                dist_currency = {cur: pri for cur, pri in offer['prices'].items() if pri}
-                if not dist_currency:
-                    # Some times the API returns minimum purchase 0 and a not valid `price_tiers`.
-                    distributor_class.logger.warning(NO_PRICE+'No price information found for parts \'{}\' query `{}`'.
-                                                     format(part.refs, str(part_query)))
+            # Get the DistData for this distributor
+            dd = part.dd.get(dist, DistData())
+            # This will happen if there are not enough entries in the price/qty list.
+            # As a stop-gap measure, just assign infinity to the part increment.
+            # A better alternative may be to examine the packaging field of the offer.
+            part_qty_increment = float("inf")
+            # Get pricing information from this distributor.
+            dist_currency = {cur: pri for cur, pri in offer['prices'].items() if pri}
+            if not dist_currency:
+                # Some times the API returns minimum purchase 0 and a not valid `price_tiers`.
+                distributor_class.logger.warning(NO_PRICE+'No price information found for parts \'{}\' query `{}`'.
+                                                 format(part.refs, str(part_query)))
+            else:
+                prices = None
+                # Get the price tiers prioritizing:
+                # 1) The asked currency by KiCost user;
+                # 2) The default currency given by `DEFAULT_CURRENCY` in root `global_vars.py`;
+                # 3) The first not null tiers
+                if currency in dist_currency:
+                    prices = dist_currency[currency]
+                    dd.currency = currency
+                elif DEFAULT_CURRENCY in dist_currency:
+                    prices = dist_currency[DEFAULT_CURRENCY]
+                    dd.currency = DEFAULT_CURRENCY
                 else:
-                    prices = None
-                    # Get the price tiers prioritizing:
-                    # 1) The asked currency by KiCost user;
-                    # 2) The default currency given by `DEFAULT_CURRENCY` in root `global_vars.py`;
-                    # 3) The first not null tiers
-                    if currency in dist_currency:
-                        prices = dist_currency[currency]
-                        dd.currency = currency
-                    elif DEFAULT_CURRENCY in dist_currency:
-                        prices = dist_currency[DEFAULT_CURRENCY]
-                        dd.currency = DEFAULT_CURRENCY
-                    else:
-                        dd.currency, prices = next(iter(dist_currency.items()))
-                    price_tiers = {qty: float(price) for qty, price in prices}
-                    # Combine price lists for multiple offers from the same distributor
-                    # to build a complete list of cut-tape and reeled components.
-                    dd.price_tiers.update(price_tiers)
-                    # Compute the quantity increment between the lowest two prices.
-                    # This will be used to distinguish the cut-tape from the reeled components.
-                    if len(price_tiers) > 1:
-                        part_break_qtys = sorted(price_tiers.keys())
-                        part_qty_increment = part_break_qtys[1] - part_break_qtys[0]
-                # Select the part SKU, web page, and available quantity.
-                # Each distributor can have different stock codes for the same part in different
-                # quantities / delivery package styles: cut-tape, reel, ...
-                # Therefore we select and overwrite a previous selection if one of the
-                # following conditions is met:
-                #   1. We don't have a selection for this part from this distributor yet.
-                #   2. The MOQ is smaller than for the current selection.
-                #   3. The part_qty_increment for this offer smaller than that of the existing selection.
-                #      (we prefer cut-tape style packaging over reels)
-                #   4. For DigiKey, we can't use part_qty_increment to distinguish between
-                #      reel and cut-tape, so we need to look at the actual DigiKey part number.
-                #      This procedure is made by the definition `distributors_info[dist]['ignore_cat#_re']`
-                #      at the distributor profile.
-                dist_part_num = offer.get('sku', '').get('part', '')
-                qty_avail = dd.qty_avail
-                in_stock_quantity = offer.get('in_stock_quantity')
-                if not qty_avail or (in_stock_quantity and qty_avail < in_stock_quantity):
-                    # Keeps the information of more availability.
-                    dd.qty_avail = in_stock_quantity  # In stock.
-                ign_stock_code = distributor_class.get_distributor_info(dist).ignore_cat
-                valid_part = not (ign_stock_code and re.match(ign_stock_code, dist_part_num))
-                # debug('dd.part_num')  # Uncomment to debug
-                # debug('dd.qty_increment')  # Uncomment to debug
-                moq = offer.get('moq')
-                if (valid_part and
-                    (not dd.part_num or
-                     (dd.qty_increment is None or part_qty_increment < dd.qty_increment) or
-                     (not dd.moq or (moq and dd.moq > moq)))):
-                    # Save the link, stock code, ... of the page for minimum purchase.
-                    dd.moq = moq  # Minimum order qty.
-                    dd.url = offer.get('product_url', '')  # Page to purchase the minimum quantity.
-                    dd.part_num = dist_part_num
-                    dd.qty_increment = part_qty_increment
-                # Update the DistData for this distributor
-                part.dd[dist] = dd
+                    dd.currency, prices = next(iter(dist_currency.items()))
+                price_tiers = {qty: float(price) for qty, price in prices}
+                # Combine price lists for multiple offers from the same distributor
+                # to build a complete list of cut-tape and reeled components.
+                dd.price_tiers.update(price_tiers)
+                # Compute the quantity increment between the lowest two prices.
+                # This will be used to distinguish the cut-tape from the reeled components.
+                if len(price_tiers) > 1:
+                    part_break_qtys = sorted(price_tiers.keys())
+                    part_qty_increment = part_break_qtys[1] - part_break_qtys[0]
+            # Select the part SKU, web page, and available quantity.
+            # Each distributor can have different stock codes for the same part in different
+            # quantities / delivery package styles: cut-tape, reel, ...
+            # Therefore we select and overwrite a previous selection if one of the
+            # following conditions is met:
+            #   1. We don't have a selection for this part from this distributor yet.
+            #   2. The MOQ is smaller than for the current selection.
+            #   3. The part_qty_increment for this offer smaller than that of the existing selection.
+            #      (we prefer cut-tape style packaging over reels)
+            #   4. For DigiKey, we can't use part_qty_increment to distinguish between
+            #      reel and cut-tape, so we need to look at the actual DigiKey part number.
+            #      This procedure is made by the definition `distributors_info[dist]['ignore_cat#_re']`
+            #      at the distributor profile.
+            dist_part_num = offer.get('sku', '').get('part', '')
+            qty_avail = dd.qty_avail
+            in_stock_quantity = offer.get('in_stock_quantity')
+            if not qty_avail or (in_stock_quantity and qty_avail < in_stock_quantity):
+                # Keeps the information of more availability.
+                dd.qty_avail = in_stock_quantity  # In stock.
+            ign_stock_code = distributor_class.get_distributor_info(dist).ignore_cat
+            valid_part = not (ign_stock_code and re.match(ign_stock_code, dist_part_num))
+            # debug('dd.part_num')  # Uncomment to debug
+            # debug('dd.qty_increment')  # Uncomment to debug
+            moq = offer.get('moq')
+            if (valid_part and
+                (not dd.part_num or
+                 (dd.qty_increment is None or part_qty_increment < dd.qty_increment) or
+                 (not dd.moq or (moq and dd.moq > moq)))):
+                # Save the link, stock code, ... of the page for minimum purchase.
+                dd.moq = moq  # Minimum order qty.
+                dd.url = offer.get('product_url', '')  # Page to purchase the minimum quantity.
+                dd.part_num = dist_part_num
+                dd.qty_increment = part_qty_increment
+            # Update the DistData for this distributor
+            part.dd[dist] = dd
 
     @staticmethod
     def query_part_info(parts, distributors, currency):
@@ -309,22 +317,48 @@ class api_partinfo_kitspace(distributor_class):
                 # List of distributors without an specific part number
                 query_part_stock_code.append(part_dist_use_manfpn)
 
-        n_queries = len(query_parts)
-        if not n_queries:
+        if not query_parts:
             return
+        # Ask only once for each query, the result is shared by all the parts using it.
+        # Note: the spaces are removed by query()
+        unique, unique_index = distributor_class.unique_queries(queries, lambda q: q.replace(' ', ''))
+        n_queries = len(unique)
         # Setup progress bar to track progress of server queries.
         progress = distributor_class.progress(n_queries, distributor_class.logger)
 
-        # Slice the queries into batches of the largest allowed size and gather
-        # the part data for each batch.
-        for i in range(0, len(queries), MAX_PARTS_PER_QUERY):
-            slc = slice(i, i+MAX_PARTS_PER_QUERY)
-            api_partinfo_kitspace.get_part_info(queries[slc], query_parts[slc], distributors, currency, query_part_stock_code[slc])
-            progress.update(len(queries[slc]))
+        # Use the results from the cache when available.
+        results = [None]*n_queries
+        pending = []  # Index of the queries we must send to the server.
+        for i, part_query in enumerate(unique):
+            found, result = distributor_class.cache_get(api_partinfo_kitspace.cache_key(part_query, distributors, currency))
+            if found:
+                results[i] = result
+            else:
+                pending.append(i)
+        progress.update(n_queries-len(pending))
+
+        # Slice the pending queries into batches of the largest allowed size and gather
+        # the part data for each batch. The batches are sent concurrently.
+        batches = [pending[i:i+MAX_PARTS_PER_QUERY] for i in range(0, len(pending), MAX_PARTS_PER_QUERY)]
+        # Skip the batches that doesn't fit in the budget (when limited)
+        allowed = distributor_class.budget_batches(api_partinfo_kitspace, batches)
+        progress.update(sum(len(b) for b in batches[len(allowed):]))
+        batches = allowed
+        batches_results = distributor_class.run_batches(api_partinfo_kitspace.get_part_info, [[unique[n] for n in b] for b in batches],
+                                                        progress, distributors)
+        for batch, batch_results in zip(batches, batches_results):
+            for n, result in zip(batch, batch_results):
+                results[n] = result
+                distributor_class.cache_put(api_partinfo_kitspace.cache_key(unique[n], distributors, currency), result)
+
+        # Enter the info into the parts list, in the same order used to create the queries.
+        for part_query, part, dist_want, n in zip(queries, query_parts, query_part_stock_code, unique_index):
+            api_partinfo_kitspace.fill_part_info(part_query, part, dist_want, results[n], currency)
 
         # Done with the scraping progress bar so delete it or else we get an
         # error when the program terminates.
         progress.close()
+        distributor_class.report_budget(api_partinfo_kitspace)
 
 
 distributor_class.register(api_partinfo_kitspace, 50)
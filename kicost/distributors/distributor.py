@@ -30,10 +30,26 @@ __company__ = 'INTI-CMNB - Argentina'
 
 import copy
 import os
+import json
 import logging
+import threading
+import time
 import tqdm
-from ..global_vars import DEFAULT_CURRENCY, DEBUG_HTTP_HEADERS, DEBUG_HTTP_RESPONSES
+import requests
+from email.utils import parsedate_tz, mktime_tz
+try:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+except ImportError:
+    # Python 2.7 without the `futures` backport, the queries are sent one by one
+    ThreadPoolExecutor = None
+import sys
+if sys.version_info[0] < 3:
+    from urlparse import urlsplit
+else:
+    from urllib.parse import urlsplit
+from ..global_vars import DEFAULT_CURRENCY, DEBUG_HTTP_HEADERS, DEBUG_HTTP_RESPONSES, DEBUG_OVERVIEW, ERR_SCRAPE, KiCostError, W_APIBUDGET
 from .distributors_info import distributors_info
+from .rate_limit import TokenBucket, QueryBudget
 
 __all__ = ['distributor_class']
 
@@ -66,6 +82,29 @@ class distributor_class(object):
     # The list of *used* distributors is handled separately.
     distributor_dict = {}
     label2name = {}
+    # Persistent cache for the queries results, `None` when disabled (see `set_distributors_cache()`)
+    cache = None
+    # Maximum number of queries sent at the same time (see `set_distributors_concurrency()`)
+    max_workers = 4
+    # Maximum number of queries sent at the same time to the same server
+    max_host_connections = 4
+    host_semaphores = {}
+    host_semaphores_lock = threading.Lock()
+    # HTTP session shared by all the APIs, keeps the connections alive (see `get_session()`)
+    session = None
+    session_lock = threading.Lock()
+    # Timeout for the queries (connect, read) in seconds, the APIs can override it
+    timeout = (10, 60)
+    # How many times a failed query is retried, the wait time is doubled on each retry
+    retries = 4
+    retry_backoff = 1
+    max_retry_wait = 60
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    # Limits for the queries of each API (see `set_api_limits()`)
+    rate_limiter = None
+    budget = None
+    # Record/replay of the HTTP responses, `None` when disabled (see `set_distributors_recorder()`)
+    recorder = None
 
     @staticmethod
     def register(api, priority):
@@ -80,11 +119,102 @@ class distributor_class(object):
         distributor_class.priorities.insert(index, priority)
 
     @staticmethod
-    def get_dist_parts_info(parts, distributors, currency=DEFAULT_CURRENCY):
-        ''' Get the parts info using the modules API/Scrape/Local.'''
+    def get_dist_parts_info(parts, distributors, currency=DEFAULT_CURRENCY, to_query=None):
+        ''' Get the parts info using the modules API/Scrape/Local.
+            When more than one API is enabled they run at the same time, each one
+            filling a private copy of the parts. The copies are then merged using
+            the APIs priority, so the result is the same we get running them in sequence.
+            The parts whose fields were changed by an API are asked again to the next
+            APIs, using the updated fields, as a sequential run does.
+            `to_query` is the subset of `parts` that must be asked to the remote APIs, the rest
+            already has the data (i.e. from a previous run). `None` means all the parts.
+            The local distributors always process all the parts. '''
+        apis = []
         for api in distributor_class.registered:
-            if api.enabled:
-                api.query_part_info(parts, distributors, currency)
+            api_parts = parts if to_query is None or api.type == 'local' else to_query
+            if api.enabled and api_parts:
+                apis.append((api, api_parts))
+        if ThreadPoolExecutor is None or distributor_class.max_workers < 2:
+            sequential, apis = apis, []
+        else:
+            # The local APIs with the highest priority don't use the network, running them
+            # before the rest the other APIs see their changes, as in a sequential run.
+            first = 0
+            while first < len(apis) and apis[first][0].type == 'local':
+                first += 1
+            sequential, apis = apis[:first], apis[first:]
+            if len(apis) < 2:
+                sequential, apis = sequential + apis, []
+        for api, api_parts in sequential:
+            api.query_part_info(api_parts, distributors, currency)
+        if apis:
+            # The fields of the parts before the queries, only the changes made by each API are merged
+            snapshots = {id(p): p.fields.copy() for _, api_parts in apis for p in api_parts}
+            buffers = [([distributor_class.part_buffer(p) for p in api_parts], list(distributors)) for api, api_parts in apis]
+            with ThreadPoolExecutor(max_workers=len(apis)) as executor:
+                futures = [executor.submit(api.query_part_info, b_parts, b_dists, currency) for (api, _), (b_parts, b_dists) in zip(apis, buffers)]
+                # Wait for all of them, errors are raised here
+                for f in futures:
+                    f.result()
+            changed = set()  # Parts with fields changed by the APIs already merged
+            for (api, api_parts), (b_parts, b_dists) in zip(apis, buffers):
+                bases = [snapshots[id(p)] for p in api_parts]
+                stale = [i for i, p in enumerate(api_parts) if id(p) in changed]
+                if stale:
+                    # This API didn't see the changes, ask again using the current fields
+                    redo = [distributor_class.part_buffer(api_parts[i]) for i in stale]
+                    api.query_part_info(redo, b_dists, currency)
+                    for i, b_part in zip(stale, redo):
+                        b_parts[i] = b_part
+                        bases[i] = api_parts[i].fields.copy()
+                for part, b_part, base in zip(api_parts, b_parts, bases):
+                    if distributor_class.merge_part_buffer(part, b_part, base):
+                        changed.add(id(part))
+                # Distributors added by the API (i.e. local distributors)
+                for dist in b_dists:
+                    if dist not in distributors:
+                        distributors.append(dist)
+        if distributor_class.cache is not None:
+            distributor_class.cache.flush()
+        if distributor_class.recorder is not None:
+            distributor_class.recorder.flush()
+
+    @staticmethod
+    def part_buffer(part):
+        ''' Private copy of a part used to collect the data from one API.
+            The fields are copied, the data filled by the APIs starts empty. '''
+        buf = copy.copy(part)
+        buf.fields = part.fields.copy()
+        buf.datasheet = buf.lifecycle = None
+        buf.specs = {}
+        buf.dd = {}
+        return buf
+
+    @staticmethod
+    def merge_part_buffer(part, buf, base):
+        ''' Adds the data collected in `buf` to the part, the data from `buf` has priority.
+            Only the fields changed by the API, compared to the `base` fields, are copied.
+            Returns `True` if any field was changed. '''
+        changed = False
+        for name, value in buf.fields.items():
+            if name not in base or base[name] != value:
+                part.fields[name] = value
+                changed = True
+        for name in base:
+            if name not in buf.fields and name in part.fields:
+                del part.fields[name]
+                changed = True
+        for dist, dd in buf.dd.items():
+            if dist in part.dd:
+                part.dd[dist].update(dd)
+            else:
+                part.dd[dist] = dd
+        if buf.datasheet is not None:
+            part.datasheet = buf.datasheet
+        if buf.lifecycle is not None:
+            part.lifecycle = buf.lifecycle
+        part.update_specs(buf.specs)
+        return changed
 
     @staticmethod
     def init_dist_dict():
@@ -143,6 +273,168 @@ class distributor_class(object):
             with open(os.environ['KICOST_LOG_HTTP'], 'at') as f:
                 f.write(response.text + '\n')
 
+    @staticmethod
+    def host_slot(url):
+        ''' Semaphore used to limit the concurrent connections to the server of `url`.
+            Use it in a `with` statement when sending the query. '''
+        host = urlsplit(url).netloc
+        with distributor_class.host_semaphores_lock:
+            sem = distributor_class.host_semaphores.get(host)
+            if sem is None:
+                sem = distributor_class.host_semaphores[host] = threading.BoundedSemaphore(distributor_class.max_host_connections)
+        return sem
+
+    @staticmethod
+    def get_session():
+        ''' Returns the HTTP session used for the queries, created on the first use. '''
+        with distributor_class.session_lock:
+            if distributor_class.session is None:
+                session = requests.Session()
+                # One pool for each server, big enough for all the concurrent queries
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(distributor_class.max_workers, distributor_class.max_host_connections))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                distributor_class.session = session
+            return distributor_class.session
+
+    @staticmethod
+    def retry_wait(attempt, response=None):
+        ''' Time to wait before retrying a query, honors the `Retry-After` header. '''
+        wait = distributor_class.retry_backoff * (2 ** attempt)
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                date = parsedate_tz(retry_after)
+                if date is not None:
+                    wait = mktime_tz(date) - time.time()
+        return min(max(wait, 0), distributor_class.max_retry_wait)
+
+    @staticmethod
+    def http_request(method, url, timeout=None, api=None, **kwargs):
+        ''' Sends an HTTP request using the shared session and returns the response.
+            Connection errors, timeouts and temporal server errors (i.e. 429 Too Many Requests)
+            are retried `retries` times. The error responses are returned to the caller.
+            The requests follow the rate limit of `api`.
+            When replaying the response comes from the recorded ones, no network access is done. '''
+        recorder = distributor_class.recorder
+        if recorder is not None and recorder.replay:
+            return recorder.get(method, url, kwargs.get('data'))
+        session = distributor_class.get_session()
+        attempt = 0
+        while True:
+            response = None
+            if api is not None and api.rate_limiter is not None:
+                api.rate_limiter.acquire()
+            try:
+                with distributor_class.host_slot(url):
+                    response = session.request(method, url, timeout=timeout or distributor_class.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= distributor_class.retries:
+                    raise KiCostError('Unable to contact `{}` ({})'.format(urlsplit(url).netloc, e), ERR_SCRAPE)
+                reason = str(e)
+            else:
+                if response.status_code not in distributor_class.RETRY_STATUS or attempt >= distributor_class.retries:
+                    if recorder is not None:
+                        recorder.put(method, url, kwargs.get('data'), response)
+                    return response
+                reason = 'status code {}'.format(response.status_code)
+            wait = distributor_class.retry_wait(attempt, response)
+            distributor_class.logger.log(DEBUG_OVERVIEW, 'Query to `{}` failed ({}), retrying in {:.1f} s'.
+                                         format(urlsplit(url).netloc, reason, wait))
+            time.sleep(wait)
+            attempt += 1
+
+    @staticmethod
+    def unique_queries(queries, key=None):
+        ''' Query planning: finds the queries that are repeated (i.e. same manf# used by more than one part).
+            `key` computes the canonical form of a query, compared to find the repeated ones.
+            Returns the list of unique queries and, for each query, the index of its unique query. '''
+        unique = []
+        index = []
+        seen = {}
+        for query in queries:
+            k = key(query) if key else query
+            n = seen.get(k)
+            if n is None:
+                n = seen[k] = len(unique)
+                unique.append(query)
+            index.append(n)
+        return unique, index
+
+    @staticmethod
+    def budget_batches(api, batches):
+        ''' Returns the batches of queries that fit in the daily budget of `api`.
+            The budget for them is reserved, the rest are reported.
+            Replayed responses don't use the budget, no query is sent. '''
+        if api.budget is None or not batches or (distributor_class.recorder is not None and distributor_class.recorder.replay):
+            return batches
+        fit = api.budget.reserve([len(b) for b in batches])
+        if fit < len(batches):
+            distributor_class.logger.warning(W_APIBUDGET + 'The {} daily budget is exhausted, {} parts not queried'.
+                                             format(api.name, sum(len(b) for b in batches[fit:])))
+        return batches[:fit]
+
+    @staticmethod
+    def report_budget(api):
+        ''' Informs the budget left for `api`, if limited '''
+        if api.budget is None:
+            return
+        requests, parts = api.budget.remaining()
+        left = []
+        if requests is not None:
+            left.append('{} requests'.format(requests))
+        if parts is not None:
+            left.append('{} parts'.format(parts))
+        if left:
+            distributor_class.logger.info('{} budget left for today: {}'.format(api.name, ' and '.join(left)))
+
+    @staticmethod
+    def run_batches(func, batches, progress, *args):
+        ''' Calls `func(batch, *args)` for each batch of queries, concurrently when possible.
+            The progress is updated using the length of each batch.
+            Returns the list of results, in the same order used for `batches`. '''
+        workers = min(distributor_class.max_workers, len(batches))
+        if ThreadPoolExecutor is None or workers < 2:
+            results = []
+            for batch in batches:
+                results.append(func(batch, *args))
+                progress.update(len(batch))
+            return results
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(func, batch, *args) for batch in batches]
+            sizes = dict(zip(futures, [len(batch) for batch in batches]))
+            # The progress is updated from this thread, the GUI needs it
+            for future in as_completed(futures):
+                future.result()
+                progress.update(sizes[future])
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def cache_key(api, query, distributors, currency, *args):
+        ''' Creates the key used to store a query result in the cache.
+            `args` can be used to add API specific options that modifies the result. '''
+        return '|'.join([api, query, ','.join(sorted(distributors)), currency] + [str(a) for a in args])
+
+    @staticmethod
+    def cache_get(key):
+        ''' Looks for the result of a query in the cache.
+            Returns a tuple (found, result). '''
+        if distributor_class.cache is None:
+            return False, None
+        data = distributor_class.cache.get(key)
+        if data is None:
+            return False, None
+        return True, json.loads(data)
+
+    @staticmethod
+    def cache_put(key, result):
+        ''' Stores the result of a query in the cache. '''
+        if distributor_class.cache is not None:
+            distributor_class.cache.set(key, json.dumps(result))
+
     @staticmethod
     def _get_api(api):
         # We currently assume the API is registered
@@ -155,6 +447,18 @@ class distributor_class(object):
         # In the future some check could be added.
         distributor_class._get_api(api).set_options(**kwargs)
 
+    @staticmethod
+    def set_api_limits(api, rate=None, requests=None, parts=None):
+        ''' Limits the queries for an API (by name).
+            `rate` is the maximum number of requests per second.
+            `requests` and `parts` are the daily budget, for the key currently configured in the API. '''
+        api = distributor_class._get_api(api)
+        api.rate_limiter = TokenBucket(rate) if rate else None
+        if requests is not None or parts is not None:
+            api.budget = QueryBudget(api.name, requests, parts, key=getattr(api, 'API_KEY', None))
+        else:
+            api.budget = None
+
     @staticmethod
     def set_api_status(api, enabled):
         ''' Enable/Disable a particular API '''
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# MIT license
+#
+# Copyright (c) 2021 KiCost authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Limits for the API queries
+
+Used to avoid exceeding the quotas associated to the API keys.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+from ..cache import get_cache_path
+from ..global_vars import get_logger
+
+__all__ = ['TokenBucket', 'QueryBudget']
+
+
+class TokenBucket(object):
+    '''@brief Limits the rate of the queries.
+
+       Each query takes a token, the tokens are refilled at `rate` tokens per second.
+       Up to `burst` tokens can be accumulated. Can be shared by more than one thread.
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        ''' Waits until a token is available and takes it '''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QueryBudget(object):
+    '''@brief Daily budget of requests and parts for an API key.
+
+       The usage is stored on disk, so it accumulates for all the runs done the same day (UTC).
+       Each key has its own file, named using a hash of the key (the key itself isn't stored).
+       `None` means no limit.
+    '''
+    def __init__(self, name, requests=None, parts=None, path=None, key=None):
+        self.name = name
+        self.max_requests = requests
+        self.max_parts = parts
+        base_name = name.lower()
+        if key:
+            base_name += '_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        self.file_name = os.path.join(path or get_cache_path(), base_name + '_budget.json')
+        self.lock = threading.Lock()
+        self.date = None
+        self.requests = self.parts = 0
+
+    def _load(self):
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        if self.date == today:
+            return
+        self.date = today
+        self.requests = self.parts = 0
+        try:
+            with open(self.file_name, 'rt') as f:
+                data = json.load(f)
+            if data.get('date') == today:
+                self.requests = data.get('requests', 0)
+                self.parts = data.get('parts', 0)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _save(self):
+        try:
+            dir_name = os.path.dirname(self.file_name)
+            if not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+            with open(self.file_name, 'wt') as f:
+                json.dump({'date': self.date, 'requests': self.requests, 'parts': self.parts}, f)
+        except (IOError, OSError) as e:
+            get_logger().warning('Unable to save the {} budget to `{}` ({})'.format(self.name, self.file_name, e))
+
+    def remaining(self):
+        ''' Returns the requests and parts left for today, `None` for the unlimited ones '''
+        with self.lock:
+            self._load()
+            return (None if self.max_requests is None else max(self.max_requests - self.requests, 0),
+                    None if self.max_parts is None else max(self.max_parts - self.parts, 0))
+
+    def reserve(self, sizes):
+        ''' Reserves the budget for a list of requests, `sizes` is the number of parts for each request.
+            Returns how many requests (from the start of the list) fit in the budget. '''
+        with self.lock:
+            self._load()
+            fit = 0
+            for size in sizes:
+                if ((self.max_requests is not None and self.requests + 1 > self.max_requests) or
+                   (self.max_parts is not None and self.parts + size > self.max_parts)):
+                    break
+                self.requests += 1
+                self.parts += size
+                fit += 1
+            if fit:
+                self._save()
+            return fit
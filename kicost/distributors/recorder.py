@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# MIT license
+#
+# Copyright (c) 2021 KiCost authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+HTTP recorder
+
+Stores the responses to the distributors queries, so they can be replayed later without using the network.
+"""
+import os
+import json
+import hashlib
+import threading
+import requests
+from ..global_vars import DEBUG_OVERVIEW, ERR_SCRAPE, KiCostError, get_logger
+import sys
+if sys.version_info[0] < 3:
+    from urllib import urlencode
+else:
+    from urllib.parse import urlencode
+
+__all__ = ['HttpRecorder']
+
+INDEX_FILE = 'index.json'
+# Query parameters that are never stored, they are also excluded from the hash so the recordings work for any user
+SECRET_PARAMS = ('apikey',)
+
+
+class HttpRecorder(object):
+    '''@brief Content addressed store of request -> response pairs.
+
+       Each response is stored in `<dir>/<hash[:2]>/<hash>.json`, where `hash` is computed from the request.
+       The `index.json` file lists the stored requests.
+       In `replay` mode the responses are taken from the store and the requests that aren't there are errors.
+    '''
+    def __init__(self, path, replay=False):
+        self.path = path
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.count = 0
+        self.index = {}
+        index_name = os.path.join(path, INDEX_FILE)
+        if replay:
+            if not os.path.isfile(index_name):
+                raise KiCostError('No recorded queries found at `{}`'.format(path), ERR_SCRAPE)
+        elif os.path.isfile(index_name):
+            # Add to the previous recordings
+            with open(index_name, 'rt') as f:
+                self.index = json.load(f)
+
+    @staticmethod
+    def remove_secrets(url, data=None):
+        ''' Removes the `SECRET_PARAMS` (i.e. API keys) from the URL and the data of a request '''
+        def clean(query):
+            return '&'.join(p for p in query.split('&') if p.split('=')[0].lower() not in SECRET_PARAMS)
+        if '?' in url:
+            base, query = url.split('?', 1)
+            url = base + '?' + clean(query)
+        if isinstance(data, dict):
+            data = urlencode([(k, v) for k, v in data.items() if k.lower() not in SECRET_PARAMS])
+        elif data:
+            data = clean(data)
+        return url, data
+
+    @staticmethod
+    def request_key(method, url, data=None):
+        ''' Hash used to identify a request '''
+        url, data = HttpRecorder.remove_secrets(url, data)
+        content = method + ' ' + url + '\n' + (data or '')
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _file_name(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, method, url, data=None):
+        ''' Returns the recorded response for the request '''
+        key = self.request_key(method, url, data)
+        try:
+            with open(self._file_name(key), 'rt') as f:
+                stored = json.load(f)
+        except (IOError, OSError, ValueError):
+            raise KiCostError('No recorded response for the `{}` query to `{}`'.format(method, self.remove_secrets(url)[0]), ERR_SCRAPE)
+        response = requests.models.Response()
+        response.status_code = stored['status']
+        response.headers.update(stored['headers'])
+        response.encoding = 'utf-8'
+        response._content = stored['text'].encode('utf-8')
+        response.url = url
+        with self.lock:
+            self.count += 1
+        return response
+
+    def put(self, method, url, data, response):
+        ''' Stores the response for the request '''
+        key = self.request_key(method, url, data)
+        file_name = self._file_name(key)
+        dir_name = os.path.dirname(file_name)
+        url = self.remove_secrets(url)[0]
+        stored = {'method': method, 'url': url, 'status': response.status_code,
+                  'headers': {k: v for k, v in response.headers.items() if k.lower() == 'content-type'},
+                  'text': response.text}
+        with self.lock:
+            if not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+            with open(file_name, 'wt') as f:
+                json.dump(stored, f)
+            self.index[key] = method + ' ' + url.split('?')[0]
+            self.count += 1
+
+    def flush(self):
+        ''' Updates the index and reports the activity '''
+        with self.lock:
+            get_logger().log(DEBUG_OVERVIEW, 'HTTP recorder: {} responses {}'.format(self.count, 'replayed' if self.replay else 'recorded'))
+            self.count = 0
+            if self.replay:
+                return
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(os.path.join(self.path, INDEX_FILE), 'wt') as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
@@ -24,10 +24,23 @@
 import os
 import re
 from collections import OrderedDict
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
 from ..global_vars import logger, DEBUG_OVERVIEW, SEPRTR, DEBUG_OBSESSIVE, W_FLDOVR
 from ..distributors import get_distributors_iter
 
-__all__ = ['eda_class', 'field_name_translations']
+__all__ = ['eda_class', 'field_name_translations', 'FieldsOverlay']
+
+# Amount of data, from the beginning and the end of the file, used to detect the file format.
+FILE_HEAD_SIZE = 65536
+FILE_TAIL_SIZE = 4096
+# Memorized variant filters and lists of variants, all are forgotten when full
+variant_filters = {}
+variants_lists = {}
+VARIANT_CACHE_SIZE = 1024
 
 
 # Generate a dictionary to translate all the different ways people might want
@@ -97,6 +110,76 @@ for stub in ['part#', '#', 'p#', 'pn', 'vendor#', 'vp#', 'vpn', 'num']:
         field_name_translations[dist + '-' + stub] = dist + '#'
 
 
+class FieldsOverlay(MutableMapping):
+    '''@brief Fields of a part defined as changes over fields shared with other parts.
+
+       The shared fields (i.e. the ones from the library) are never modified, the values written go to this part only.
+       The order of the fields is the one an `OrderedDict` copy of the shared fields would have after the same changes.
+       Removing a shared field makes a private copy of them.
+    '''
+    __slots__ = ('base', 'own')
+    EMPTY = OrderedDict()
+
+    def __init__(self, base=None, fields=None):
+        self.base = self.EMPTY if base is None else base
+        self.own = OrderedDict()
+        if fields is not None:
+            self.own.update(fields)
+
+    def __getitem__(self, key):
+        try:
+            return self.own[key]
+        except KeyError:
+            return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.own[key] = value
+
+    def __delitem__(self, key):
+        if key in self.base:
+            self.materialize()
+        del self.own[key]
+
+    def __contains__(self, key):
+        return key in self.own or key in self.base
+
+    def __iter__(self):
+        own = self.own
+        base = self.base
+        for key in base:
+            yield key
+        for key in own:
+            if key not in base:
+                yield key
+
+    def __len__(self):
+        return len(self.base) + sum(1 for key in self.own if key not in self.base)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, list(self.items()))
+
+    def get(self, key, default=None):
+        try:
+            return self.own[key]
+        except KeyError:
+            return self.base.get(key, default)
+
+    def materialize(self):
+        ''' Makes a private copy of the shared fields '''
+        if self.base is not self.EMPTY:
+            own = OrderedDict(self.items())
+            self.base = self.EMPTY
+            self.own = own
+
+    def copy(self):
+        ''' Another part using the same shared fields and the same changes '''
+        return FieldsOverlay(self.base, self.own)
+
+    def __reduce__(self):
+        # Used to pass the parts between processes, the default protocol doesn't support `__slots__`
+        return (FieldsOverlay, (self.base, self.own))
+
+
 class eda_class(object):
     registered = {}
     logger = None
@@ -120,96 +203,12 @@ class eda_class(object):
         parts = eda_class.process_fields(parts, variant, ignore_fields, distributors)
         return eda_class.remove_dnp_parts(parts, variant), prj_info
 
-    @staticmethod
-    def process_kicost_field(f, v, new_fields, ignore_fields, distributors, name_ori, ref):
-        f = f.strip()
-        if SEPRTR in f:
-            # DISTRIBUTOR:FIELD
-            # Separate the distributor from the field name
-            idx = f.index(SEPRTR)
-            dist = f[:idx]
-            # Is this a supported distributor?
-            dist_l = dist.lower()
-            if dist_l in distributors:
-                # Use the lower case version
-                dist = dist_l
-            # Translate the field name
-            f = f[idx+1:].lower()
-            if f in ignore_fields:
-                return
-            f = field_name_translations.get(f, f)
-            if f in ignore_fields:
-                return
-            # Join both again
-            f = dist + SEPRTR + f
-        else:
-            # FIELD
-            # No distributor in the name
-            # Adapt it
-            f = f.lower()
-            if f in ignore_fields:
-                return
-            f = field_name_translations.get(f, f)
-            if f in ignore_fields:
-                return
-            # Is distributor related?
-            if f in ('cat#', 'pricing', 'link'):
-                # Add it to the default local distributor
-                logger.log(DEBUG_OBSESSIVE, 'Assigning name "{}" to "Local" distributor'.format(f))
-                f = 'Local:' + f
-        # Note: here we allow a field to "clear" another definition (assigning an empty value)
-        # This is because we assume that "kicost*" fields are defined on purpose, not just inherited from the library
-        new_fields[f] = v.strip()
-        logger.log(DEBUG_OBSESSIVE, '{} Field {} -> {}={}'.format(ref, name_ori, f, v))
-
     @staticmethod
     def process_fields(parts, variant, ignore_fields, distributors):
+        normalizer = FieldNormalizer(variant, ignore_fields, distributors)
         new_parts = OrderedDict()
         for ref, fields in parts.items():
-            new_fields = OrderedDict()
-            # Add the fields from lowest to highest priority.
-            # We even add empty fields, so we can "clear" a field using a higher priority mechanism.
-            # 1) All fields without SEPRTR (lowest priority)
-            for f, v in fields.items():
-                old_name = f
-                if SEPRTR in f:
-                    continue
-                # Just translate it
-                f = f.lower().strip()
-                if f in ignore_fields:
-                    continue
-                f = field_name_translations.get(f, f)
-                if f in ignore_fields:
-                    continue
-                # Trim extra spaces in the value
-                v = v.strip()
-                already_defined = f in new_fields
-                if not v and already_defined:
-                    # For regular fields we avoid one alias clearing another.
-                    # Example: if manf# was defined as XXX and now we have mnp='' we avoid getting manf#=''
-                    continue
-                if already_defined and new_fields[f]:
-                    logger.warning(W_FLDOVR+'Warning: in {} overwriting {}={} with {}={}'.format(ref, f, new_fields[f], old_name, v))
-                new_fields[f] = v
-            # 2) kicost:FIELD
-            for f, v in fields.items():
-                if f.startswith('kicost' + SEPRTR):
-                    eda_class.process_kicost_field(f[7:], v, new_fields, ignore_fields, distributors, f, ref)
-            # 3) kicost.VARIANT:  (highest priority)
-            for f, v in fields.items():
-                if not (SEPRTR in f and f.startswith('kicost.')):
-                    continue
-                sep_pos = f.index(SEPRTR)
-                var = f[7:sep_pos]
-                if not re.match(variant, var, flags=re.IGNORECASE):
-                    # Not for the current variant
-                    continue
-                name = f[sep_pos+1:]
-                logger.log(DEBUG_OBSESSIVE, 'Matched Variant ... ' + var + '.' + name)
-                eda_class.process_kicost_field(name, v, new_fields, ignore_fields, distributors, f, ref)
-            # TODO: What about the other cases?
-            # * Has ':' but doesn't start with "kicost"
-            new_parts[ref] = new_fields
+            new_parts[ref] = normalizer.process(ref, fields)
         return new_parts
 
     @staticmethod
@@ -217,17 +216,20 @@ class eda_class(object):
         '''@brief Verify with which EDA the file matches.
 
            Return the EDA name with the file matches or `None` if not founded.
+           Only the beginning and the end of the file are examined, so the time needed doesn't depend on the file size.
            @param file_name File `str` name.
            @return Name of the module corresponding to read the file or `None`to not recognized.
         '''
-        try:
-            file_handle = open(file_name, 'r')
-            content = file_handle.read()
-        except UnicodeDecodeError:  # Python 3 assumes UTF-8, try with Latin1 if it failed
-            file_handle.close()
-            file_handle = open(file_name, 'r', encoding='ISO-8859-1')
-            content = file_handle.read()
-        file_handle.close()
+        with open(file_name, 'rb') as file_handle:
+            content = file_handle.read(FILE_HEAD_SIZE)
+            file_handle.seek(0, os.SEEK_END)
+            size = file_handle.tell()
+            if size > FILE_HEAD_SIZE:
+                # Add the end of the file
+                file_handle.seek(max(size - FILE_TAIL_SIZE, FILE_HEAD_SIZE))
+                content += b'\n' + file_handle.read()
+        # Truncated multi-byte characters are replaced, they aren't relevant to detect the format
+        content = content.decode('utf-8', 'replace')
         extension = os.path.splitext(file_name)[1]
         for name, cls in eda_class.registered.items():
             if cls.file_eda_match(content, extension):
@@ -246,35 +248,195 @@ class eda_class(object):
            @return `list()` of `dict()`.
         '''
         logger.log(DEBUG_OVERVIEW, '# Removing do not populate parts...')
-        accepted_components = OrderedDict()
-        for ref, fields in components.items():
-            # Remove DNPs.
-            dnp = fields.get('dnp', '0')
+        accepts = get_variant_filter(variant).accepts
+        return OrderedDict((ref, fields) for ref, fields in components.items() if accepts(fields))
+
+
+class VariantFilter(object):
+    '''@brief Decides which parts are used for a variant.
+
+       The variant regex is compiled only once and the decisions for each value of the `dnp` and `variant` fields are memorized.
+    '''
+    def __init__(self, variant):
+        self.regex = re.compile(variant, flags=re.IGNORECASE)
+        self.variants = {}
+        self.dnps = {}
+
+    def match_variant(self, name):
+        ''' True if the variant `name` is the current variant '''
+        return self.regex.match(name) is not None
+
+    def is_dnp(self, dnp):
+        ''' True if the value of the `dnp` field means "do not populate" '''
+        res = self.dnps.get(dnp)
+        if res is None:
+            if len(self.dnps) >= VARIANT_CACHE_SIZE:
+                self.dnps.clear()
             # Interpret empty strings as 0. See #471 discussion.
-            if dnp == '':
-                dnp = '0'
             try:
-                dnp = float(dnp)
+                res = self.dnps[dnp] = bool(float(dnp or '0'))
             except ValueError:
                 # The field value must have been a string.
                 # The docs says "any string" is DNP enabled.
-                dnp = 1
-            if dnp:
+                res = self.dnps[dnp] = True
+        return res
+
+    def match_variants(self, variants):
+        ''' True if any of the variants in the `variant` field is the current variant '''
+        res = self.variants.get(variants)
+        if res is None:
+            if len(self.variants) >= VARIANT_CACHE_SIZE:
+                self.variants.clear()
+            # A part can be assigned to multiple variants. The part will not
+            # be removed if any of its variants match the current variant.
+            res = self.variants[variants] = any(self.match_variant(v) for v in split_variants(variants))
+        return res
+
+    def accepts(self, fields):
+        ''' True if the part with these `fields` is used for the current variant '''
+        # Remove DNPs.
+        if self.is_dnp(fields.get('dnp', '0')):
+            return False
+        # Get part variant. Prioritize local variants over global ones.
+        variants = fields.get('variant', None)
+        # Remove parts that are not assigned to the current variant.
+        # If a part is not assigned to any variant, then it is never removed.
+        return not variants or self.match_variants(variants)
+
+
+def split_variants(variants):
+    ''' List of variants in the `variant` field, shared by all the filters '''
+    res = variants_lists.get(variants)
+    if res is None:
+        if len(variants_lists) >= VARIANT_CACHE_SIZE:
+            variants_lists.clear()
+        res = variants_lists[variants] = re.split('[,;/ ]', variants)
+    return res
+
+
+def get_variant_filter(variant):
+    ''' Filter for the `variant` regex, created once and reused for all the BoMs using the same variant '''
+    res = variant_filters.get(variant)
+    if res is None:
+        if len(variant_filters) >= VARIANT_CACHE_SIZE:
+            variant_filters.clear()
+        res = variant_filters[variant] = VariantFilter(variant)
+    return res
+
+
+# Kind of fields, from lowest to highest priority
+FIELD_REGULAR = 1
+FIELD_KICOST = 2
+FIELD_VARIANT = 3
+
+
+class FieldNormalizer(object):
+    '''@brief Translates the fields of the parts for one BoM.
+
+       The names of the fields repeat for all the parts, so the translation for each name is computed only once.
+    '''
+    def __init__(self, variant, ignore_fields, distributors):
+        self.variant = get_variant_filter(variant)
+        self.ignore_fields = set(ignore_fields)
+        self.distributors = distributors
+        self.names = {}
+
+    def translate(self, f):
+        ''' Translated name for a field, `None` if ignored '''
+        if f in self.ignore_fields:
+            return None
+        f = field_name_translations.get(f, f)
+        if f in self.ignore_fields:
+            return None
+        return f
+
+    def kicost_name(self, f):
+        ''' Translated name for a field defined using `kicost:FIELD` or `kicost.VARIANT:FIELD` '''
+        f = f.strip()
+        if SEPRTR in f:
+            # DISTRIBUTOR:FIELD
+            # Separate the distributor from the field name
+            idx = f.index(SEPRTR)
+            dist = f[:idx]
+            # Is this a supported distributor?
+            dist_l = dist.lower()
+            if dist_l in self.distributors:
+                # Use the lower case version
+                dist = dist_l
+            # Translate the field name
+            f = self.translate(f[idx+1:].lower())
+            if f is None:
+                return None
+            # Join both again
+            return dist + SEPRTR + f
+        # FIELD
+        # No distributor in the name
+        # Adapt it
+        f = self.translate(f.lower())
+        # Is distributor related?
+        if f in ('cat#', 'pricing', 'link'):
+            # Add it to the default local distributor
+            logger.log(DEBUG_OBSESSIVE, 'Assigning name "{}" to "Local" distributor'.format(f))
+            f = 'Local:' + f
+        return f
+
+    def classify(self, f):
+        ''' Returns the kind and the translated name for a field. The kind is `None` for the ignored fields '''
+        if SEPRTR not in f:
+            # Just translate it
+            new_name = self.translate(f.lower().strip())
+            return (None if new_name is None else FIELD_REGULAR, new_name)
+        if f.startswith('kicost' + SEPRTR):
+            new_name = self.kicost_name(f[7:])
+            return (None if new_name is None else FIELD_KICOST, new_name)
+        if f.startswith('kicost.'):
+            sep_pos = f.index(SEPRTR)
+            var = f[7:sep_pos]
+            if not self.variant.match_variant(var):
+                # Not for the current variant
+                return (None, None)
+            name = f[sep_pos+1:]
+            logger.log(DEBUG_OBSESSIVE, 'Matched Variant ... ' + var + '.' + name)
+            new_name = self.kicost_name(name)
+            return (None if new_name is None else FIELD_VARIANT, new_name)
+        # TODO: What about the other cases?
+        # * Has ':' but doesn't start with "kicost"
+        return (None, None)
+
+    def process(self, ref, fields):
+        ''' Translates the fields of one part '''
+        names = self.names
+        new_fields = OrderedDict()
+        kicost_fields = []
+        # Add the fields from lowest to highest priority.
+        # We even add empty fields, so we can "clear" a field using a higher priority mechanism.
+        # 1) All fields without SEPRTR (lowest priority)
+        for f, v in fields.items():
+            kind_name = names.get(f)
+            if kind_name is None:
+                kind_name = names[f] = self.classify(f)
+            kind, name = kind_name
+            if kind is None:
                 continue
-            # Get part variant. Prioritize local variants over global ones.
-            variants = fields.get('variant', None)
-            # Remove parts that are not assigned to the current variant.
-            # If a part is not assigned to any variant, then it is never removed.
-            if variants:
-                # A part can be assigned to multiple variants. The part will not
-                # be removed if any of its variants match the current variant.
-                # Split the variants apart and abort the loop if any of them match.
-                for v in re.split('[,;/ ]', variants):
-                    if re.match(variant, v, flags=re.IGNORECASE):
-                        break
-                else:
-                    # None of the variants matched, so skip/remove this part.
-                    continue
-            # The part was not removed, so add it to the list of accepted components.
-            accepted_components[ref] = fields
-        return accepted_components
+            if kind != FIELD_REGULAR:
+                kicost_fields.append((kind, name, f, v))
+                continue
+            # Trim extra spaces in the value
+            v = v.strip()
+            already_defined = name in new_fields
+            if not v and already_defined:
+                # For regular fields we avoid one alias clearing another.
+                # Example: if manf# was defined as XXX and now we have mnp='' we avoid getting manf#=''
+                continue
+            if already_defined and new_fields[name]:
+                logger.warning(W_FLDOVR+'Warning: in {} overwriting {}={} with {}={}'.format(ref, name, new_fields[name], f, v))
+            new_fields[name] = v
+        # 2) kicost:FIELD
+        # 3) kicost.VARIANT:  (highest priority)
+        # Note: here we allow a field to "clear" another definition (assigning an empty value)
+        # This is because we assume that "kicost*" fields are defined on purpose, not just inherited from the library
+        kicost_fields.sort(key=lambda x: x[0])
+        for _, name, f, v in kicost_fields:
+            new_fields[name] = v.strip()
+            logger.log(DEBUG_OBSESSIVE, '{} Field {} -> {}={}'.format(ref, f, name, v))
+        return new_fields
@@ -33,7 +33,7 @@ import sys
 import os
 import copy  # Necessary because Py2 doesn't have copy in list.
 from datetime import datetime
-from bs4 import BeautifulSoup  # To Read XML files.
+from lxml import etree  # To Read XML files.
 import re  # Regular expression parser.
 from ..global_vars import DEBUG_OVERVIEW, ERR_INPUTFILE, KiCostError  # Debug configurations.
 from .tools import field_name_translations, PART_REF_REGEX_NOT_ALLOWED
@@ -41,7 +41,9 @@ from .eda import eda_class
 
 ALTIUM_NONE = '[NoParam]'  # Value of Altium to `None`.
 ALTIUM_PART_SEPRTR = r'(?<!\\),\s*'  # Separator for the part numbers in a list, remove the lateral spaces.
-FILE_REGEX = r'\<GRID[\s\S]+<COLUMNS>[\s\S]+<COLUMN[\s\S]+<\/COLUMNS>[\s\S]+<ROWS>[\s\S]+\<ROW[\s\S]+\<\/ROWS>[\s\S]+\<\/GRID>'
+ALTIUM_PART_SEPRTR_RE = re.compile(ALTIUM_PART_SEPRTR)
+# Tags that must be found, in this order, in an Altium BoM.
+FILE_TAGS = ['<grid', '<columns>', '<column', '</columns>', '<rows>', '<row', '</rows>', '</grid>']
 
 __all__ = ['eda_altium']
 
@@ -57,64 +59,97 @@ def extract_field(xml_entry, field_name):
         return None
 
 
-def extract_fields_row(row, header):
-    '''Extract XML fields from the part in a library or schematic.'''
+class AltiumHeader(object):
+    '''@brief Information from the table header, computed once for all the rows.'''
+    def __init__(self, header):
+        self.header = header
+        header_translated = [field_name_translations.get(hdr.lower(), hdr.lower()) for hdr in header]
+        # The references and the quantities of elements in each row group.
+        hdr_refs = [i for i, x in enumerate(header_translated) if x == "refs"]
+        self.refs = header[hdr_refs[0]].lower() if hdr_refs else None
+        hdr_qty = [i for i, x in enumerate(header_translated) if x == "qty"]
+        self.qty = header[hdr_qty[0]].lower() if hdr_qty else None
+        # The rest of the fields: (attribute, field name)
+        header_valid = copy.copy(header)
+        if hdr_refs:
+            header_valid.remove(header[hdr_refs[0]])
+        self.fields_qty = [(hdr.lower(), field_name_translations.get(hdr.lower(), hdr.lower())) for hdr in header_valid]
+        # The quantity is removed when it is a valid number
+        if hdr_qty:
+            header_valid.remove(header[hdr_qty[0]])
+        self.fields = [(hdr.lower(), field_name_translations.get(hdr.lower(), hdr.lower())) for hdr in header_valid]
+
 
-    # First get the references and the quantities of elements in each row group.
-    header_translated = [field_name_translations.get(hdr.lower(), hdr.lower()) for hdr in header]
-    hdr_refs = [i for i, x in enumerate(header_translated) if x == "refs"]
-    if not hdr_refs:
+def extract_fields_row(row, header):
+    '''Extract XML fields from the part in a library or schematic.
+       `row` is a dict with the attributes (lower case names) and `header` an AltiumHeader.'''
+    if header.refs is None:
         raise KiCostError('No part designators/references found in the BOM.\nTry to generate the file again with Altium.', ERR_INPUTFILE)
-    else:
-        hdr_refs = hdr_refs[0]
-    refs = re.split(ALTIUM_PART_SEPRTR, extract_field(row, header[hdr_refs].lower()))
-    header_valid = copy.copy(header)
-    header_valid.remove(header[hdr_refs])
-    try:
-        hdr_qty = [i for i, x in enumerate(header_translated) if x == "qty"][0]
-        qty = int(extract_field(row, header[hdr_qty].lower()))
-        header_valid.remove(header[hdr_qty])
-        if qty != len(refs):
-            raise KiCostError('Not recognize the division elements in the Altium BOM.\nIf you are using subparts, try to replace the separator from `, `'
-                              ' to `,` or better, use `;` instead `,`.', ERR_INPUTFILE)
-    except Exception:
-        qty = len(refs)
+    refs = ALTIUM_PART_SEPRTR_RE.split(extract_field(row, header.refs))
+    qty = len(refs)
+    header_valid = header.fields_qty
+    if header.qty is not None:
+        try:
+            int(extract_field(row, header.qty))
+            header_valid = header.fields
+        except (ValueError, TypeError):
+            pass
 
     # After the others fields.
     fields = [dict() for x in range(qty)]
-    for hdr in header_valid:
+    for attr, name in header_valid:
         # Extract each information, by the the header given, for each row part, spliting it in a list.
-        value = extract_field(row, hdr.lower())
-        value = re.split(ALTIUM_PART_SEPRTR, value)
+        value = ALTIUM_PART_SEPRTR_RE.split(extract_field(row, attr))
         for i in range(qty):
             if len(value) == qty:
                 v = value[i]
             else:
                 v = value[0]  # Footprint is just one for group.
-            fields[i][field_name_translations.get(hdr.lower(), hdr.lower())] = v
+            fields[i][name] = v
     return refs, fields
 
 
+def release(element):
+    ''' Frees the memory used by an already processed element. '''
+    element.clear()
+    # Also remove the references from the parent to the previous elements
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def get_rows(in_file):
+    '''Generator for the rows of the table, the file is parsed incrementally.
+       Yields the table header (AltiumHeader) and a dict with the row attributes (lower case names).'''
+    header = []
+    header_info = None
+    try:
+        for _, el in etree.iterparse(in_file, events=('end',), remove_comments=True, recover=True):
+            tag = el.tag.lower()
+            if tag == 'row':
+                if header_info is None:
+                    header_info = AltiumHeader(header)
+                yield header_info, {k.lower(): v for k, v in el.attrib.items()}
+                release(el)
+            elif tag == 'column':
+                # Get the header of the XML file of Altium, so KiCost is able to to
+                # to get all the informations in the file.
+                header.append(extract_field({k.lower(): v for k, v in el.attrib.items()}, 'name'))
+    except etree.XMLSyntaxError as e:
+        raise KiCostError('Malformed Altium XML file `{}` ({})'.format(in_file, e), ERR_INPUTFILE)
+
+
 def get_part_groups(in_file):
     '''@brief Get groups of identical parts from an XML file and return them as a dictionary.
        @param in_file `str()` with the file name.
        @return `dict()` of the parts designed. The keys are the componentes references.
     '''
-    # Read-in the schematic XML file to get a tree and get its root.
     eda_class.logger.log(DEBUG_OVERVIEW, '# Getting from XML \'{}\' Altium BoM...'.format(
                                     os.path.basename(in_file)))
-    file_h = open(in_file)
-    root = BeautifulSoup(file_h, 'lxml')
-    file_h.close()
-
-    # Get the header of the XML file of Altium, so KiCost is able to to
-    # to get all the informations in the file.
-    eda_class.logger.log(DEBUG_OVERVIEW, 'Getting the XML table header...')
-    header = [extract_field(entry, 'name') for entry in root.find('columns').find_all('column')]
-
     eda_class.logger.log(DEBUG_OVERVIEW, 'Getting components...')
     accepted_components = {}
-    for row in root.find('rows').find_all('row'):
+    for header, row in get_rows(in_file):
 
         # Get the values for the fields in each library part (if any).
         refs, fields = extract_fields_row(row, header)
@@ -149,7 +184,16 @@ class eda_altium(eda_class):
     @staticmethod
     def file_eda_match(content, extension):
         ''' Returns True if this EDA can handle this file. '''
-        return extension == '.xml' and re.search(FILE_REGEX, content, re.IGNORECASE)
+        if extension != '.xml':
+            return False
+        content = content.lower()
+        pos = 0
+        for tag in FILE_TAGS:
+            pos = content.find(tag, pos)
+            if pos < 0:
+                return False
+            pos += len(tag)
+        return True
 
 
 eda_class.register(eda_altium)
@@ -26,10 +26,11 @@
 import os
 from datetime import datetime
 import re
-from bs4 import BeautifulSoup
+from lxml import etree
 from collections import OrderedDict
-from ..global_vars import DEBUG_OVERVIEW, SEPRTR
-from .eda import eda_class
+from ..global_vars import DEBUG_OVERVIEW, SEPRTR, ERR_INPUTFILE, KiCostError
+from .eda import eda_class, FieldsOverlay
+from . import kicad_sch
 
 
 __all__ = ['eda_kicad']
@@ -40,111 +41,124 @@ def extract_fields(part):
     # Here the order of the dict is important
     # The fields from the library must be easily redefined by the component
     fields = OrderedDict()
-    try:
-        for f in part.find('fields').find_all('field'):
-            name = str(f['name'])
-            if name == 'Reference':
-                # Excluded to avoid problems to group parts of differents sheets ISSUE #97.
-                continue
-            # Store the name and value for each kicost-related field.
-            # Remove case of field name along with leading/trailing whitespace.
-            # Note: str() is needed to avoid Python 2.7 then printing it as u'xxx'
-            fields[name] = str(f.string) if f.string is not None else ''
-    except AttributeError:
-        pass  # No fields found for this part.
+    fields_el = part.find('fields')
+    if fields_el is None:
+        return fields  # No fields found for this part.
+    for f in fields_el.iter('field'):
+        name = str(f.get('name'))
+        if name == 'Reference':
+            # Excluded to avoid problems to group parts of differents sheets ISSUE #97.
+            continue
+        # Store the name and value for each kicost-related field.
+        # Remove case of field name along with leading/trailing whitespace.
+        # Note: str() is needed to avoid Python 2.7 then printing it as u'xxx'
+        fields[name] = str(f.text) if f.text is not None else ''
     return fields
 
 
-def title_find_all(data, field):
-    ''' Helper function for finding title info, especially if it is absent. '''
-    try:
-        return data.find_all(field)[0].string
-    except (AttributeError, IndexError):
+def element_text(element):
+    ''' Text of an element, `None` if the element is missing or empty. '''
+    if element is None or not element.text:
         return None
+    return element.text
+
+
+def release(element):
+    ''' Frees the memory used by an already processed element. '''
+    element.clear()
+    # Also remove the references from the parent to the previous elements
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
 
 
 def get_part_groups(in_file):
     '''Get groups of identical parts from an XML file and return them as a dictionary.
+       The file is parsed incrementally, each element is released after using it.
        @param in_file `str()` with the file name.
        @return `dict()` of the parts designed. The keys are the componentes references.
     '''
-    # Read-in the schematic XML file to get a tree and get its root.
     eda_class.logger.log(DEBUG_OVERVIEW, '# Getting from XML \'{}\' KiCad BoM...'.format(
                                     os.path.basename(in_file)))
-    file_h = open(in_file)
-    root = BeautifulSoup(file_h, 'lxml')
-    file_h.close()
-
-    # Get the general information of the project BoM XML file.
-    eda_class.logger.log(DEBUG_OVERVIEW, 'Getting authorship data...')
-    title = root.find('title_block')
-
-    prj_info = dict()
-    prj_info['title'] = title_find_all(title, 'title') or os.path.basename(in_file)
-    prj_info['company'] = title_find_all(title, 'company')
-    prj_info['date'] = title_find_all(root, 'date') or (datetime.fromtimestamp(os.path.getmtime(in_file)).strftime("%Y-%m-%d %H:%M:%S") + ' (file)')
-
+    title = company = date = None
+    title_found = date_found = False
     # Make a dictionary from the fields in the parts library so these field
     # values can be instantiated into the individual components in the schematic.
-    eda_class.logger.log(DEBUG_OVERVIEW, 'Getting parts library...')
     libparts = {}
-    if root.find('libparts'):
-        for p in root.find('libparts').find_all('libpart'):
-
-            # Get the values for the fields in each library part (if any).
-            fields = extract_fields(p)
-
-            # Store the field dict under the key made from the
-            # concatenation of the library and part names.
-            libparts[str(p['lib']) + SEPRTR + str(p['part'])] = fields
-
-            # Also have to store the fields under any part aliases.
-            try:
-                for alias in p.find('aliases').find_all('alias'):
-                    libparts[str(p['lib']) + SEPRTR + str(alias.string)] = fields
-            except AttributeError:
-                pass  # No aliases for this part.
-
-    # Find the components used in the schematic and elaborate
-    # them with global values from the libraries and local values
-    # from the schematic.
-    eda_class.logger.log(DEBUG_OVERVIEW, 'Getting components...')
-    components = OrderedDict()
-    for c in root.find('components').find_all('comp'):
-
-        # Find the library used for this component.
-        libsource = c.find('libsource')
-        if libsource:
-            # Create the key to look up the part in the libparts dict.
-            # libpart = str(libsource['lib'] + SEPRTR + libsource['part'])
-            libpart = str(libsource['lib']) + SEPRTR + str(libsource['part'])
-        else:
-            libpart = '???'
-            eda_class.logger.log(DEBUG_OVERVIEW, 'Footprint library not assigned to {}'.format(''))  # TODO
+    # Data from the components, we need the libparts (found after the components) to complete it
+    comps = []
+    try:
+        for _, el in etree.iterparse(in_file, events=('end',), remove_comments=True, recover=True):
+            tag = el.tag
+            if tag == 'comp':
+                # Find the library used for this component.
+                libsource = el.find('libsource')
+                if libsource is not None:
+                    # Create the key to look up the part in the libparts dict.
+                    libpart = str(libsource.get('lib')) + SEPRTR + str(libsource.get('part'))
+                else:
+                    libpart = '???'
+                    eda_class.logger.log(DEBUG_OVERVIEW, 'Footprint library not assigned to {}'.format(''))  # TODO
+                # Get the footprint for the part (if any) from the schematic.
+                basic = OrderedDict()
+                for name in ('value', 'footprint', 'datasheet'):
+                    field = el.find(name)
+                    if field is None:
+                        break
+                    basic[name.capitalize()] = str(field.text)
+                # Get the values for any other kicost-related fields in the part (if any) from the schematic.
+                comps.append((str(el.get('ref')), libpart, basic, extract_fields(el)))
+                release(el)
+            elif tag == 'libpart':
+                # Get the values for the fields in each library part (if any).
+                fields = extract_fields(el)
+                # Store the field dict under the key made from the
+                # concatenation of the library and part names.
+                lib = str(el.get('lib'))
+                libparts[lib + SEPRTR + str(el.get('part'))] = fields
+                # Also have to store the fields under any part aliases.
+                aliases = el.find('aliases')
+                if aliases is not None:
+                    for alias in aliases.iter('alias'):
+                        libparts[lib + SEPRTR + str(alias.text)] = fields
+                release(el)
+            elif tag == 'net':
+                # Not used
+                release(el)
+            elif tag == 'date' and not date_found:
+                date_found = True
+                date = element_text(el)
+            elif tag == 'title_block' and not title_found:
+                # Get the general information of the project BoM XML file.
+                title_found = True
+                title = element_text(el.find('.//title'))
+                company = element_text(el.find('.//company'))
+    except etree.XMLSyntaxError as e:
+        raise KiCostError('Malformed KiCad XML file `{}` ({})'.format(in_file, e), ERR_INPUTFILE)
+
+    prj_info = dict()
+    prj_info['title'] = title or os.path.basename(in_file)
+    prj_info['company'] = company
+    prj_info['date'] = date or (datetime.fromtimestamp(os.path.getmtime(in_file)).strftime("%Y-%m-%d %H:%M:%S") + ' (file)')
 
+    # Elaborate the components with global values from the libraries and local values from the schematic.
+    components = OrderedDict()
+    lib_fields = {}
+    for ref, libpart, basic, comp_fields in comps:
         # Initialize the fields from the global values in the libparts dict entry.
-        # (These will get overwritten by any local values down below.)
+        # (These are shared by all the parts using it, the local values below only change this part.)
         # (Use an empty dict if no part exists in the library.)
-        fields = libparts.get(libpart, OrderedDict()).copy()  # Make a copy! Don't use reference!
-
-        # Store the part key and its value.
-        fields['libpart'] = libpart
-
-        # Get the footprint for the part (if any) from the schematic.
-        try:
-            fields['Value'] = str(c.find('value').string)
-            fields['Footprint'] = str(c.find('footprint').string)
-            fields['Datasheet'] = str(c.find('datasheet').string)
-        except AttributeError:
-            pass
-
-        # Get the values for any other kicost-related fields in the part
-        # (if any) from the schematic. These will override any field values
-        # from the part library.
-        fields.update(extract_fields(c))
-
+        base = lib_fields.get(libpart)
+        if base is None:
+            base = lib_fields[libpart] = libparts.get(libpart, OrderedDict()).copy()
+            # Store the part key and its value.
+            base['libpart'] = libpart
+        fields = FieldsOverlay(base, basic)
+        # The fields from the schematic override the ones from the part library.
+        fields.update(comp_fields)
         # Store the fields for the part using the reference identifier as the key.
-        components[str(c['ref'])] = fields
+        components[ref] = fields
 
     return components, prj_info
 
@@ -152,15 +166,20 @@ def get_part_groups(in_file):
 class eda_kicad(eda_class):
     name = 'kicad'
     label = 'KiCad file'  # Label used on the GUI.
-    desc = 'KiCad open source EDA.'
+    desc = 'KiCad open source EDA. XML netlists or KiCad 6+ schematics.'
 
     @staticmethod
     def get_part_groups(in_file, distributors):
+        if os.path.splitext(in_file)[1] == kicad_sch.SCH_EXTENSION:
+            # KiCad 6+ schematic
+            return kicad_sch.get_part_groups(in_file)
         return get_part_groups(in_file)
 
     @staticmethod
     def file_eda_match(content, extension):
         ''' Returns True if this EDA can handle this file. '''
+        if extension == kicad_sch.SCH_EXTENSION:
+            return content.lstrip().startswith('(kicad_sch')
         return extension == '.xml' and re.search(r'<tool\>Eeschema.*\<\/tool\>', content, re.IGNORECASE)
 
 
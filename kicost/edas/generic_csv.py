@@ -34,6 +34,7 @@ import sys
 import os
 from datetime import datetime
 from collections import OrderedDict
+from itertools import chain
 import csv  # CSV file reader.
 import re  # Regular expression parser.
 from ..global_vars import DEBUG_OVERVIEW, ERR_INPUTFILE, KiCostError, W_DUPWRONG
@@ -42,42 +43,61 @@ from .eda import eda_class
 
 
 GENERIC_PREFIX = 'GEN'  # Part reference prefix to use when no references are present.
+SNIFF_SIZE = 32768  # Amount of data (from the beginning of the file) used to guess the CSV dialect.
+TABS_RE = re.compile('\t+')
 
 __all__ = ['generic_csv']
 
 
-def correspondent_header_value(key, vals, header, header_file):
+class CSVHeader(object):
+    '''@brief Information from the CSV header, computed once for all the rows.'''
+    def __init__(self, header, header_file):
+        # `header` are the translated titles and `header_file` the ones found in the file.
+        self.header = header
+        self.header_file = header_file
+        self.refs = [header_file[i] for i, x in enumerate(header) if x == 'refs']
+        self.qty = [header_file[i] for i, x in enumerate(header) if x == 'qty']
+        self.fields = [(h_file, h) for (h_file, h) in zip(header_file, header) if h not in ('refs', 'qty')]
+
+
+def correspondent_header_value(key, vals, columns):
     # Get the correspondent first valid value of `vals` look from a key
-    # in `header`, but using `header_file` to access `vals`. Used to get
+    # in `columns`, the names used by `vals` for the column. Used to get
     # the designator reference `refs` and quantity `qty`.
-    idx = [i for i, x in enumerate(header) if x == key]
     value = None
-    for i in idx:
-        if len(idx) > 1 and value is not None and value != vals[header_file[i]]:
+    for col in columns:
+        if len(columns) > 1 and value is not None and value != vals[col]:
             eda_class.logger.warning(W_DUPWRONG+'Found different duplicated information for \'{}\': \'{}\'=!\'{}\'. Will be used the last.'.format(
-                key, value, vals[header_file[i]]))
-        value = vals[header_file[i]]
+                key, value, vals[col]))
+        value = vals[col]
         if value:
             break
     return value
 
 
-def extract_fields(row, header, header_file, dialect, gen_cntr):
+def row_values(row, header_file):
+    ''' Dict with the values of the row, using the titles from the file (as csv.DictReader does). '''
+    vals = dict(zip(header_file, row))
+    for key in header_file[len(row):]:
+        vals[key] = None
+    return vals
+
+
+def extract_fields(row, header, gen_cntr):
+    ''' Extracts the fields from a row. `row` is the list of values and `header` a CSVHeader. '''
     fields = {}
 
-    try:
-        vals = next(csv.DictReader([row.replace("'", '"')], fieldnames=header_file, delimiter=dialect.delimiter))
-    except Exception:
+    if not row:
         # If had a error when tried to read a line maybe a 'EmptyLine',
         # normally at the end of the file or after the header and before
         # the first part.
         raise KiCostError('Empty line in CSV?!', ERR_INPUTFILE)
+    vals = row_values(row, header.header_file)
 
-    if 'refs' in header:
-        ref_str = correspondent_header_value('refs', vals, header, header_file).strip()
-        qty = len(ref_str)
-    elif 'qty' in header:
-        qty = int(correspondent_header_value('qty', vals, header, header_file))
+    if header.refs:
+        ref_str = correspondent_header_value('refs', vals, header.refs).strip()
+    elif header.qty:
+        qty = int(correspondent_header_value('qty', vals, header.qty))
         if qty > 1:
             ref_str = GENERIC_PREFIX + '{0}-{1}'.format(gen_cntr, gen_cntr+qty-1)
         else:
@@ -92,26 +112,25 @@ def extract_fields(row, header, header_file, dialect, gen_cntr):
     refs = split_refs(ref_str)
 
     # Extract each value.
-    for (h_file, h) in zip(header_file, header):
-        if h not in ('refs', 'qty'):
-            if sys.version_info >= (3, 0):
-                # This is for Python 3 where the values are already unicode.
-                value = vals.get(h_file)
-            else:
-                # For Python 2, create unicode versions of strings.
-                value = vals.get(h_file, '').decode('utf-8')
-            try:
-                if value and fields[h] != value:
-                    eda_class.logger.warning(W_DUPWRONG+'Found different duplicated information for {} in '
-                                             'the titles [\'{}\', \'{}\']: \'{}\'=!\'{}\'. Will be used \'{}\'.'.
-                                             format(refs, h, h_file, fields[h], value, value))
-            except KeyError:
-                pass
-            finally:
-                # Use the translated header title, this is used to deal
-                # with duplicated information that could be found by
-                # translating header titles that are the same for KiCost.
-                fields[h] = value
+    for (h_file, h) in header.fields:
+        if sys.version_info >= (3, 0):
+            # This is for Python 3 where the values are already unicode.
+            value = vals.get(h_file)
+        else:
+            # For Python 2, create unicode versions of strings.
+            value = vals.get(h_file, '').decode('utf-8')
+        try:
+            if value and fields[h] != value:
+                eda_class.logger.warning(W_DUPWRONG+'Found different duplicated information for {} in '
+                                         'the titles [\'{}\', \'{}\']: \'{}\'=!\'{}\'. Will be used \'{}\'.'.
+                                         format(refs, h, h_file, fields[h], value, value))
+        except KeyError:
+            pass
+        finally:
+            # Use the translated header title, this is used to deal
+            # with duplicated information that could be found by
+            # translating header titles that are the same for KiCost.
+            fields[h] = value
     # Set some key with default values, needed for KiCost.
     # Have to be created after the loop above because of the
     # warning in the case of trying to re-write a key.
@@ -125,6 +144,26 @@ def extract_fields(row, header, header_file, dialect, gen_cntr):
     return refs, fields, gen_cntr
 
 
+def read_lines(in_file):
+    ''' Generator for the lines of the file, without the line terminator.
+        Multiple, consecutive tabs are collapsed. '''
+    encoding = None
+    read = 0
+    while True:
+        try:
+            with (open(in_file, 'r') if encoding is None else open(in_file, 'r', encoding=encoding)) as file_h:
+                for n, line in enumerate(file_h):
+                    # Skip the lines we already returned before changing the encoding
+                    if n >= read:
+                        read += 1
+                        yield TABS_RE.sub('\t', line.rstrip('\r\n'))
+            return
+        except UnicodeDecodeError:  # It happens with some Windows CSV files on Python 3.
+            if encoding is not None:
+                raise
+            encoding = 'ISO-8859-1'
+
+
 def get_part_groups(in_file, distributors):
     '''Get groups of identical parts from an generic CSV file and return them as a dictionary.
        @param in_file `str()` with the file name.
@@ -132,30 +171,29 @@ def get_part_groups(in_file, distributors):
     '''
     eda_class.logger.log(DEBUG_OVERVIEW, '# Getting from CSV \'{}\' BoM...'.format(
                                     os.path.basename(in_file)))
-    try:
-        file_h = open(in_file, 'r')
-        content = file_h.read()
-    except UnicodeDecodeError:  # It happens with some Windows CSV files on Python 3.
-        file_h.close()
-        file_h = open(in_file, 'r', encoding='ISO-8859-1')
-        content = file_h.read()
-    file_h.close()
-
-    # Collapse multiple, consecutive tabs.
-    content = re.sub('\t+', '\t', content)
+    lines = read_lines(in_file)
+    # Keep the first lines, used to determine the column delimiter.
+    sample = []
+    size = 0
+    for line in lines:
+        sample.append(line)
+        size += len(line) + 1
+        if size >= SNIFF_SIZE:
+            break
+    if not sample:
+        raise KiCostError('Empty CSV file `{}`'.format(in_file), ERR_INPUTFILE)
 
     # Determine the column delimiter used in the CSV file.
     try:
-        dialect = csv.Sniffer().sniff(content, [',', ';', '\t'])
+        dialect = csv.Sniffer().sniff('\n'.join(sample), [',', ';', '\t'])
     except csv.Error:
         # If the CSV file only has a single column of data, there may be no
         # delimiter so just set the delimiter to a comma.
         dialect = csv.Sniffer().sniff(',,,', [','])
 
     # The first line in the file must be the column header.
-    content = content.splitlines()
     eda_class.logger.log(DEBUG_OVERVIEW, 'Getting CSV header...')
-    header_file = next(csv.reader(content, delimiter=dialect.delimiter))
+    header_file = next(csv.reader(sample[:1], delimiter=dialect.delimiter))
     if len(set(header_file)) < len(header_file):
         eda_class.logger.warning(W_DUPWRONG+'There is a duplicated header title in the file. This could cause loss of information.')
 
@@ -168,9 +206,11 @@ def get_part_groups(in_file, distributors):
     # allowable field names, then assume the first line is data and not a header.
     field_names = list(field_name_translations.keys()) + list(field_name_translations.values())
     FIELDS_MANFCAT = ([d + '#' for d in distributors] + ['manf#'])
+    first_data = 1
     if not any([code in header for code in FIELDS_MANFCAT]):
-        if any(col_hdr.lower() in field_names for col_hdr in header):
-            content.pop(0)  # It was a header by the user not identify the 'manf#' / 'cat#' column.
+        if not any(col_hdr.lower() in field_names for col_hdr in header):
+            first_data = 0  # No header, the first line is data.
+        # else: It was a header by the user not identify the 'manf#' / 'cat#' column.
 
         # If a column header is not in the list of field names, then there is
         # no header in the file. Therefore, create a header based on number of columns.
@@ -187,22 +227,25 @@ def get_part_groups(in_file, distributors):
             header = ['manf#', 'refs']
         else:
             header = ['qty', 'manf#', 'refs']
-    else:
-        # OK, the first line is a header, so remove it from the data.
-        content.pop(0)  # Remove the header from the content.
+    # else: OK, the first line is a header, so skip it.
+    header = CSVHeader(header, header_file)
 
     # Make a dictionary from the fields in the parts library so these field
     # values can be instantiated into the individual components in the schematic.
     eda_class.logger.log(DEBUG_OVERVIEW, 'Getting parts...')
 
-    # Read the each line content.
+    # Read the each line content, all the rows are parsed by the same reader.
+    content = (line.replace("'", '"') for line in chain(sample[first_data:], lines))
     accepted_components = OrderedDict()
     gen_cntr = 0
-    for row in content:
-        # Get the values for the fields in each library part (if any).
-        refs, fields, gen_cntr = extract_fields(row, header, header_file, dialect, gen_cntr)
-        for ref in refs:
-            accepted_components[ref] = fields
+    try:
+        for row in csv.reader(content, delimiter=dialect.delimiter):
+            # Get the values for the fields in each library part (if any).
+            refs, fields, gen_cntr = extract_fields(row, header, gen_cntr)
+            for ref in refs:
+                accepted_components[ref] = fields
+    except csv.Error as e:
+        raise KiCostError('Malformed CSV file `{}` ({})'.format(in_file, e), ERR_INPUTFILE)
 
     # No project information in CSVs
     prj_info = {'title': os.path.basename(in_file),
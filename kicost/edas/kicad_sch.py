@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# MIT license
+#
+# Copyright (c) 2021 KiCost authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+KiCad 6+ schematic reader
+
+Reads the `.kicad_sch` files directly, no need to export a netlist.
+The hierarchical sheets are parsed in parallel (when possible) and only once, even when used more than once.
+"""
+import os
+import hashlib
+from datetime import datetime
+from collections import OrderedDict
+from ..global_vars import DEBUG_OVERVIEW, ERR_INPUTFILE, KiCostError
+from .. import sexp
+from .eda import eda_class, FieldsOverlay
+from .tools import process_pool
+
+__all__ = ['get_part_groups', 'SCH_EXTENSION']
+
+SCH_EXTENSION = '.kicad_sch'
+# Parsed sheets, the key is the hash of the file content
+sheets_cache = {}
+# Maximum number of parsed sheets memorized
+SHEETS_CACHE_SIZE = 256
+
+
+def node_name(node):
+    ''' Name of an s-expression node, i.e. `symbol` for `(symbol ...)`. `None` for atoms. '''
+    if isinstance(node, list) and node and not isinstance(node[0], (list, int, float)):
+        return node[0]
+    return None
+
+
+def sub_nodes(node, name):
+    ''' Generator for the children of `node` called `name`. '''
+    for sub in node[1:]:
+        if node_name(sub) == name:
+            yield sub
+
+
+def sub_value(node, name, default=None):
+    ''' Value of the first child called `name`, i.e. `yes` for (in_bom yes). '''
+    for sub in sub_nodes(node, name):
+        if len(sub) > 1:
+            return sub[1]
+    return default
+
+
+def get_properties(node):
+    ''' List of (name, value) for the properties of a symbol or sheet. '''
+    return [(str(p[1]), str(p[2])) for p in sub_nodes(node, 'property') if len(p) > 2]
+
+
+def filter_properties(props):
+    ''' Generator for the properties used as fields. '''
+    for name, value in props:
+        if name == 'Reference' or name.startswith('ki_'):
+            # Excluded to avoid problems to group parts of differents sheets ISSUE #97.
+            continue
+        if name in ('Value', 'Footprint', 'Datasheet') or value:
+            yield name, value
+
+
+def get_instances(node):
+    ''' Dict with the references for the instances paths, `(path "/a/b" (reference "R1") ...)` entries. '''
+    instances = {}
+    for path in sub_nodes(node, 'path'):
+        ref = sub_value(path, 'reference')
+        if ref is not None:
+            instances[str(path[1])] = str(ref)
+    return instances
+
+
+def parse_sheet(content):
+    ''' Extracts the information we need from the content of a schematic file.
+        Only plain data is returned, so it can be passed between processes. '''
+    try:
+        sch = sexp.loads(content, nil=None, true=None)
+    except sexp.SExpError as e:
+        raise KiCostError('Malformed KiCad schematic ({})'.format(e), ERR_INPUTFILE)
+    if node_name(sch) != 'kicad_sch':
+        raise KiCostError('Not a KiCad schematic', ERR_INPUTFILE)
+    sheet = {'uuid': sub_value(sch, 'uuid'), 'title': None, 'company': None, 'date': None,
+             'lib_symbols': {}, 'symbols': [], 'sheets': [], 'symbol_instances': {}}
+    for node in sch[1:]:
+        name = node_name(node)
+        if name == 'symbol':
+            # A component, KiCad 7+ stores the references for each instance here
+            instances = {}
+            for inst in sub_nodes(node, 'instances'):
+                for prj in sub_nodes(inst, 'project'):
+                    instances.update(get_instances(prj))
+            lib_id = str(sub_value(node, 'lib_id', '???'))
+            sheet['symbols'].append({'lib_id': lib_id,
+                                     'lib_name': str(sub_value(node, 'lib_name', lib_id)),
+                                     'uuid': str(sub_value(node, 'uuid')),
+                                     'in_bom': sub_value(node, 'in_bom', 'yes') == 'yes',
+                                     'dnp': sub_value(node, 'dnp', 'no') == 'yes',
+                                     'properties': get_properties(node),
+                                     'instances': instances})
+        elif name == 'lib_symbols':
+            for lib in sub_nodes(node, 'symbol'):
+                sheet['lib_symbols'][str(lib[1])] = {'properties': get_properties(lib),
+                                                     'power': any(True for _ in sub_nodes(lib, 'power'))}
+        elif name == 'sheet':
+            props = dict(get_properties(node))
+            file_name = props.get('Sheetfile', props.get('Sheet file'))
+            if file_name:
+                sheet['sheets'].append((str(sub_value(node, 'uuid')), file_name))
+        elif name == 'symbol_instances':
+            # KiCad 6 stores the references for all the instances in the root sheet
+            sheet['symbol_instances'] = get_instances(node)
+        elif name == 'title_block':
+            sheet['title'] = sub_value(node, 'title')
+            sheet['company'] = sub_value(node, 'company')
+            sheet['date'] = sub_value(node, 'date')
+    return sheet
+
+
+def parse_file(in_file, data):
+    ''' Parses the content of a schematic file, adding the file name to the errors. '''
+    try:
+        return parse_sheet(data.decode('utf-8'))
+    except KiCostError as e:
+        raise KiCostError('{} `{}`'.format(e.msg, in_file), e.id)
+
+
+def read_sheets(root):
+    ''' Reads all the sheets in the hierarchy, level by level. The sheets of each level are parsed in parallel.
+        Returns a dict with the parsed sheets, indexed by file name. '''
+    sheets = {}
+    pending = [root]
+    while pending:
+        to_parse = OrderedDict()
+        hashes = {}
+        for file_name in pending:
+            try:
+                with open(file_name, 'rb') as f:
+                    data = f.read()
+            except (IOError, OSError) as e:
+                raise KiCostError('Unable to read the KiCad schematic `{}` ({})'.format(file_name, e), ERR_INPUTFILE)
+            file_hash = hashlib.sha1(data).hexdigest()
+            hashes[file_name] = file_hash
+            if file_hash not in sheets_cache and file_hash not in to_parse:
+                to_parse[file_hash] = (file_name, data)
+        pool = process_pool(len(to_parse))
+        if pool is None:
+            parsed = [parse_file(*args) for args in to_parse.values()]
+        else:
+            with pool:
+                parsed = list(pool.map(parse_file, *zip(*to_parse.values())))
+        level = {h: sheets_cache[h] for h in hashes.values() if h in sheets_cache}
+        level.update(zip(to_parse.keys(), parsed))
+        # Memorize the new sheets, all are forgotten when the cache is full
+        if len(sheets_cache) + len(to_parse) > SHEETS_CACHE_SIZE:
+            sheets_cache.clear()
+        sheets_cache.update(zip(to_parse.keys(), parsed))
+        # Look for the sheets used by this level
+        next_level = []
+        for file_name in pending:
+            sheet = sheets[file_name] = level[hashes[file_name]]
+            for _, sub_name in sheet['sheets']:
+                sub_file = sheet_file_name(root, file_name, sub_name)
+                if sub_file not in sheets and sub_file not in next_level:
+                    next_level.append(sub_file)
+        pending = next_level
+    return sheets
+
+
+def sheet_file_name(root, parent, name):
+    ''' Full name for a sub-sheet file. KiCad uses paths relative to the parent sheet, or to the project. '''
+    file_name = os.path.join(os.path.dirname(parent), name)
+    if not os.path.isfile(file_name):
+        alt_name = os.path.join(os.path.dirname(root), name)
+        if os.path.isfile(alt_name):
+            return alt_name
+    return file_name
+
+
+def get_reference(sym, sheet_path, root):
+    ''' Reference for a symbol used in the sheet instantiated at `sheet_path` (the UUIDs of the sheets, without the root). '''
+    # KiCad 6: all the instances are in the root sheet, the path ends with the symbol UUID
+    ref = root['symbol_instances'].get(sheet_path + '/' + sym['uuid'])
+    if ref is None:
+        # KiCad 7+: the instances are in each symbol, the path starts with the root sheet UUID
+        ref = sym['instances'].get('/' + str(root['uuid']) + sheet_path)
+        if ref is None:
+            ref = sym['instances'].get(sheet_path or '/')
+            if ref is None:
+                # A sheet used as root, or a KiCad 5 converted file
+                ref = dict(sym['properties']).get('Reference', '?')
+    return ref
+
+
+def get_part_groups(in_file):
+    '''Get groups of identical parts from a KiCad schematic and its sub-sheets and return them as a dictionary.
+       @param in_file `str()` with the file name.
+       @return `dict()` of the parts designed. The keys are the componentes references.
+    '''
+    eda_class.logger.log(DEBUG_OVERVIEW, '# Getting from KiCad schematic \'{}\'...'.format(os.path.basename(in_file)))
+    root_file = os.path.abspath(in_file)
+    sheets = read_sheets(root_file)
+    root = sheets[root_file]
+
+    prj_info = dict()
+    prj_info['title'] = root['title'] or os.path.basename(in_file)
+    prj_info['company'] = root['company']
+    prj_info['date'] = root['date'] or (datetime.fromtimestamp(os.path.getmtime(in_file)).strftime("%Y-%m-%d %H:%M:%S") + ' (file)')
+    # The rest of the files used, changes in them changes the result
+    prj_info['files'] = sorted(f for f in sheets if f != root_file)
+
+    components = OrderedDict()
+    lib_fields = {}
+    # Walk the hierarchy, each sheet can be instantiated more than once
+    stack = [(root_file, '')]
+    while stack:
+        file_name, sheet_path = stack.pop()
+        sheet = sheets[file_name]
+        for sym in sheet['symbols']:
+            lib = sheet['lib_symbols'].get(sym['lib_name'], {'properties': [], 'power': False})
+            ref = get_reference(sym, sheet_path, root)
+            if not sym['in_bom'] or lib['power'] or ref.startswith('#'):
+                continue
+            if ref in components:
+                # Another unit of a multi-unit symbol
+                continue
+            # The fields from the library (shared by all its parts), redefined by the ones from the schematic
+            key = (file_name, sym['lib_name'], sym['lib_id'])
+            base = lib_fields.get(key)
+            if base is None:
+                base = lib_fields[key] = OrderedDict(filter_properties(lib['properties']))
+                base['libpart'] = sym['lib_id']
+            fields = FieldsOverlay(base, filter_properties(sym['properties']))
+            if sym['dnp'] and 'dnp' not in (f.lower() for f in fields):
+                fields['dnp'] = '1'
+            components[ref] = fields
+        for uuid, sub_name in reversed(sheet['sheets']):
+            stack.append((sheet_file_name(root_file, file_name, sub_name), sheet_path + '/' + uuid))
+
+    return components, prj_info
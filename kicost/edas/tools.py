@@ -29,19 +29,57 @@ __company__ = 'University of Campinas - Brazil'
 
 # Libraries.
 import re  # Regular expression parser and matches.
+import sys
+import multiprocessing
+import threading
 from collections import OrderedDict
+from operator import itemgetter
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2: a bounded memo, forgets all the entries when full
+    def lru_cache(maxsize=128):
+        def decorator(func):
+            cache = {}
+
+            def wrapper(*args):
+                try:
+                    return cache[args]
+                except KeyError:
+                    pass
+                if len(cache) >= maxsize:
+                    cache.clear()
+                res = cache[args] = func(*args)
+                return res
+            return wrapper
+        return decorator
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2.7 without the `futures` backport, the files are read one by one
+    ProcessPoolExecutor = None
 from .. import PartGroup
 from ..global_vars import SEPRTR, DEBUG_OVERVIEW, DEBUG_OBSESSIVE, DEBUG_DETAILED, DEBUG_FULL, ERR_FIELDS, KiCostError, W_INCQTY, W_REPMAN, W_MANQTY
 from ..distributors import get_distributors_iter
-from .eda import eda_class, field_name_translations
+from .eda import eda_class, field_name_translations, FieldsOverlay
 
-__all__ = ['partgroup_qty', 'groups_sort', 'order_refs', 'subpartqty_split', 'group_parts']
+__all__ = ['partgroup_qty', 'groups_sort', 'order_refs', 'parse_ref', 'subpartqty_split', 'group_parts', 'process_pool']
 
 # Qty and part separators are escaped by preceding with '\' = (?<!\\)
 QTY_SEPRTR = r'(?<!\\)\s*[:]\s*'  # Separator for the subpart quantity and the part number, remove the lateral spaces.
 PART_SEPRTR = r'(?<!\\)\s*\|\s*'             # Separator for the part numbers in a list, remove the lateral spaces.
 PART_SEPRTR_LEGACY = r'(?<!\\)\s*[;,\|]\s*'  # Legacy version
 ESC_FIND = r'\\\s*([;,:])\s*'      # Used to remove backslash from escaped qty & manf# separators.
+# Compiled versions of the above
+QTY_SEPRTR_REGEX = re.compile(QTY_SEPRTR)
+PART_SEPRTR_REGEX = re.compile(PART_SEPRTR)
+PART_SEPRTR_LEGACY_REGEX = re.compile(PART_SEPRTR_LEGACY)
+ESC_FIND_REGEX = re.compile(ESC_FIND)
+# Search for numbers, matching with simple, frac and decimal ones.
+QTY_NUMBER_REGEX = re.compile(r"^\s*[\-\+]?\s*[0-9]*\s*[\.\/]*\s*?[0-9]*\s*$")
+QTY_MARKS_REGEX = re.compile(r'[\.\/]')
+# Maximum number of different manf#/qty strings memorized
+SUBPART_CACHE_SIZE = 4096
 REPLICATE_MANF = '~'  # Character used to replicate the last manufacture name (`manf` field) in multi-parts.
 SGROUP_SEPRTR = '\n'  # Separator of the semi identical parts groups (parts that have the filed ignored to group).
 PRJ_STR_DECLARE = 'prj'  # Project string declaration attached to the beginning of each reference correspondent to one project in the multi-project files case.
@@ -55,6 +93,8 @@ PRJ_SEPRTR = ';'  # Separator between projects when collapsed and grouped the pa
 # Reference string order to the spreadsheet. Use this to
 # group the elements in sequential rows.
 BOM_ORDER = 'u,q,d,t,y,x,c,r,s,j,p,cnn,con'
+# Maximum number of parsed references memorized
+REF_CACHE_SIZE = 16384
 
 # Characters removed from references when read the files.
 PART_REF_REGEX_NOT_ALLOWED = r'[\+\(\)\*\{}]'.format(SEPRTR)
@@ -72,6 +112,12 @@ PART_REF_REGEX_NOT_ALLOWED = r'[\+\(\)\*\{}]'.format(SEPRTR)
 PART_REF_REGEX_SPECIAL_CHAR_REF = r'\+\-\=\s\_\.\(\)\$\*\&'  # Used in next definition only (because repeat).
 PART_REF_REGEX_NUMBER = r'(?P<num>((?P<ref_num>\d+)({sp}(?P<subpart_num>\d+))?))'.format(sp=SUB_SEPRTR)
 PART_REF_REGEX = re.compile('^(?P<prefix>.*?)'+PART_REF_REGEX_NUMBER+'$', re.IGNORECASE)
+# Used to split the references groups
+REFS_SPLIT_REGEX = re.compile(' *[,; ] *')
+REF_NOT_ALLOWED_REGEX = re.compile(PART_REF_REGEX_NOT_ALLOWED)
+REF_GROUP_REGEX = re.compile(r'^\w+\d')
+REF_RANGE_SEP_REGEX = re.compile(r'[/\\]')
+REF_NOT_GROUP_REGEX = re.compile(r'[\-\/\\]')
 
 
 def get_manfcat(fields, f):
@@ -137,6 +183,8 @@ def group_parts(components, fields_merge, c_prjs):
     # part numbers that may be assigned. Just collect those in a list for each group.
     eda_class.logger.log(DEBUG_OVERVIEW, 'Getting groups of identical components...')
     component_groups = OrderedDict()
+    # The manf# and distributors codes for each part, in the FIELDS_MANFCAT order
+    ref_codes = {}
     for ref, fields in components.items():  # part references and field values.
 
         # Take the field keys and values of each part and create a hash.
@@ -148,6 +196,7 @@ def group_parts(components, fields_merge, c_prjs):
         # a field used by a specific tool (including KiCost).
         hash_fields = (fields[k] for k in fields if k not in FIELDS_NOT_HASH and SEPRTR not in k)
         h = hash(tuple(sorted(hash_fields)))
+        ref_codes[ref] = tuple(get_manfcat(fields, f) for f in FIELDS_MANFCAT)
 
         # Now add the hashed component to the group with the matching hash
         # or create a new group if the hash hasn't been seen before.
@@ -156,20 +205,11 @@ def group_parts(components, fields_merge, c_prjs):
             # doesn't exist yet.
             grp = PartGroup()  # Add empty structure.
             grp.refs = [ref]  # Init list of refs with first ref.
-            # Now add the manf. part code (or None) and each distributor stock
-            # catalogue code for this part to the group set.
-            grp.manfcat_codes = {}
-            for f in FIELDS_MANFCAT:
-                grp.manfcat_codes[f] = OrderedDict([(get_manfcat(fields, f), True)])
             component_groups[h] = grp
         else:
             grp = component_groups[h]
             # Add next ref for identical part to the list.
             grp.refs.append(ref)
-            # Also add any manufacturer's part number (or None) and each distributor
-            # stock catalogue code to the group's list.
-            for f in FIELDS_MANFCAT:
-                grp.manfcat_codes[f][get_manfcat(fields, f)] = True
     if ultra_debug:
         eda_class.logger.log(DEBUG_FULL, '\n\n\n1++++++++++++++' + str(len(component_groups)))
         for g, grp in list(component_groups.items()):
@@ -199,6 +239,10 @@ def group_parts(components, fields_merge, c_prjs):
     eda_class.logger.log(DEBUG_OVERVIEW, 'Checking the seemingly identical parts group...')
     new_component_groups = []  # Copy new component groups into this.
     for g, grp in component_groups.items():
+        # Now add the manf. part codes (or None) and each distributor stock
+        # catalogue codes for the parts of this group, in order of appearance.
+        codes_found = zip(*OrderedDict.fromkeys(ref_codes[r] for r in grp.refs))
+        grp.manfcat_codes = {f: tuple(OrderedDict.fromkeys(codes)) for f, codes in zip(FIELDS_MANFCAT, codes_found)}
         num_manfcat_codes = {f: len(grp.manfcat_codes[f]) for f in FIELDS_MANFCAT}
         if all([num_manfcat_codes[f] == 1 or (num_manfcat_codes[f] == 2 and None in grp.manfcat_codes[f]) for f in FIELDS_MANFCAT]):
             new_component_groups.append(grp)
@@ -221,25 +265,18 @@ def group_parts(components, fields_merge, c_prjs):
         # Otherwise, split the group into subgroups, each with the
         # same manf# and distributors catalogue codes (for that one
         # that will be scraped, the other ones are not considered).
-        for i_manfcat in range(max([len(grp.manfcat_codes[f]) for f in FIELDS_MANFCAT])):
-            manfcat_num = OrderedDict()
-            for f in FIELDS_MANFCAT:
-                try:
-                    manfcat_num[f] = list(grp.manfcat_codes[f])[i_manfcat]
-                except IndexError:
-                    # If not have more code in the set list, is because just
-                    # exist one. So use this as general.
-                    manfcat_num[f] = list(grp.manfcat_codes[f])[0]
-            sub_group = PartGroup()
-            sub_group.manfcat_codes = manfcat_num
-            sub_group.refs = []
-            for ref in grp.refs:
-                # Use get() which returns `None` if the component has no
-                # manf# or distributor# field. That will match if the
-                # group manf_num is also None. So append the par to the group.
-                if all([get_manfcat(components[ref], f) == manfcat_num[f] for f in FIELDS_MANFCAT]):
-                    sub_group.refs.append(ref)
-            new_component_groups.append(sub_group)  # Append one part of the split group.
+        # The parts are classified in one pass, using the codes as index.
+        # A missing code is `None`, so it only matches other missing codes.
+        sub_groups = OrderedDict()
+        for ref in grp.refs:
+            codes = ref_codes[ref]
+            sub_group = sub_groups.get(codes)
+            if sub_group is None:
+                sub_group = sub_groups[codes] = PartGroup()
+                sub_group.manfcat_codes = {f: (code,) for f, code in zip(FIELDS_MANFCAT, codes)}
+                sub_group.refs = []
+            sub_group.refs.append(ref)
+        new_component_groups.extend(sub_groups.values())  # Append the parts of the split group.
     if ultra_debug:
         eda_class.logger.log(DEBUG_FULL, '\n\n\n2++++++++++++++' + str(len(new_component_groups)))
         for grp in new_component_groups:
@@ -253,12 +290,14 @@ def group_parts(components, fields_merge, c_prjs):
     # collapsed plus `SEPRTR`. Implementation of the ISSUE #102.
     eda_class.logger.log(DEBUG_OVERVIEW, 'Merging field asked in the identical components groups...')
     if fields_merge:
-        fields_merge = [field_name_translations.get(f.lower(), f.lower()) for f in fields_merge]
         for grp in new_component_groups:
-            components_grp = [components[i] for i in grp.refs]
             for f in fields_merge:
-                values_field = set([cmp.get(f, '') for cmp in components_grp])  # Different values
-                ocurrences = {v_g: [r for r in grp.refs if components[r].get(f, '') == v_g] for v_g in values_field if v_g}
+                # The refs for each value, in one pass
+                ocurrences = {}
+                for r in grp.refs:
+                    v_g = components[r].get(f, '')
+                    if v_g:
+                        ocurrences.setdefault(v_g, []).append(r)
                 if len(ocurrences) > 1:
                     if f == 'desc' and len(ocurrences) == 2 and '' in ocurrences:
                         value = ''.join(list(ocurrences.keys()))
@@ -276,6 +315,8 @@ def group_parts(components, fields_merge, c_prjs):
     # Now get the values of all fields within the members of a group.
     # These will become the field values for ALL members of that group.
     eda_class.logger.log(DEBUG_OVERVIEW, 'Propagating field values to identical components...')
+    # The same names and values repeat in a lot of groups, keep only one copy of them
+    strings = {}
     for grp in new_component_groups:
         grp_fields = OrderedDict()
         # Multiprojects has a list of qty's
@@ -294,7 +335,9 @@ def group_parts(components, fields_merge, c_prjs):
                         raise KiCostError('Field value mismatch: ref={} field={} value=\'{}\', global=\'{}\' at group={}'
                                           .format(ref, key, val, grp_fields[key], grp.refs), ERR_FIELDS)
                 else:  # First time this field has been seen in the group, so store it.
-                    grp_fields[key] = val
+                    if isinstance(val, str):
+                        val = strings.setdefault(val, val)
+                    grp_fields[strings.setdefault(key, key)] = val
             # Add this component to the total quantity
             qty = [1]*c_prjs
             if 'manf#_qty' in comp:
@@ -334,41 +377,25 @@ def groups_sort(new_component_groups):
 
     ref_identifiers = re.split(r'(?<![\W\*\/])\s*,\s*|\s*,\s*(?![\W\*\/])',
                                BOM_ORDER, flags=re.IGNORECASE)
-    component_groups_order_old = list(range(0, len(new_component_groups)))
-    component_groups_order_new = list()
-    component_groups_refs = [new_component_groups[g].fields.get('reference') for g in component_groups_order_old]
+    # Position of each identifier in BOM_ORDER
+    ranks = {}
+    for rank, ref_identifier in enumerate(ref_identifiers):
+        ranks.setdefault(ref_identifier, rank)
     eda_class.logger.log(DEBUG_OBSESSIVE, 'All ref identifier: {}'.format(ref_identifiers))
-    eda_class.logger.log(DEBUG_OBSESSIVE, '{} groups of components.'.format(len(component_groups_order_old)))
-    eda_class.logger.log(DEBUG_OBSESSIVE, 'Identifiers founded {}.'.format(component_groups_refs))
-    for ref_identifier in ref_identifiers:
-        component_groups_ref_match = [i for i in range(0, len(component_groups_refs)) if ref_identifier == component_groups_refs[i].lower()]
-        eda_class.logger.log(DEBUG_OBSESSIVE, 'Identifier: {} in {}.'.format(ref_identifier, component_groups_ref_match))
-        if len(component_groups_ref_match) > 0:
-            # If found more than one group with the reference, use the 'manf#'
-            # as second order criteria.
-            if len(component_groups_ref_match) > 1:
-                try:
-                    for item in component_groups_ref_match:
-                        component_groups_order_old.remove(item)
-                except ValueError:
-                    pass
-                # Examine 'manf#' and refs to get the order.
-                # Order by refs that have 'manf#' codes, that ones that don't have stay at the end of the group.
-                group_manf_list = [new_component_groups[h].fields.get('manf#') for h in component_groups_ref_match]
-                group_refs_list = [new_component_groups[h].refs for h in component_groups_ref_match]
-                sorted_groups = sorted(range(len(group_refs_list)), key=lambda k: (group_manf_list[k] is None,  group_refs_list[k]))
-                eda_class.logger.log(DEBUG_OBSESSIVE, '{} > order: {}'.format(group_manf_list, sorted_groups))
-                component_groups_ref_match = [component_groups_ref_match[i] for i in sorted_groups]
-                component_groups_order_new += component_groups_ref_match
-            else:
-                try:
-                    component_groups_order_old.remove(component_groups_ref_match[0])
-                except ValueError:
-                    pass
-                component_groups_order_new += component_groups_ref_match
-    # The new order is the found refs first and at the last the not referenced in BOM_ORDER.
-    component_groups_order_new += component_groups_order_old  # Add the missing references groups.
-    new_component_groups = [new_component_groups[i] for i in component_groups_order_new]
+    eda_class.logger.log(DEBUG_OBSESSIVE, '{} groups of components.'.format(len(new_component_groups)))
+    # The groups with an identifier in BOM_ORDER go first, the rest at the end (in the same order).
+    ordered = []
+    not_ordered = []
+    for grp in new_component_groups:
+        rank = ranks.get(grp.fields.get('reference').lower())
+        if rank is None:
+            not_ordered.append(grp)
+        else:
+            # If found more than one group with the reference, use the 'manf#' as second order criteria.
+            # Order by refs that have 'manf#' codes, that ones that don't have stay at the end of the group.
+            ordered.append(((rank, grp.fields.get('manf#') is None, grp.refs), grp))
+    ordered.sort(key=lambda x: x[0])
+    new_component_groups = [grp for _, grp in ordered] + not_ordered
     return new_component_groups
 
 
@@ -457,7 +484,8 @@ def subpartqty_split(components, distributors, split_extra_fields):
             # the subparts. Modify the designator and the part. Create
             # a sub quantity field.
             if is_multi:
-                subpart_actual = part_actual.copy()
+                # Only the fields changed for the subpart are stored, the rest are shared with the part
+                subpart_actual = FieldsOverlay(part_actual)
                 subpart_actual['value'] = '{v} - p{idx}/{total}'.format(v=part_actual_value, idx=subparts_index+1, total=subparts_qty)
             else:
                 subpart_actual = part_actual
@@ -486,7 +514,7 @@ def subpartqty_split(components, distributors, split_extra_fields):
                 if p_manf_code and p_manf_code_prior and subpart_qty_prior != subpart_qty:
                     eda_class.logger.warning(W_INCQTY+'Different quantities signed between \"{f}={c}\" and \"{fl}={cl}\" at \"{r}\". Make sure that is right.'.
                                              format(f=field_manf_dist_code, fl=field_manf_dist_code_prior,
-                                                    c=p_manf_code, cl=p_manf_code_prior, r=order_refs(list(components.keys()))[0]))
+                                                    c=p_manf_code, cl=p_manf_code_prior, r=part_ref))
                 # Memorize prior value for the above warning
                 subpart_qty_prior = subpart_qty
                 p_manf_code_prior = p_manf_code
@@ -502,7 +530,7 @@ def subpartqty_split(components, distributors, split_extra_fields):
                     p_manf = subparts_manf[subparts_index]
                 elif p_manf is None:
                     eda_class.logger.warning(W_REPMAN+'Asking to repeat a manufacturer in the first entry (at {})'.
-                                             format(order_refs(list(components.keys()))[0]))
+                                             format(part_ref))
                 subpart_actual['manf'] = p_manf
                 # Update the reference of the part.
                 ref = part_ref + SUB_SEPRTR + str(subparts_index + 1)
@@ -512,12 +540,17 @@ def subpartqty_split(components, distributors, split_extra_fields):
     return split_components
 
 
+@lru_cache(maxsize=SUBPART_CACHE_SIZE)
+def str2qty(value):
+    if isinstance(value, str) and '/' in value:
+        vals = value.split('/')
+        return float(vals[0])/float(vals[1])
+    return float(value)
+
+
 def qty2float(value):
     try:
-        if isinstance(value, str) and '/' in value:
-            vals = value.split('/')
-            return float(vals[0])/float(vals[1])
-        return float(value)
+        return str2qty(value)
     except ValueError:
         eda_class.logger.warning(W_MANQTY+'Malformed `manf#_qty`: ' + str(value))
         return 1.0
@@ -570,9 +603,16 @@ def subpart_list(part, legacy=True):
     @param part Manufacture code part `str`.
     @return List of manufacture code parts.
     '''
-    return re.split(PART_SEPRTR_LEGACY if legacy else PART_SEPRTR, part.strip())
+    return list(split_subparts(part, legacy))
+
 
+@lru_cache(maxsize=SUBPART_CACHE_SIZE)
+def split_subparts(part, legacy):
+    ''' Memorized `subpart_list()`, returns a `tuple()` '''
+    return tuple((PART_SEPRTR_LEGACY_REGEX if legacy else PART_SEPRTR_REGEX).split(part.strip()))
 
+
+@lru_cache(maxsize=SUBPART_CACHE_SIZE)
 def manf_code_qtypart(subpart):
     '''@brief Get the quantity and the part code of the sub part
        manufacture / distributor. Test if was pre or post
@@ -588,13 +628,12 @@ def manf_code_qtypart(subpart):
 
        @param Part that way have different than ONE quantity. Intended as one element of the list of `subpart_list()`.
        @return (qty, manf#) Quantity and the manufacture code.
+       The result is memorized, the same codes are used by many parts.
     '''
-    strings = re.split(QTY_SEPRTR, subpart)
+    strings = QTY_SEPRTR_REGEX.split(subpart)
     if len(strings) == 2:
-        # Search for numbers, matching with simple, frac and decimal ones.
-        num_format = re.compile(r"^\s*[\-\+]?\s*[0-9]*\s*[\.\/]*\s*?[0-9]*\s*$")
-        string0_test = re.match(num_format, strings[0])
-        string1_test = re.match(num_format, strings[1])
+        string0_test = QTY_NUMBER_REGEX.match(strings[0])
+        string1_test = QTY_NUMBER_REGEX.match(strings[1])
         if string0_test and not(string1_test):
             qty = strings[0].strip()
             part = strings[1].strip()
@@ -605,7 +644,7 @@ def manf_code_qtypart(subpart):
             # May be founded a just numeric manufacture/distributor part,
             # in this case, the quantity is a shortest string not
             # considering "." and "/" marks.
-            if len(re.sub(r'[\.\/]', '', strings[0])) < len(re.sub(r'[\.\/]', '', strings[1])):
+            if len(QTY_MARKS_REGEX.sub('', strings[0])) < len(QTY_MARKS_REGEX.sub('', strings[1])):
                 qty = strings[0].strip()
                 part = strings[1].strip()
             else:
@@ -619,98 +658,96 @@ def manf_code_qtypart(subpart):
     else:
         qty = '1'
         part = ''.join(strings)
-    part = re.sub(ESC_FIND, r'\1', part)  # Remove any escape backslashes preceding PART_SEPRTR.
+    part = ESC_FIND_REGEX.sub(r'\1', part)  # Remove any escape backslashes preceding PART_SEPRTR.
     eda_class.logger.log(DEBUG_OBSESSIVE, 'part/qty>> {}\t\tpart>>{}\tqty>>{}'.format(subpart, part, qty))
     return qty, part
 
 
-def get_refnum(refnum):
-    if not refnum:
-        return 0
-    return int(re.match(r'\d+', refnum).group(0))
-
+@lru_cache(maxsize=REF_CACHE_SIZE)
+def parse_ref(ref):
+    '''@brief Splits a reference in its components, the result is cached because the same references are used many times.
 
-def convert_to_ranges(nums):
-    # Collapse a list of numbers into sorted, comma-separated, hyphenated ranges.
-    # e.g.: 3,4,7,8,9,10,11,13,14 => 3,4,7-11,13,14
+       'prj1:R10' --> ('prj1:', 'R', '10', 10, None)
+       'CONN1#3' --> (None, 'CONN', '1#3', 1, 3)
+       @param ref Designator/reference `str()`.
+       @return `tuple()` with the project prefix (`None` if not a multiproject reference), the prefix,
+       the number (a `str()`, empty if none), the reference number and the subpart number (`None` if not a subpart).
+    '''
+    # Partition each part reference into its beginning part prefix and ending number.
+    match = PART_REF_REGEX.search(ref)
+    if match:
+        prefix = match.group('prefix')
+        num = match.group('num')
+        ref_num = int(match.group('ref_num'))
+        subpart_num = match.group('subpart_num')
+        if subpart_num is not None:
+            subpart_num = int(subpart_num)
+    else:
+        prefix = ref
+        num = ''
+        ref_num = 0
+        subpart_num = None
+    # Is this a multiproject ref?
+    match = PRJ_REGEX.search(prefix)
+    if match:
+        prj_prefix = match.group(1)
+        prefix = match.group(3)
+    else:
+        prj_prefix = None
+    return (prj_prefix, prefix, num, ref_num, subpart_num)
 
-    def to_int(n):
-        try:
-            return int(n)
-        except ValueError:
-            return n
 
-    nums.sort(key=get_refnum)  # Sort all the numbers.
-    nums = [to_int(n) for n in nums]  # Convert strings to `int` if possible.
+def convert_to_ranges(refs):
+    # Collapse a list of references, sorted by number, into comma-separated, hyphenated ranges.
+    # e.g.: 3,4,7,8,9,10,11,13,14 => 3,4,7-11,13,14
+    # Part references with subparts (or without number) are never included in ref ranges, they are returned as `str`.
     num_ranges = []  # No ranges found yet since we just started.
-    range_start = 0  # First possible range is at the start of the list of numbers.
-
-    # Go through the list of numbers looking for 3 or more sequential numbers.
-    while range_start < len(nums):
-        num_range = nums[range_start]  # Current range starts off as a single number.
-        next_range_start = range_start + 1  # The next possible start of a range.
-        # Part references with subparts are never included in ref ranges.
-        if not isinstance(num_range, int):
-            num_ranges.append(num_range)
-            range_start = next_range_start
+    range_start = None  # First possible range.
+    last = None
+    for _, _, num, ref_num, subpart_num in refs:
+        if subpart_num is not None or not num:
+            if range_start is not None:
+                num_ranges.extend(range_to_list(range_start, last))
+                range_start = None
+            num_ranges.append(num)
             continue
-        # Look for sequences of three or more sequential numbers.
-        for range_end in range(range_start + 2, len(nums)):
-            if not isinstance(nums[range_end], int):
-                break  # Ref with subpart, so can't be in a ref range.
-            if range_end - range_start != nums[range_end] - nums[range_start]:
-                break  # Non-sequential numbers found, so break out of loop.
-            # Otherwise, extend the current range.
-            num_range = [nums[range_start], nums[range_end]]
-            # 3 or more sequential numbers found, so next possible range must start after this one.
-            next_range_start = range_end + 1
-        # Append the range (or single number) just found to the list of range.
-        num_ranges.append(num_range)
-        # Point to the start of the next possible range and keep looking.
-        range_start = next_range_start
-
+        if range_start is not None and ref_num == last + 1:
+            # Extend the current range
+            last = ref_num
+            continue
+        if range_start is not None:
+            num_ranges.extend(range_to_list(range_start, last))
+        range_start = last = ref_num
+    if range_start is not None:
+        num_ranges.extend(range_to_list(range_start, last))
     return num_ranges
 
 
+def range_to_list(start, end):
+    # Only 3 or more sequential numbers are a range
+    if end - start >= 2:
+        return [[start, end]]
+    return list(range(start, end + 1))
+
+
 def order_refs(refs, collapse=True, ref_sep=PART_NSEQ_SEPRTR):
     '''@brief Collapse list of part references into a sorted, comma-separated list of hyphenated ranges. This is intended as opposite of `split_refs()`
        @param refs Designator/references `list()`.
        @return References in a organized view way.
     '''
-    prefix_nums = OrderedDict()  # Contains a list of numbers for each distinct prefix.
+    prefix_refs = OrderedDict()  # Contains a list of parsed references for each distinct prefix.
     for ref in refs:
-        # Partition each part reference into its beginning part prefix and ending number.
-        match = PART_REF_REGEX.search(ref)
-        if match:
-            prefix = match.group('prefix')
-            num = match.group('num')
-        else:
-            prefix = ref
-            num = ''
-        # Append the number to the list of numbers for this prefix, or create a list
-        # with a single number if this is the first time a particular prefix was encountered.
-        prefix_nums.setdefault(prefix, []).append(num)
-
-    # Convert the list of numbers for each ref prefix into ranges.
-    if collapse:
-        for prefix in list(prefix_nums.keys()):
-            prefix_nums[prefix] = convert_to_ranges(prefix_nums[prefix])
-    else:
-        for prefix in list(prefix_nums.keys()):
-            prefix_nums[prefix].sort(key=get_refnum)
+        parsed = parse_ref(ref)
+        prefix_refs.setdefault(parsed[:2], []).append(parsed)
 
     # Combine the prefixes and number ranges back into part references.
     collapsed_refs = []
     first_ref = None
-
-    for prefix, nums in prefix_nums.items():
-        # Is this a multiproject ref?
-        match = PRJ_REGEX.search(prefix)
-        if match:
-            prj_prefix = match.group(1)
-            prefix = match.group(3)
-        else:
-            prj_prefix = None
+    prj_prefix = None
+    for (prj_prefix, prefix), parsed in prefix_refs.items():
+        parsed.sort(key=itemgetter(3))  # Sort by number
+        # Convert the list of numbers for each ref prefix into ranges.
+        nums = convert_to_ranges(parsed) if collapse else [p[2] for p in parsed]
         # Work on this group of references
         refs = []
         for num in nums:
@@ -751,17 +788,17 @@ def split_refs(text):
        @param text Designator/references worn by a group of parts.
        @return Designator/references `list()` split.
     '''
-    partial_ref = re.split(' *[,; ] *', text)  # Split ignoring the spaces.
+    partial_ref = REFS_SPLIT_REGEX.split(text)  # Split ignoring the spaces.
     refs = []
     for ref in partial_ref:
         # Remove invalid characters. Changed `PART_REF_REGEX_SPECIAL_CHAR_REF` definition and allowed special characters.
         # ref = re.sub('\+$', 'p', ref) # Finishing "+".
-        ref = re.sub(PART_REF_REGEX_NOT_ALLOWED, '', ref)  # Generic special characters not allowed. To work around #ISSUE #89.
+        ref = REF_NOT_ALLOWED_REGEX.sub('', ref)  # Generic special characters not allowed. To work around #ISSUE #89.
         # ref = re.sub('\-+', '-', ref) # Double "-".
         # ref = re.sub('^\-', '', ref) # Starting "-".
         # ref = re.sub('\-$', 'n', ref) # Finishing "-".
-        if re.search(r'^\w+\d', ref):
-            if re.search('-', ref):
+        if REF_GROUP_REGEX.search(ref):
+            if '-' in ref:
                 designator_name = re.findall(r'^\D+', ref)[0]
                 split_nums = re.split('-', ref)
                 designator_name += ''.join(re.findall(r'^d*\W', split_nums[0]))
@@ -778,9 +815,9 @@ def split_refs(text):
                 split = [designator_name + base_split_nums+str(split[i]) for i in range(len(split))]
 
                 refs += split
-            elif re.search(r'[/\\]', ref):
+            elif '/' in ref or '\\' in ref:
                 designator_name = re.findall(r'^\D+', ref)[0]
-                split_nums = [re.sub('^'+designator_name, '', i) for i in re.split(r'[/\\]', ref)]
+                split_nums = [re.sub('^'+designator_name, '', i) for i in REF_RANGE_SEP_REGEX.split(ref)]
                 refs += [designator_name+i for i in split_nums]
             else:
                 refs += [ref.strip()]
@@ -788,11 +825,37 @@ def split_refs(text):
             # The designator name is not for a group of components and
             # "\", "/" or "-" is part of the name. This characters have
             # to be removed.
-            ref = re.sub(r'[\-\/\\]', '', ref.strip())
-            match = PART_REF_REGEX.search(ref)
-            if not match or not match.group('num'):
+            ref = REF_NOT_GROUP_REGEX.sub('', ref.strip())
+            if not parse_ref(ref)[2]:
                 # Add a '0' number at the end to be compatible with KiCad/KiCost
                 # ref strings. This may be missing in the hand made BoM.
                 ref += '0'
             refs += [ref]
     return refs
+
+
+def process_pool(jobs):
+    ''' Returns a pool of processes to run `jobs` tasks, or `None` if they must be done one by one.
+        The processes are forked, so they inherit the current configuration (i.e. the fields translations). '''
+    workers = min(jobs, multiprocessing.cpu_count())
+    # Daemonic processes (i.e. the workers of a pool in old Python versions) can't have children
+    if ProcessPoolExecutor is None or workers < 2 or multiprocessing.current_process().daemon:
+        return None
+    # Forking a process with other threads running (i.e. the GUI) can copy locks held by them
+    if threading.active_count() > 1:
+        eda_class.logger.log(DEBUG_OVERVIEW, 'Working with one process, other threads are running')
+        return None
+    try:
+        if sys.version_info >= (3, 4):
+            # Only where fork is the default start method, it isn't safe on macOS and not available on Windows.
+            # The first start method is the default for the platform.
+            start_method = multiprocessing.get_start_method(allow_none=True) or multiprocessing.get_all_start_methods()[0]
+            if start_method != 'fork':
+                return None
+        elif sys.platform.startswith('win'):
+            return None
+        return ProcessPoolExecutor(max_workers=workers)
+    except (OSError, ImportError, NotImplementedError) as e:
+        # I.e. no support for semaphores
+        eda_class.logger.log(DEBUG_OVERVIEW, 'Working with one process, unable to create a process pool ({})'.format(e))
+        return None
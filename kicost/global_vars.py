@@ -77,6 +77,7 @@ W_REPMAN = '(WC013) '  # Asking to repeat a manufacturer
 W_MANQTY = '(WC014) '  # Malformed manf#_qty
 W_AMBIPN = '(WC015) '  # Ambiguous mpn, needs better manf
 W_LOCFAIL = '(WC016) '  # Failed to set the locale
+W_APIBUDGET = '(WC017) '  # API daily budget exhausted
 
 
 class PartHtmlError(Exception):
@@ -96,6 +97,10 @@ class KiCostError(Exception):
         self.msg = msg
         self.id = id
 
+    def __reduce__(self):
+        # Needed to pass it between processes
+        return (self.__class__, (self.msg, self.id))
+
 
 def get_logger():
     return logger
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# MIT license
+#
+# Copyright (c) 2021 KiCost authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Incremental pricing
+
+Keeps the distributors data obtained for each group of parts, so the next run
+only needs to query the groups that are new or changed.
+"""
+import os
+import json
+import time
+import hashlib
+from . import DistData
+from .global_vars import DEBUG_OVERVIEW, get_logger
+from .cache import DEFAULT_CACHE_TTL
+
+__all__ = ['PreviousRun']
+
+# Version of the file format
+STATE_VERSION = 2
+DD_ATTRS = ('part_num', 'url', 'qty_avail', 'qty_increment', 'currency', 'moq')
+
+
+class PreviousRun(object):
+    '''@brief Distributors data from a previous run, stored in a JSON file.
+
+       The groups are identified by their fields (including the manf#, the distributors codes and the quantities).
+       The data is used only if the run is using the same currency, distributors and APIs.
+       Only the groups that got data from the distributors are stored, and they are queried again after `ttl` hours
+       (0 means they never expire).
+    '''
+    def __init__(self, file_name, distributors, currency, apis, ttl=DEFAULT_CACHE_TTL):
+        self.file_name = file_name
+        self.config = {'currency': currency, 'distributors': sorted(distributors), 'apis': sorted(apis)}
+        self.ttl = ttl*3600
+        self.parts = {}
+        self.keys = []
+        # Time when the data for each group was obtained
+        self.stamps = {}
+        logger = get_logger()
+        if not os.path.isfile(file_name):
+            return
+        try:
+            with open(file_name, 'rt') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('Ignoring the previous run data from `{}` ({})'.format(file_name, e))
+            return
+        if data.get('version') != STATE_VERSION or data.get('config') != self.config:
+            logger.log(DEBUG_OVERVIEW, 'The previous run used a different configuration, querying all the parts')
+            return
+        self.parts = data.get('parts', {})
+
+    @staticmethod
+    def part_key(part):
+        ''' Hash used to identify a group of parts, computed before asking the distributors '''
+        return hashlib.sha1(json.dumps(part.fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def to_dict(part):
+        ''' Data collected from the distributors for a group of parts '''
+        dd = {}
+        for dist, d in part.dd.items():
+            dd[dist] = {attr: getattr(d, attr) for attr in DD_ATTRS}
+            dd[dist]['price_tiers'] = sorted(d.price_tiers.items())
+        return {'fields': part.fields, 'dd': dd, 'datasheet': part.datasheet, 'lifecycle': part.lifecycle, 'specs': part.specs}
+
+    @staticmethod
+    def from_dict(part, data):
+        ''' Restores the data collected from the distributors '''
+        part.fields = data['fields']
+        part.dd = {}
+        for dist, d in data['dd'].items():
+            dd = DistData()
+            for attr in DD_ATTRS:
+                setattr(dd, attr, d[attr])
+            dd.price_tiers = {qty: price for qty, price in d['price_tiers']}
+            part.dd[dist] = dd
+        part.datasheet = data['datasheet']
+        part.lifecycle = data['lifecycle']
+        part.specs = {code: tuple(info) for code, info in data['specs'].items()}
+
+    def restore(self, parts):
+        ''' Fills the groups found in the previous run.
+            Returns the list of groups that must be asked to the distributors. '''
+        self.keys = [self.part_key(part) for part in parts]
+        to_query = []
+        now = time.time()
+        for part, key in zip(parts, self.keys):
+            data = self.parts.get(key)
+            if data is None or (self.ttl and now - data['stamp'] > self.ttl):
+                to_query.append(part)
+            else:
+                self.from_dict(part, data)
+                self.stamps[key] = data['stamp']
+        reused = len(parts) - len(to_query)
+        get_logger().log(DEBUG_OVERVIEW, 'Incremental pricing: {} parts reused, {} parts to query'.format(reused, len(to_query)))
+        return to_query
+
+    def save(self, parts):
+        ''' Stores the data for the current groups, used by the next run.
+            The groups without distributors data (i.e. skipped by the query budget or not found) are queried again. '''
+        now = time.time()
+        stored = {}
+        for part, key in zip(parts, self.keys):
+            if not part.dd:
+                continue
+            stored[key] = self.to_dict(part)
+            # The restored groups keep the time of the original query
+            stored[key]['stamp'] = self.stamps.get(key, now)
+        data = {'version': STATE_VERSION, 'config': self.config, 'parts': stored}
+        try:
+            with open(self.file_name, 'wt') as f:
+                json.dump(data, f)
+        except (IOError, OSError) as e:
+            get_logger().warning('Unable to save the pricing data to `{}` ({})'.format(self.file_name, e))
@@ -42,7 +42,10 @@
 # Libraries.
 import sys
 import os
+import json
+import logging
 import pprint
+import hashlib
 from collections import OrderedDict
 from copy import copy
 
@@ -54,32 +57,135 @@ except NameError:
     pass  # Happens if reload is attempted in Python 3.
 
 # Only export this routine for use by the outside world.
-__all__ = ['kicost', 'output_filename', 'kicost_gui_notdependences', 'query_part_info']
+__all__ = ['kicost', 'output_filename', 'kicost_gui_notdependences', 'query_part_info', 'set_bom_cache']
 
 from .global_vars import (DEFAULT_CURRENCY, DEBUG_OVERVIEW, SEPRTR, DEBUG_DETAILED, DEF_MAX_COLUMN_W, get_logger, ERR_KICOSTCONFIG, ERR_ARGS, KiCostError,
                           W_TRANS, W_NOMANP)
 # * Import the KiCost libraries functions.
 # Import information for various EDA tools.
-from .edas.tools import field_name_translations, subpartqty_split, group_parts, PRJ_STR_DECLARE, PRJPART_SPRTR
+from .edas.tools import field_name_translations, subpartqty_split, group_parts, process_pool, PRJ_STR_DECLARE, PRJPART_SPRTR
 from .edas import get_part_groups
 # Creation of the final XLSX spreadsheet.
 from .spreadsheet import create_spreadsheet, Spreadsheet
 # Import the scrape API
 from .distributors import get_dist_parts_info, get_registered_apis, get_distributors_iter, get_distributor_info
+from .version import __version__, __build__
+from .incremental import PreviousRun
+from .cache import DEFAULT_CACHE_TTL
 
 logger = get_logger()
+# Persistent cache for the parts read from the BoMs, `None` when disabled (see `set_bom_cache()`)
+bom_cache = None
 
 
-def query_part_info(parts, dist_list, currency=DEFAULT_CURRENCY):
+def set_bom_cache(cache):
+    ''' Configures the persistent cache used for the parsed BoMs (`None` to disable it) '''
+    global bom_cache
+    bom_cache = cache
+
+
+def query_part_info(parts, dist_list, currency=DEFAULT_CURRENCY, to_query=None):
     if logger.getEffectiveLevel() <= DEBUG_OVERVIEW:
         api_list = [d.name + ('(Disabled)' if not d.enabled else '') for d in get_registered_apis()]
         logger.log(DEBUG_OVERVIEW, 'Scrape API list ' + str(api_list))
-    get_dist_parts_info(parts, dist_list, currency)
+    get_dist_parts_info(parts, dist_list, currency, to_query)
+
+
+class WarningsCollector(logging.Handler):
+    ''' Collects the warnings and errors reported while reading a BoM, they are stored in the cache with the parts. '''
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+
+def read_bom(eda_name, in_file, ignore_fields, variant, dist_list, split_extra_fields):
+    ''' Reads one BoM file, doing all the steps that are independent of the other files.
+        Also returns the warnings reported, as a list of (level, message). '''
+    collector = WarningsCollector()
+    logger.addHandler(collector)
+    try:
+        p, info = get_part_groups(eda_name, in_file, ignore_fields, variant, dist_list)
+        return subpartqty_split(p, dist_list, split_extra_fields), info, collector.messages
+    finally:
+        logger.removeHandler(collector)
+
+
+def file_hash(name):
+    ''' SHA1 of the file content '''
+    f_hash = hashlib.sha1()
+    with open(name, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            f_hash.update(chunk)
+    return f_hash.hexdigest()
+
+
+def bom_cache_key(eda_name, in_file, ignore_fields, variant, dist_list, split_extra_fields):
+    ''' Creates the key used to store the parts read from a BoM in the cache.
+        The file is identified by its content, the rest are the options that change the result. '''
+    return json.dumps([__version__, __build__, file_hash(in_file), eda_name, variant, ignore_fields, dist_list, split_extra_fields,
+                       sorted(field_name_translations.items())])
+
+
+def bom_cache_get(key):
+    ''' Looks for the parts of a BoM in the cache. Returns `None` if not there.
+        Also checks the other files used by the BoM (i.e. the sub-sheets of a schematic).
+        The warnings reported when the BoM was read are reported again. '''
+    data = bom_cache.get(key)
+    if data is None:
+        return None
+    # The order of the fields is kept, even on Python versions where the `dict` doesn't keep it
+    data = json.loads(data, object_pairs_hook=OrderedDict)
+    for name, f_hash in data['files'].items():
+        if not os.path.isfile(name) or file_hash(name) != f_hash:
+            return None
+    warnings = data.get('warnings', [])
+    for level, msg in warnings:
+        logger.log(level, msg)
+    return OrderedDict(data['parts']), data['info'], warnings
+
+
+def bom_cache_put(key, result):
+    ''' Stores the parts of a BoM in the cache. '''
+    p, info, warnings = result
+    files = {name: file_hash(name) for name in info.get('files', [])}
+    bom_cache.set(key, json.dumps({'parts': [(ref, OrderedDict(fields)) for ref, fields in p.items()], 'info': info, 'files': files,
+                                   'warnings': warnings}, separators=(',', ':')))
+
+
+def read_boms(eda_name, in_file, ignore_fields, variant, dist_list, split_extra_fields):
+    ''' Reads all the BoM files, in parallel when possible.
+        Returns a list with the parts and project information for each file, in the same order used by `in_file`. '''
+    c_files = len(in_file)
+    args = list(zip(eda_name, in_file, [ignore_fields] * c_files, variant, [dist_list] * c_files, [split_extra_fields] * c_files))
+    results = [None] * c_files
+    keys = [None] * c_files
+    if bom_cache is not None:
+        for i, a in enumerate(args):
+            keys[i] = bom_cache_key(*a)
+            results[i] = bom_cache_get(keys[i])
+    # Read the files not found in the cache
+    pending = [i for i, r in enumerate(results) if r is None]
+    pool = process_pool(len(pending))
+    if pool is None:
+        read = [read_bom(*args[i]) for i in pending]
+    else:
+        with pool:
+            read = list(pool.map(read_bom, *zip(*[args[i] for i in pending])))
+    for i, r in zip(pending, read):
+        results[i] = r
+        if bom_cache is not None:
+            bom_cache_put(keys[i], r)
+    if bom_cache is not None:
+        bom_cache.flush()
+    return [(p, info) for p, info, _ in results]
 
 
 def kicost(in_file, eda_name, out_filename, user_fields, ignore_fields, group_fields, translate_fields, variant, dist_list, collapse_refs=True,
            suppress_cat_url=True, currency=DEFAULT_CURRENCY, max_column_width=DEF_MAX_COLUMN_W, split_extra_fields=[],
-           board_qty=[Spreadsheet.DEFAULT_BUILD_QTY]):
+           board_qty=[Spreadsheet.DEFAULT_BUILD_QTY], incremental=None, incremental_ttl=DEFAULT_CACHE_TTL):
     ''' @brief Run KiCost.
 
     Take a schematic input file and create an output file with a cost spreadsheet in xlsx format.
@@ -103,6 +209,10 @@ def kicost(in_file, eda_name, out_filename, user_fields, ignore_fields, group_fi
     @param max_column_width `int()` The maximum column width. If 0 disables cell size adjust. Default: DEF_MAX_COLUMN_W
     @param split_extra_fields `list(str())` Fields that will be split using the multipart mechanism.
     @param board_qty `list(int())` Board quantities for each project.
+    @param incremental `str()` File used to keep the distributors data between runs, only the new or changed parts are queried.
+    Default `None` (query all the parts).
+    @param incremental_ttl `float()` Hours to keep the data stored in the `incremental` file. If 0 it never expires.
+    Default: DEFAULT_CACHE_TTL
     '''
     # Add or remove field translations, ignore in case the trying to
     # re-translate default field names.
@@ -154,9 +264,7 @@ def kicost(in_file, eda_name, out_filename, user_fields, ignore_fields, group_fi
     # Get groups of identical parts.
     parts = OrderedDict()
     prj_info = list()
-    for i_prj in range(c_files):
-        p, info = get_part_groups(eda_name[i_prj], in_file[i_prj], ignore_fields, variant[i_prj], dist_list)
-        p = subpartqty_split(p, dist_list, split_extra_fields)
+    for i_prj, (p, info) in enumerate(read_boms(eda_name, in_file, ignore_fields, variant, dist_list, split_extra_fields)):
         if c_files > 1:
             # In the case of multiple BOM files, add the project prefix identifier
             # to each reference/designator. Use the field 'manf#_qty' to set
@@ -222,7 +330,14 @@ def kicost(in_file, eda_name, out_filename, user_fields, ignore_fields, group_fi
     if logger.isEnabledFor(DEBUG_DETAILED):
         logger.log(DEBUG_DETAILED, 'Distributors: ' + pprint.pformat(dist_list))
     # Get the distributor pricing/qty/etc for each part.
-    query_part_info(parts, dist_list, currency)
+    if incremental:
+        # Reuse the data from the previous run for the groups that didn't change
+        previous = PreviousRun(incremental, dist_list, currency, [api.name for api in get_registered_apis() if api.enabled],
+                               incremental_ttl)
+        query_part_info(parts, dist_list, currency, previous.restore(parts))
+        previous.save(parts)
+    else:
+        query_part_info(parts, dist_list, currency)
 
     # Create the part pricing spreadsheet.
     create_spreadsheet(parts, prj_info, out_filename, dist_list, currency, collapse_refs, suppress_cat_url,
@@ -231,20 +346,14 @@ def kicost(in_file, eda_name, out_filename, user_fields, ignore_fields, group_fi
     # Print component groups for debugging purposes.
     if logger.isEnabledFor(DEBUG_DETAILED):
         for part in parts:
-            for f in dir(part):
-                if f.startswith('__'):
-                    continue
-                elif f.startswith('html_trees'):
-                    continue
-                else:
-                    head = '{} = '.format(f)
-                    try:
-                        logger.log(DEBUG_DETAILED, head + pprint.pformat(part.__dict__[f]))
-                    except TypeError:
-                        # Python 2.7 pprint has some problem ordering None and strings.
-                        logger.log(DEBUG_DETAILED, head + str(part.__dict__[f]))
-                    except KeyError:
-                        pass
+            for f in sorted(part.__slots__):
+                head = '{} = '.format(f)
+                value = getattr(part, f)
+                try:
+                    logger.log(DEBUG_DETAILED, head + pprint.pformat(value))
+                except TypeError:
+                    # Python 2.7 pprint has some problem ordering None and strings.
+                    logger.log(DEBUG_DETAILED, head + str(value))
             logger.log(DEBUG_DETAILED, '')
 
 
@@ -77,8 +77,9 @@ libreoffice_executable = None
 # Open file definitions.
 FILE_HIST_QTY_DEFAULT = 10
 SEP_FILES = '\n'  # File separator in the comboBox.
-WILDCARD_BOM = "BOM compatible formats (*.xml,*.csv)|*.xml;*.csv|"\
+WILDCARD_BOM = "BOM compatible formats (*.xml,*.csv,*.kicad_sch)|*.xml;*.csv;*.kicad_sch|"\
             "KiCad/Altium BOM file (*.xml)|*.xml|" \
+            "KiCad schematic (*.kicad_sch)|*.kicad_sch|" \
             "Proteus/Generic BOM file (*.csv)|*.csv"
 
 # save settings definitions.
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+# MIT license
+#
+# Copyright (c) 2021 KiCost authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Fast S-expression reader
+
+A replacement for `sexpdata.loads` suitable for big files (i.e. KiCad schematics and libraries).
+All the tokens are obtained by a single regex, no objects are created for them.
+The differences with `sexpdata` are:
+- Symbols are returned as `str`, not `Symbol` objects.
+- No support for quoted expressions (`'a`), square brackets or comments. KiCad doesn't use them.
+"""
+import re
+
+__all__ = ['loads', 'iterloads', 'tokenize', 'SExpError']
+
+# Each token is a tuple: (open, close, string, integer, real, symbol, error). Only one of them is not empty.
+# The string includes the quotes, so the empty string isn't an empty token.
+TOKEN_RE = re.compile(r'''\s*(?:(\()|(\))|("[^"\\]*(?:\\.[^"\\]*)*")|'''
+                      r'''([-+]?\d+)(?![^\s()"])|'''
+                      r'''([-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)(?![^\s()"])|'''
+                      r'''((?:[^\s()"\\]|\\.)[^\s()"\\]*(?:\\.[^\s()"\\]*)*)|(\S))''', re.S)
+ESCAPE_RE = re.compile(r'\\.', re.S)
+STRING_ESCAPES = {'\\\\': '\\', '\\"': '"', '\\b': '\b', '\\f': '\f', '\\n': '\n', '\\r': '\r', '\\t': '\t'}
+CHUNK_SIZE = 1024*1024
+
+
+class SExpError(ValueError):
+    ''' Malformed S-expression '''
+    pass
+
+
+def unescape_string(m):
+    return STRING_ESCAPES.get(m.group(), m.group())
+
+
+def unescape_symbol(m):
+    return m.group()[1]
+
+
+def tokenize(string):
+    ''' List of tokens for the string, see `TOKEN_RE` '''
+    return TOKEN_RE.findall(string)
+
+
+def parse_tokens(chunks, nil='nil', true='t', false=None):
+    ''' Generator for the top level expressions, `chunks` is an iterable of lists of tokens '''
+    stack = []
+    cur = None
+    for tokens in chunks:
+        for open_, close, string, integer, real, symbol, error in tokens:
+            if open_:
+                stack.append(cur)
+                cur = []
+                continue
+            if close:
+                if not stack:
+                    raise SExpError('Unexpected `)`')
+                value = cur
+                cur = stack.pop()
+            elif symbol:
+                if symbol == nil:
+                    value = []
+                elif symbol == true:
+                    value = True
+                elif symbol == false:
+                    value = False
+                else:
+                    value = ESCAPE_RE.sub(unescape_symbol, symbol) if '\\' in symbol else symbol
+            elif string:
+                value = ESCAPE_RE.sub(unescape_string, string[1:-1]) if '\\' in string else string[1:-1]
+            elif integer:
+                value = int(integer)
+            elif real:
+                value = float(real)
+            else:
+                raise SExpError('Unexpected `{}`'.format(error))
+            if cur is None:
+                yield value
+            else:
+                cur.append(value)
+    if stack:
+        raise SExpError('Missing `)`')
+
+
+def loads(string, **kwds):
+    ''' Load an object from the S-expression `string`.
+        The `nil`, `true` and `false` keywords are the same used by `sexpdata.loads` '''
+    values = list(parse_tokens([tokenize(string)], **kwds))
+    if len(values) != 1:
+        raise SExpError('Expected one expression, found {}'.format(len(values)))
+    return values[0]
+
+
+def read_tokens(filelike, chunk_size):
+    ''' Generator for the tokens of a text stream, in chunks that end at a line boundary '''
+    pending = ''
+    while True:
+        data = filelike.read(chunk_size)
+        if not data:
+            if pending:
+                yield tokenize(pending)
+            return
+        pending += data
+        cut = pending.rfind('\n') + 1
+        if not cut:
+            continue
+        tokens = tokenize(pending[:cut])
+        if any(t[6] for t in tokens):
+            # A string with a new line inside, wait for the rest
+            continue
+        yield tokens
+        pending = pending[cut:]
+
+
+def iterloads(filelike, chunk_size=CHUNK_SIZE, **kwds):
+    ''' Generator for the top level expressions found in a text stream.
+        The stream is read in chunks, so the whole file doesn't need to be in memory.
+        The `nil`, `true` and `false` keywords are the same used by `sexpdata.loads` '''
+    return parse_tokens(read_tokens(filelike, chunk_size), **kwds)
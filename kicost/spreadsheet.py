@@ -44,7 +44,7 @@ from validators import url as validate_url  # URL validator.
 # KiCost libraries.
 from .version import __version__  # Version control by @xesscorp and collaborator.
 from .distributors import get_distributor_info, ORDER_COL_USERFIELDS
-from .edas.tools import partgroup_qty, order_refs, PART_REF_REGEX
+from .edas.tools import partgroup_qty, order_refs, parse_ref
 from . import DistData
 
 from .currency_converter import CurrencyConverter, get_currency_symbol, format_currency
@@ -589,11 +589,10 @@ def create_worksheet(ss, logger, parts):
 
 def get_ref_key(part):
     ''' Helper function to sort the references '''
-    match = PART_REF_REGEX.match(part.first_ref)
-    if not match:
+    prj_prefix, prefix, num, ref_num, subpart_num = parse_ref(part.first_ref)
+    if not num:
         return [part.collapsed_refs, 0, 0]
-    subpart_num = match.group('subpart_num')
-    return [match.group('prefix'), int(match.group('ref_num')), int(subpart_num) if subpart_num else 0]
+    return [(prj_prefix or '') + prefix, ref_num, subpart_num or 0]
 
 
 def add_globals_to_worksheet(ss, logger, start_row, start_col, total_cost_row, parts, dist_list):
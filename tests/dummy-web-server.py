@@ -42,13 +42,23 @@ OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 """
 import argparse
+import json
+import os
 import os.path as op
 import sys
-from urllib.parse import unquote
+from urllib.parse import unquote, parse_qsl
 from http.server import HTTPServer, BaseHTTPRequestHandler
 queries = {}
 queries_octo = {}
 comments = {}
+# The replies for each part found in the recorded batches, for each test (the comment before the batches).
+# KiCost sends each distinct part only once, so the batches it sends can be different from the recorded ones.
+# In this case the reply is composed using the replies recorded for one test.
+parts_kitspace = {}
+parts_octo = {}
+# Used to test the retries: the first time we get a query we answer "429 Too Many Requests"
+busy = os.environ.get('DUMMY_SERVER_BUSY')
+busy_seen = set()
 
 
 class S(BaseHTTPRequestHandler):
@@ -65,8 +75,21 @@ class S(BaseHTTPRequestHandler):
         content = "<html><body><h1>{}</h1></body></html>".format(message)
         return content.encode("utf8")  # NOTE: must return a bytes object!
 
+    def _busy(self, query):
+        if not busy or query in busy_seen:
+            return False
+        busy_seen.add(query)
+        self.send_response(429)
+        self.send_header("Retry-After", "0")
+        self.end_headers()
+        print("Busy reply")
+        sys.stdout.flush()
+        return True
+
     def do_GET(self):
         get_data = unquote(self.path)[2:]
+        if self._busy(get_data):
+            return
         self._set_headers()
         if get_data in queries_octo:
             self.wfile.write(queries_octo[get_data].encode("utf8"))
@@ -77,9 +100,14 @@ class S(BaseHTTPRequestHandler):
                 self.wfile.write(queries_octo[get_data].encode("utf8"))
                 print("Known query (7E replaced) "+comments[get_data])
             else:
-                print('Unknown query, {}'.format(get_data))
-                content = "<html><body><h1>GET!</h1><pre>{}</pre></body></html>".format(get_data)
-                self.wfile.write(content.encode("utf8"))
+                reply = compose_octo(get_data)
+                if reply is not None:
+                    self.wfile.write(reply.encode("utf8"))
+                    print("Composed octo query")
+                else:
+                    print('Unknown query, {}'.format(get_data))
+                    content = "<html><body><h1>GET!</h1><pre>{}</pre></body></html>".format(get_data)
+                    self.wfile.write(content.encode("utf8"))
         sys.stdout.flush()
 
     def do_HEAD(self):
@@ -88,6 +116,8 @@ class S(BaseHTTPRequestHandler):
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])  # <--- Gets the size of data
         post_data = self.rfile.read(content_length).decode('utf8')  # <--- Gets the data itself
+        if self._busy(post_data):
+            return
         self._set_headers()
         if post_data in queries:
             self.wfile.write(queries[post_data].encode("utf8"))
@@ -98,13 +128,101 @@ class S(BaseHTTPRequestHandler):
                 self.wfile.write(queries[post_data].encode("utf8"))
                 print("Known query (7E replaced) "+comments[post_data])
             else:
-                data = unquote(post_data.replace('+', ' '))
-                print('Unknown query, len={}\n{}\n{}'.format(content_length, post_data, data))
-                content = "<html><body><h1>POST!</h1><pre>{}</pre></body></html>".format(post_data)
-                self.wfile.write(content.encode("utf8"))
+                reply = compose_kitspace(post_data)
+                if reply is not None:
+                    self.wfile.write(reply.encode("utf8"))
+                    print("Composed query")
+                else:
+                    data = unquote(post_data.replace('+', ' '))
+                    print('Unknown query, len={}\n{}\n{}'.format(content_length, post_data, data))
+                    content = "<html><body><h1>POST!</h1><pre>{}</pre></body></html>".format(post_data)
+                    self.wfile.write(content.encode("utf8"))
         sys.stdout.flush()
 
 
+def split_kitspace(query):
+    """ Returns the GraphQL query and the list of parts for a KitSpace query """
+    data = dict(parse_qsl(query))
+    return data['query'], json.loads(data['variables'])['input']
+
+
+def split_octo(query):
+    """ Returns the options and the list of parts for an Octopart query """
+    parts, end = json.JSONDecoder().raw_decode(query, len('queries='))
+    return query[end:], parts
+
+
+def part_key(options, part):
+    """ Identifies a part query, the Octopart reference isn't included """
+    return options + json.dumps({k: v for k, v in part.items() if k != 'reference'}, sort_keys=True)
+
+
+def find_replies(index, options, keys):
+    """ The replies for all the `keys`, taken from the recordings of one test.
+        KiCost splits the list of distinct parts in batches, so we prefer the test where `keys` is one of these batches """
+    if not keys:
+        return []
+    found = [replies for replies in index.values() if all(k in replies for k in keys)]
+    for replies in found:
+        order = [k for k in replies if k.startswith(options)]
+        n = len(keys)
+        i = order.index(keys[0])
+        if order[i:i+n] == keys and (i % n == 0 or i+n == len(order)):
+            break
+    else:
+        if not found:
+            return None
+        replies = found[0]
+    return [replies[k] for k in keys]
+
+
+def index_kitspace(test, query, reply):
+    try:
+        options, parts = split_kitspace(query)
+        matches = json.loads(reply)['data']['match']
+    except (KeyError, TypeError, ValueError):
+        return
+    if len(matches) == len(parts):
+        replies = parts_kitspace.setdefault(test, {})
+        for part, match in zip(parts, matches):
+            replies.setdefault(part_key(options, part), match)
+
+
+def compose_kitspace(query):
+    try:
+        options, parts = split_kitspace(query.replace('%7E', '~'))
+    except (KeyError, TypeError, ValueError):
+        return None
+    matches = find_replies(parts_kitspace, options, [part_key(options, part) for part in parts])
+    if matches is None:
+        return None
+    return json.dumps({'data': {'match': matches}})
+
+
+def index_octo(test, query, reply):
+    try:
+        options, parts = split_octo(query)
+        results = {r['reference']: r for r in json.loads(reply)['results']}
+    except (KeyError, TypeError, ValueError):
+        return
+    replies = parts_octo.setdefault(test, {})
+    for part in parts:
+        result = results.get(part.get('reference'))
+        if result is not None:
+            replies.setdefault(part_key(options, part), result)
+
+
+def compose_octo(query):
+    try:
+        options, parts = split_octo(query)
+    except (KeyError, TypeError, ValueError):
+        return None
+    results = find_replies(parts_octo, options, [part_key(options, part) for part in parts])
+    if results is None:
+        return None
+    return json.dumps({'results': [dict(r, reference=p['reference']) for p, r in zip(parts, results)]})
+
+
 def load_queries(file):
     global queries
     with open(file, 'rt') as f:
@@ -127,6 +245,7 @@ def load_queries(file):
                 # print(len(query))
                 queries[query] = line
                 comments[query] = '{} ({})'.format(last_comment, id)
+                index_kitspace(last_comment, query, line)
                 id += 1
                 is_query = True
 
@@ -149,6 +268,7 @@ def load_octo_queries(file):
             elif line[0] == '}':
                 queries_octo[query] = reply + line
                 comments[query] = '{} ({})'.format(last_comment, id)
+                index_octo(last_comment, query, reply + line)
                 id += 1
                 is_query = True
             else:
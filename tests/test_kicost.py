@@ -39,8 +39,30 @@ import os
 import re
 import sys
 import shutil
+import json
+import pickle
+import multiprocessing
+import threading
+import requests
+from collections import OrderedDict
 import xml.etree.ElementTree as ET
-from kicost.global_vars import ERR_FIELDS
+from kicost.global_vars import ERR_FIELDS, ERR_INPUTFILE, KiCostError, set_logger
+# Some modules get the logger when imported, as in __main__.py
+set_logger(logging.getLogger())
+from kicost.edas import file_eda_match  # noqa: E402
+from kicost import sexp, sexpdata  # noqa: E402
+from kicost.edas.eda import FieldsOverlay  # noqa: E402
+from kicost.edas import kicad_sch, eda  # noqa: E402
+from kicost.edas.tools import group_parts, process_pool, order_refs, parse_ref  # noqa: E402
+from kicost.kicost import read_boms, set_bom_cache  # noqa: E402
+from kicost.cache import PersistentCache  # noqa: E402
+from kicost.edas import set_edas_logger  # noqa: E402
+from kicost import PartGroup, DistData  # noqa: E402
+from kicost.distributors.distributor import distributor_class  # noqa: E402
+from kicost.distributors.api_partinfo_kitspace import api_partinfo_kitspace  # noqa: E402
+from kicost.distributors import init_distributor_dict, set_distributors_logger, set_distributors_progress, HttpRecorder  # noqa: E402
+from kicost.distributors.rate_limit import QueryBudget  # noqa: E402
+from kicost.incremental import PreviousRun  # noqa: E402
 
 # Author information.
 __author__ = 'Salvador Eduardo Tropea'
@@ -270,7 +292,7 @@ def check_diff(filename):
         raise
 
 
-def run_test(name, inputs, output, extra=None, price=True, ret_err=0):
+def run_test(name, inputs, output, extra=None, price=True, ret_err=0, cache=False):
     if not os.path.isdir(TESTDIR + '/result_test'):
         os.mkdir(TESTDIR + '/result_test')
     if not os.path.isdir(TESTDIR + '/log_test'):
@@ -294,6 +316,8 @@ def run_test(name, inputs, output, extra=None, price=True, ret_err=0):
         server = subprocess.Popen(TESTDIR + '/dummy-web-server.py', stdout=fo, stderr=fe)
     # Run KiCost
     cmd = ['src/kicost', '--debug', '10']
+    if not cache:
+        cmd.append('--no_cache')
     if not price:
         cmd.append('--no_price')
     if extra:
@@ -332,7 +356,7 @@ def run_test(name, inputs, output, extra=None, price=True, ret_err=0):
     logging.info(output+' OK')
 
 
-def run_test_check(name, inputs=None, output=None, extra=None, price=True, ret_err=0):
+def run_test_check(name, inputs=None, output=None, extra=None, price=True, ret_err=0, cache=False):
     logging.debug('Test name: ' + name)
     if inputs is None:
         inputs = name
@@ -342,7 +366,7 @@ def run_test_check(name, inputs=None, output=None, extra=None, price=True, ret_e
         output = inputs[0]
         if output.endswith('.csv'):
             output = output[:-4]
-    run_test(name, inputs, output, extra, price, ret_err)
+    run_test(name, inputs, output, extra, price, ret_err, cache)
 
 
 def check_errors(errors):
@@ -576,6 +600,11 @@ def test_scrape_over_2():
     run_test_check('scrape_over_2', 'scrape_over', 'scrape_over_2', extra=['--exclude', 'rs'])
 
 
+def test_scrape_over_serial():
+    # Same as test_scrape_over_1, but running the APIs one after the other
+    run_test_check('scrape_over_serial', 'scrape_over', 'scrape_over', extra=['--parallel_queries', '1'])
+
+
 def test_manf_no_manf_num():
     # Two similar parts, but from different manufacturer and no manf#
     # Issue #474
@@ -668,11 +697,543 @@ def test_octopart_2n():
     run_test_check(name + 'n', name, name + 'n', extra=['--octopart_key', OCTOPART_KEY, '--octopart_level', '4'])
 
 
+def test_octopart_budget():
+    # Same as test_octopart_1n, but limiting the queries
+    name = 'octopart_1'
+    cache_dir = TESTDIR + '/cache_test'
+    os.environ['KICOST_CACHE_DIR'] = cache_dir
+    try:
+        extra = ['--octopart_key', OCTOPART_KEY, '--octopart_level', '4', '--octopart_rate', '100', '--octopart_budget', '10', '1000']
+        run_test_check(name + 'n (budget)', name, name + 'n', extra=extra)
+        with open(TESTDIR + '/log_test/' + name + 'n_out.log', 'rt') as f:
+            assert re.search(r'Octopart budget left for today: 9 requests and 9\d\d parts', f.read())
+        # The usage is stored for the key, without the key
+        budget_files = [f for f in os.listdir(cache_dir) if f.endswith('_budget.json')]
+        assert budget_files == [os.path.basename(QueryBudget('Octopart', key=OCTOPART_KEY).file_name)]
+        assert OCTOPART_KEY not in budget_files[0]
+    finally:
+        del os.environ['KICOST_CACHE_DIR']
+        shutil.rmtree(cache_dir)
+
+
+def test_budget_keys():
+    # Each key has its own budget and the replayed responses don't use it
+    budget_dir = TESTDIR + '/budget_test'
+    try:
+        budget_a = QueryBudget('Octopart', requests=1, path=budget_dir, key='KEY_A')
+        budget_b = QueryBudget('Octopart', requests=1, path=budget_dir, key='KEY_B')
+        assert budget_a.reserve([1]) == 1
+        assert budget_b.reserve([1]) == 1
+        assert QueryBudget('Octopart', requests=1, path=budget_dir, key='KEY_A').reserve([1]) == 0
+
+        class FakeApi(object):
+            name = 'Fake'
+            budget = QueryBudget('Fake', requests=1, path=budget_dir)
+
+        class FakeReplay(object):
+            replay = True
+
+        old = distributor_class.recorder
+        distributor_class.recorder = FakeReplay()
+        try:
+            assert distributor_class.budget_batches(FakeApi, [[1], [2]]) == [[1], [2]]
+        finally:
+            distributor_class.recorder = old
+        assert FakeApi.budget.remaining() == (1, None)
+    finally:
+        if os.path.isdir(budget_dir):
+            shutil.rmtree(budget_dir)
+
+
+def test_unique_queries():
+    # Each distinct MPN/SKU is asked only once
+    unique, index = distributor_class.unique_queries(['A', 'B', 'A', 'C 1', 'C1'], lambda q: q.replace(' ', ''))
+    assert unique == ['A', 'B', 'C 1']
+    assert index == [0, 1, 0, 2, 2]
+
+    # The result of each query is used by all the parts that asked for it
+    class NoProgress(object):
+        def __init__(self, total, logger):
+            pass
+
+        def update(self, n):
+            pass
+
+        def close(self):
+            pass
+    set_distributors_logger(logging.getLogger())
+    set_distributors_progress(NoProgress)
+    init_distributor_dict()
+    parts = []
+    for ref, field, code in (('R1', 'manf#', 'RC1'), ('R2', 'manf#', 'RC1'), ('R3', 'digikey#', 'DK1'),
+                             ('R4', 'digikey#', 'DK1'), ('R5', 'manf#', 'RC2')):
+        part = PartGroup()
+        part.refs = [ref]
+        part.fields = OrderedDict([(field, code)])
+        parts.append(part)
+    sent = []
+
+    def get_part_info(queries, distributors):
+        sent.extend(queries)
+        return [{'datasheet': q, 'specs': [], 'offers': []} for q in queries]
+    old = api_partinfo_kitspace.get_part_info
+    api_partinfo_kitspace.get_part_info = staticmethod(get_part_info)
+    try:
+        api_partinfo_kitspace.query_part_info(parts, ['digikey'], 'USD')
+    finally:
+        api_partinfo_kitspace.get_part_info = old
+    assert len(sent) == 3
+    assert all(sent.count(q) == 1 for q in sent)
+    for part in parts:
+        code = list(part.fields.values())[0]
+        assert '"' + code + '"' in part.datasheet, (part.refs, part.datasheet)
+    assert parts[0].datasheet == parts[1].datasheet and parts[2].datasheet == parts[3].datasheet
+
+
 def test_337():
     # Test for issue #337
     run_test_check('test_337_UserFieldCombining', extra=['--field', 'Supplier'], price=False)
 
 
+def test_cache_1():
+    # The second run must get the same results using the data stored in the cache
+    cache_dir = TESTDIR + '/cache_test'
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.environ['KICOST_CACHE_DIR'] = cache_dir
+    try:
+        run_test_check('cache_1 (store)', 'test', cache=True)
+        check_errors([r'Cache `queries`: 0 hits, [1-9]\d* misses', r'Cache `boms`: 0 hits, 1 misses'])
+        run_test_check('cache_1 (use)', 'test', cache=True)
+        check_errors([r'Cache `queries`: [1-9]\d* hits, 0 misses', r'Cache `boms`: 1 hits, 0 misses'])
+    finally:
+        del os.environ['KICOST_CACHE_DIR']
+        shutil.rmtree(cache_dir)
+
+
+def test_cache_warnings():
+    # The warnings reported reading a BoM are reported again when it's taken from the cache
+    cache_dir = TESTDIR + '/cache_warnings_test'
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.environ['KICOST_CACHE_DIR'] = cache_dir
+    try:
+        run_test_check('cache_warnings (store)', 'no_empty_overwrite', price=False, cache=True)
+        check_errors([r'Cache `boms`: 0 hits, 1 misses', r'in C3 overwriting manf#=XXXX with mpn=YYYY'])
+        run_test_check('cache_warnings (use)', 'no_empty_overwrite', price=False, cache=True)
+        check_errors([r'Cache `boms`: 1 hits, 0 misses', r'in C3 overwriting manf#=XXXX with mpn=YYYY'])
+    finally:
+        del os.environ['KICOST_CACHE_DIR']
+        shutil.rmtree(cache_dir)
+
+
+def test_bom_cache_order():
+    # The parts and fields read from the cache must keep the order of the BoM
+    set_edas_logger(logging.getLogger())
+    cache_dir = TESTDIR + '/bom_cache_test'
+    cache = PersistentCache('boms', ttl=0, path=cache_dir)
+    found = []
+
+    def cache_get(key):
+        data = PersistentCache.get(cache, key)
+        found.append(data is not None)
+        return data
+    cache.get = cache_get
+    set_bom_cache(cache)
+    try:
+        read = []
+        for _ in range(2):
+            p, info = read_boms(['kicad'], [TESTDIR + '/acquire-PWM.xml'], [], [''], ['digikey'], [])[0]
+            read.append([(ref, list(fields.items())) for ref, fields in p.items()])
+        assert found == [False, True]
+        assert read[1] == read[0]
+        assert all(isinstance(fields, OrderedDict) for fields in p.values())
+    finally:
+        set_bom_cache(None)
+        cache.close()
+        shutil.rmtree(cache_dir)
+
+
+def test_record_replay_1():
+    # The second run must get the same results using the recorded responses
+    record_dir = TESTDIR + '/record_test'
+    if os.path.isdir(record_dir):
+        shutil.rmtree(record_dir)
+    try:
+        run_test_check('record_1 (record)', 'test', extra=['--record', record_dir])
+        check_errors([r'HTTP recorder: [1-9]\d* responses recorded'])
+        run_test_check('record_1 (replay)', 'test', extra=['--replay', record_dir])
+        check_errors([r'HTTP recorder: [1-9]\d* responses replayed'])
+    finally:
+        shutil.rmtree(record_dir)
+
+
+def test_record_apikey():
+    # The API key isn't recorded and the recordings can be replayed using another key
+    record_dir = TESTDIR + '/record_key_test'
+    url = 'http://localhost:8000/parts/match?queries=[{"mpn":"RC1"}]&apikey=' + OCTOPART_KEY + '&include[]=specs'
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = b'{"results": []}'
+    try:
+        recorder = HttpRecorder(record_dir)
+        recorder.put('GET', url, {'apikey': OCTOPART_KEY, 'q': 'RC1'}, response)
+        recorder.flush()
+        for root, dirs, files in os.walk(record_dir):
+            for name in files:
+                with open(os.path.join(root, name), 'rt') as f:
+                    assert OCTOPART_KEY not in f.read()
+        other_key = url.replace(OCTOPART_KEY, 'yyyyyyyy-yyyy-yyyy-yyyy-yyyyyyyyyyyy')
+        replayed = HttpRecorder(record_dir, replay=True).get('GET', other_key, {'apikey': 'other', 'q': 'RC1'})
+        assert replayed.text == '{"results": []}'
+    finally:
+        if os.path.isdir(record_dir):
+            shutil.rmtree(record_dir)
+
+
+def test_incremental_1():
+    # The second run must get the same results reusing the data from the first
+    state_file = TESTDIR + '/incremental_test.json'
+    if os.path.isfile(state_file):
+        os.remove(state_file)
+    try:
+        run_test_check('incremental_1 (first)', 'test', extra=['--incremental', state_file])
+        total = int(check_errors([r'Incremental pricing: 0 parts reused, ([1-9]\d*) parts to query'])[0].group(1))
+        with open(state_file, 'rt') as f:
+            stored = json.load(f)['parts']
+        # Only the groups with distributors data are stored, the rest is queried again
+        assert 0 < len(stored) < total
+        assert all(p['dd'] for p in stored.values())
+        run_test_check('incremental_1 (second)', 'test', extra=['--incremental', state_file])
+        check_errors([r'Incremental pricing: {} parts reused, {} parts to query'.format(len(stored), total - len(stored))])
+    finally:
+        os.remove(state_file)
+
+
+def test_incremental_ttl():
+    # The data from the previous run expires, the restored groups keep the time of the original query
+    state_file = TESTDIR + '/incremental_ttl_test.json'
+    if os.path.isfile(state_file):
+        os.remove(state_file)
+
+    def make_parts():
+        parts = []
+        for manf in ('RC1', 'RC2'):
+            part = PartGroup()
+            part.fields = OrderedDict([('manf#', manf)])
+            part.dd = {}
+            part.specs = {}
+            parts.append(part)
+        return parts
+    try:
+        previous = PreviousRun(state_file, ['digikey'], 'USD', ['KitSpace'], ttl=1)
+        parts = make_parts()
+        assert previous.restore(parts) == parts
+        # RC2 wasn't found (or was skipped by the budget)
+        parts[0].dd['digikey'] = DistData()
+        previous.save(parts)
+        previous = PreviousRun(state_file, ['digikey'], 'USD', ['KitSpace'], ttl=1)
+        parts = make_parts()
+        assert previous.restore(parts) == [parts[1]]
+        assert 'digikey' in parts[0].dd
+        # Two hours later RC1 is too old, even when saved again by the last run
+        previous.save(parts)
+        with open(state_file, 'rt') as f:
+            data = json.load(f)
+        for p in data['parts'].values():
+            p['stamp'] -= 7200
+        with open(state_file, 'wt') as f:
+            json.dump(data, f)
+        parts = make_parts()
+        assert PreviousRun(state_file, ['digikey'], 'USD', ['KitSpace'], ttl=1).restore(parts) == parts
+        # A TTL of 0 never expires
+        parts = make_parts()
+        assert PreviousRun(state_file, ['digikey'], 'USD', ['KitSpace'], ttl=0).restore(parts) == [parts[1]]
+    finally:
+        if os.path.isfile(state_file):
+            os.remove(state_file)
+
+
+def test_retry_1():
+    # The server asks us to wait, the queries must be retried
+    os.environ['DUMMY_SERVER_BUSY'] = '1'
+    try:
+        run_test_check('retry_1', 'test')
+        check_errors([r'Query to `localhost:8000` failed \(status code 429\), retrying in 0.0 s'])
+    finally:
+        del os.environ['DUMMY_SERVER_BUSY']
+
+
+def test_altium_1():
+    # Altium XML BoM
+    run_test_check('altium_1', 'altium_1.xml', 'altium_1', extra=['--eda', 'altium'], price=False)
+
+
+def test_eda_detection():
+    # Only the beginning and the end of the files are used
+    assert file_eda_match(os.path.join(TESTDIR, 'altium_1.xml')) == 'altium'
+    assert file_eda_match(os.path.join(TESTDIR, 'safelink_receiver.xml')) == 'kicad'
+    assert file_eda_match(os.path.join(TESTDIR, 'part_list_small.csv')) == 'csv'
+    assert file_eda_match(os.path.join(TESTDIR, 'kicad_sch_1.kicad_sch')) == 'kicad'
+
+
+def test_kicad_sch_1():
+    # KiCad 6 schematic, the same sub-sheet used twice
+    run_test_check('kicad_sch_1', 'kicad_sch_1.kicad_sch', 'kicad_sch_1', price=False)
+
+
+def test_kicad_sch_cache():
+    # The cache of parsed sheets is bounded, the sheets of the hierarchy are found even when it gets full
+    root = os.path.join(TESTDIR, 'kicad_sch_1.kicad_sch')
+    kicad_sch.sheets_cache.clear()
+    expected = kicad_sch.read_sheets(root)
+    old = kicad_sch.SHEETS_CACHE_SIZE
+    kicad_sch.SHEETS_CACHE_SIZE = 1
+    try:
+        kicad_sch.sheets_cache.clear()
+        assert kicad_sch.read_sheets(root) == expected
+        assert len(kicad_sch.sheets_cache) <= 1
+        # Now using the cached sheet
+        assert kicad_sch.read_sheets(root) == expected
+        assert len(kicad_sch.sheets_cache) <= 1
+    finally:
+        kicad_sch.SHEETS_CACHE_SIZE = old
+        kicad_sch.sheets_cache.clear()
+
+
+def test_order_refs():
+    # Only 3 or more sequential numbers are collapsed, subparts and refs without number are never part of a range
+    assert parse_ref('prj1:R10') == ('prj1:', 'R', '10', 10, None)
+    assert parse_ref('CONN1#3') == (None, 'CONN', '1#3', 1, 3)
+    assert order_refs(['C10', 'C2', 'C1', 'C3']) == ('C1-C3,C10', 'C1')
+    assert order_refs(['R1', 'R2', 'R3', 'R5', 'R6']) == ('R1-R3,R5,R6', 'R1')
+    assert order_refs(['J1#1', 'J1#2', 'J2', 'J3', 'J4']) == ('J1#1,J1#2,J2-J4', 'J1#1')
+    assert order_refs(['U1#1', 'U1#2', 'U1#3']) == ('U1#1,U1#2,U1#3', 'U1#1')
+    assert order_refs(['TP', 'R1', 'R2', 'R3', 'TP']) == ('TP,TP,R1-R3', 'TP')
+    assert order_refs(['H', 'H1', 'H2', 'H3']) == ('H,H1-H3', 'H')
+    # A repeated ref doesn't fill a gap (U4 isn't used)
+    assert order_refs(['U3', 'U3', 'U5']) == ('U3,U3,U5', 'U3')
+    assert order_refs(['U3', 'U4', 'U5']) == ('U3-U5', 'U3')
+    assert order_refs(['C10', 'C2', 'C1', 'C3'], collapse=False) == ('C1,C2,C3,C10', 'C1')
+    # Multiproject refs, one line for each project
+    assert order_refs(['prj0:R1', 'prj0:R2', 'prj0:R3', 'prj1:R1']) == ('prj0:R1-R3\nprj1:R1', 'R1')
+
+
+def test_sexp():
+    # The fast reader must return the same as sexpdata, but using `str` for the symbols
+    def to_str(value):
+        if isinstance(value, list):
+            return [to_str(v) for v in value]
+        return value.value() if isinstance(value, sexpdata.Symbol) else value
+    assert sexp.loads('(a "b c" 1 -2 3.5 1e3 "" "q\\"x\\n" nil t)') == ['a', 'b c', 1, -2, 3.5, 1000.0, '', 'q"x\n', [], True]
+    with open(os.path.join(TESTDIR, 'kicad_sch_1.kicad_sch'), 'rt') as f:
+        content = f.read()
+    expected = to_str(sexpdata.loads(content, nil=None, true=None))
+    assert sexp.loads(content, nil=None, true=None) == expected
+    # Small chunks, so the tokens are split
+    with open(os.path.join(TESTDIR, 'kicad_sch_1.kicad_sch'), 'rt') as f:
+        assert list(sexp.iterloads(f, chunk_size=17, nil=None, true=None)) == [expected]
+    for wrong in ('(a', 'a)', '(a "b)', '(a) (b)'):
+        try:
+            sexp.loads(wrong)
+            assert False, wrong
+        except sexp.SExpError:
+            pass
+
+
+class FakeApiA(object):
+    # Fills the quantity and a distributor
+    type = 'api'
+    enabled = True
+
+    @staticmethod
+    def query_part_info(parts, distributors, currency):
+        for part in parts:
+            part.fields['manf#_qty'] = '2'
+            part.fields['desc'] = 'A'
+            dd = part.dd['digikey'] = DistData()
+            dd.part_num = 'A-' + part.fields['manf#']
+
+
+class FakeApiB(object):
+    # Uses the quantity filled by A, doesn't change it
+    type = 'api'
+    enabled = True
+
+    @staticmethod
+    def query_part_info(parts, distributors, currency):
+        for part in parts:
+            part.fields['desc'] = 'B'
+            dd = part.dd['mouser'] = DistData()
+            dd.part_num = 'B-' + part.fields['manf#']
+            dd.qty_avail = int(part.fields.get('manf#_qty', '1'))
+
+
+def test_parallel_apis():
+    # Running the APIs at the same time must give the same result we get running them in sequence
+    def run(workers):
+        parts = []
+        for manf in ('RC1', 'RC2'):
+            part = PartGroup()
+            part.fields = OrderedDict([('manf#', manf), ('desc', 'orig')])
+            parts.append(part)
+        old = (distributor_class.registered, distributor_class.max_workers)
+        distributor_class.registered = [FakeApiA, FakeApiB]
+        distributor_class.max_workers = workers
+        try:
+            distributor_class.get_dist_parts_info(parts, ['digikey', 'mouser'])
+        finally:
+            distributor_class.registered, distributor_class.max_workers = old
+        return [(list(p.fields.items()), sorted((d, dd.part_num, dd.qty_avail) for d, dd in p.dd.items())) for p in parts]
+    sequential = run(1)
+    assert sequential[0] == ([('manf#', 'RC1'), ('desc', 'B'), ('manf#_qty', '2')], [('digikey', 'A-RC1', None), ('mouser', 'B-RC1', 2)])
+    assert run(4) == sequential
+
+
+def test_read_boms_pool():
+    # The BoMs are read by a pool of processes, the errors in the workers must reach us
+    set_edas_logger(logging.getLogger())
+    boms = [TESTDIR + '/acquire-PWM.xml', TESTDIR + '/acquire-PWM_2.xml']
+    empty = TESTDIR + '/empty_bom.csv'
+    open(empty, 'wt').close()
+    old = multiprocessing.cpu_count
+    multiprocessing.cpu_count = lambda: 2
+    try:
+        pool = process_pool(2)
+        if pool is None:
+            logging.warning('No process pool available, reading the BoMs one by one')
+        else:
+            pool.shutdown()
+        sequential = [(list(p.keys()), info['title']) for p, info in [read_boms(['kicad'], [b], [], [''], ['digikey'], [])[0] for b in boms]]
+        assert [(list(p.keys()), info['title']) for p, info in read_boms(['kicad', 'kicad'], boms, [], ['', ''], ['digikey'], [])] == sequential
+        try:
+            read_boms(['kicad', 'csv'], [boms[0], empty], [], ['', ''], ['digikey'], [])
+            assert False, 'No error reading an empty BoM'
+        except KiCostError as e:
+            assert e.id == ERR_INPUTFILE
+            assert 'Empty CSV file' in e.msg
+        # Only where fork is the default start method (not on macOS)
+        old_methods = (multiprocessing.get_start_method, multiprocessing.get_all_start_methods)
+        multiprocessing.get_start_method = lambda allow_none=False: None
+        multiprocessing.get_all_start_methods = lambda: ['spawn', 'fork', 'forkserver']
+        try:
+            assert process_pool(2) is None
+        finally:
+            multiprocessing.get_start_method, multiprocessing.get_all_start_methods = old_methods
+        # Don't fork if other threads are running
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        try:
+            assert process_pool(2) is None
+        finally:
+            stop.set()
+            thread.join()
+    finally:
+        multiprocessing.cpu_count = old
+        os.remove(empty)
+
+
+def test_variant_cache():
+    # The memorized variant filters and decisions are bounded
+    old = eda.VARIANT_CACHE_SIZE
+    eda.VARIANT_CACHE_SIZE = 2
+    try:
+        for variant in ('a', 'b', 'c', 'a'):
+            flt = eda.get_variant_filter(variant)
+            assert len(eda.variant_filters) <= 2
+            for variants in ('a', 'b,c', 'd/e', 'x'):
+                assert flt.match_variants(variants) == (variant in eda.split_variants(variants))
+                assert len(flt.variants) <= 2 and len(eda.variants_lists) <= 2
+            for dnp in ('', '0', '1', 'dnp'):
+                assert flt.accepts({'dnp': dnp}) == (dnp in ('', '0'))
+                assert len(flt.dnps) <= 2
+    finally:
+        eda.VARIANT_CACHE_SIZE = old
+        eda.variant_filters.clear()
+        eda.variants_lists.clear()
+
+
+def test_fields_overlay():
+    # Must behave like a copy of the shared fields, without changing them
+    lib = OrderedDict([('a', '1'), ('b', '2')])
+    comp = FieldsOverlay(lib, [('c', '3'), ('a', '4')])
+    sub = FieldsOverlay(comp)
+    sub['b'] = '5'
+    sub['d'] = '6'
+    assert list(comp.items()) == [('a', '4'), ('b', '2'), ('c', '3')]
+    assert list(sub.items()) == [('a', '4'), ('b', '5'), ('c', '3'), ('d', '6')]
+    assert len(sub) == 4 and 'c' in sub and 'x' not in sub and sub.get('x') is None
+    del sub['a']
+    assert list(sub.keys()) == ['b', 'c', 'd']
+    assert list(lib.items()) == [('a', '1'), ('b', '2')] and comp['a'] == '4'
+    # Passed between processes and stored in the BoM cache
+    assert list(pickle.loads(pickle.dumps(sub)).items()) == list(sub.items())
+    assert json.loads(json.dumps(OrderedDict(sub))) == dict(sub)
+
+
+def test_data_model_memory():
+    # Memory benchmark for the groups of parts, compared to the same data stored in a `__dict__`
+    try:
+        import tracemalloc
+    except ImportError:
+        return  # Python 2
+
+    class PlainData(object):
+        pass
+
+    def measure(group_cls, dd_cls, n=10000):
+        tracemalloc.start()
+        objs = []
+        for i in range(n):
+            o = group_cls()
+            for attr in PartGroup.__slots__:
+                setattr(o, attr, None)
+            o.dd = {}
+            for d in ('digikey', 'mouser'):
+                dd = o.dd[d] = dd_cls()
+                for attr in DistData.__slots__:
+                    setattr(dd, attr, None)
+            objs.append(o)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size / n
+    slotted = measure(PartGroup, DistData)
+    plain = measure(PlainData, PlainData)
+    logging.info('Memory per group: {:.0f} bytes, {:.0f} bytes using __dict__'.format(slotted, plain))
+    assert not hasattr(PartGroup(), '__dict__') and not hasattr(DistData(), '__dict__')
+    assert slotted < plain
+    # The groups share the names and values of the fields
+    set_edas_logger(logging.getLogger())
+    components = OrderedDict()
+    for i in range(4):
+        components['R{}'.format(i + 1)] = OrderedDict([('value', '{}k'.format(i)), (''.join(['foot', 'print']), ''.join(['R_', '0603'])),
+                                                       ('manf#', 'RC{}'.format(i))])
+    groups = group_parts(components, set(), 1)
+    assert len(groups) == 4
+    assert all(g.fields['footprint'] is groups[0].fields['footprint'] for g in groups)
+    assert all(len(g.manfcat_codes['manf#']) == 1 for g in groups)
+
+
+def test_group_parts_split():
+    # Parts that look identical, but with different manf#/cat# codes, are split in groups with the same codes.
+    # Every ref must be in exactly one group.
+    set_edas_logger(logging.getLogger())
+    set_distributors_logger(logging.getLogger())
+    init_distributor_dict()
+    components = OrderedDict()
+    for ref, codes in (('R1', [('manf#', 'A')]), ('R2', [('manf#', 'A')]), ('R3', [('manf#', 'B')]),
+                       ('R4', [('manf#', 'A'), ('digikey#', 'X')]), ('R5', []), ('R6', [('manf#', 'B')]),
+                       ('R7', [('manf#', 'C'), ('digikey#', 'X')]), ('C1', [('manf#', 'A')])):
+        components[ref] = OrderedDict([('value', '1u' if ref[0] == 'C' else '1k'), ('footprint', 'R_0603')] + codes)
+    groups = group_parts(components, set(), 1)
+    refs = [ref for g in groups for ref in g.refs]
+    assert sorted(refs) == sorted(components.keys())
+    assert [g.refs for g in groups] == [['R1', 'R2'], ['R3', 'R6'], ['R4'], ['R5'], ['R7'], ['C1']]
+    assert [(g.fields.get('manf#'), g.fields.get('digikey#')) for g in groups] == [('A', None), ('B', None), ('A', 'X'), (None, None),
+                                                                                   ('C', 'X'), ('A', None)]
+
+
 class TestKicost(unittest.TestCase):
 
     def setUp(self):